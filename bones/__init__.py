@@ -1,6 +1,8 @@
 import log
 import sequence
 import fast
+import kmer
+import simulate
 import samfile
 import utils
 import process
@@ -0,0 +1,178 @@
+import itertools
+
+__all__ = ["DiffAlignment", "diff_align", "common_prefix_length"]
+
+def common_prefix_length(a, b, x=0, y=0):
+    # length of the common run of a[x:] and b[y:], compared in slices of
+    # doubling size so long identical stretches run at C speed
+    limit = min(len(a) - x, len(b) - y)
+    size = 0
+    step = 32
+    while size < limit:
+        step = min(step, limit - size)
+        if a[x + size:x + size + step] == b[y + size:y + size + step]:
+            size += step
+            step *= 2
+            continue
+        if step == 1:
+            break
+        step //= 2
+    return size
+
+class DiffAlignment(object):
+    # a global alignment from diff_align(), with the attributes the pipeline
+    # reads off ssw alignments.  a deletion next to an insertion of the same
+    # length is reported as mismatches.
+    def __init__(self, query, reference, cigar_ops):
+        self.query = query
+        self.reference = reference
+        self.cigar_ops = cigar_ops
+        self.match_count = 0
+        self.mismatch_count = 0
+        self.insertion_count = 0
+        self.deletion_count = 0
+        (ref, seq) = (str(reference), str(query))
+        (x, y) = (0, 0)
+        for (op, length) in cigar_ops:
+            if op == 'M':
+                if ref[x:x + length] == seq[y:y + length]:
+                    matches = length
+                else:
+                    matches = sum(itertools.imap(str.__eq__, ref[x:x + length], seq[y:y + length]))
+                self.match_count += matches
+                self.mismatch_count += length - matches
+                (x, y) = (x + length, y + length)
+            elif op == 'I':
+                self.insertion_count += length
+                y += length
+            elif op == 'D':
+                self.deletion_count += length
+                x += length
+        (self.query_begin, self.query_end) = (0, len(query) - 1)
+        (self.reference_begin, self.reference_end) = (0, len(reference) - 1)
+        # ssw's default scoring: match 2, mismatch -2, gap open 3 / extend 1
+        gaps = [length for (op, length) in cigar_ops if op in "ID"]
+        self.score = 2 * self.match_count - 2 * self.mismatch_count - 3 * len(gaps) - sum(gaps) + len(gaps)
+
+    @property
+    def cigar(self):
+        return str.join('', ["%d%s" % (length, op) for (op, length) in self.cigar_ops])
+
+    @property
+    def edit_distance(self):
+        return self.mismatch_count + self.insertion_count + self.deletion_count
+
+    def __repr__(self):
+        return "DiffAlignment(cigar=%r, matches=%d, mismatches=%d)" % (self.cigar, self.match_count, self.mismatch_count)
+
+    def alignment_report(self, width=80):
+        (ref, query) = (str(self.reference), str(self.query))
+        rows = ([], [], [])
+        (x, y) = (0, 0)
+        for (op, length) in self.cigar_ops:
+            if op == 'M':
+                (ref_part, query_part) = (ref[x:x + length], query[y:y + length])
+                rows[1].append(str.join('', ['|' if pair[0] == pair[1] else '*' for pair in zip(ref_part, query_part)]))
+                (x, y) = (x + length, y + length)
+            elif op == 'I':
+                (ref_part, query_part) = ('-' * length, query[y:y + length])
+                rows[1].append(' ' * length)
+                y += length
+            else:
+                (ref_part, query_part) = (ref[x:x + length], '-' * length)
+                rows[1].append(' ' * length)
+                x += length
+            rows[0].append(ref_part)
+            rows[2].append(query_part)
+        (ref_row, marks, query_row) = [str.join('', row) for row in rows]
+        report = "Score = %d, Matches = %d, Mismatches = %d, Insertions = %d, Deletions = %d\n" % (self.score, self.match_count, self.mismatch_count, self.insertion_count, self.deletion_count)
+        for pos in xrange(0, len(marks), width):
+            report += "\nref   %s\n      %s\nquery %s\n" % (ref_row[pos:pos + width], marks[pos:pos + width], query_row[pos:pos + width])
+        return report
+
+def merge_ops(ops):
+    merged = []
+    for (op, length) in ops:
+        if not length:
+            continue
+        # a deletion and insertion of the same size next to each other are
+        # substitutions
+        if merged and set((op, merged[-1][0])) == set("ID") and merged[-1][1] == length:
+            merged.pop()
+            op = 'M'
+        if merged and merged[-1][0] == op:
+            length += merged.pop()[1]
+        merged.append((op, length))
+    return merged
+
+def diff_align(query, reference, max_distance=1000):
+    # unit cost edit distance of query against reference, following the
+    # furthest reaching points of each diagonal as in Myers' O(ND) diff but
+    # with substitutions as single edits (Landau and Vishkin), so a mismatch
+    # isn't split into an insertion and a deletion.  returns a DiffAlignment,
+    # or None when more than max_distance substitutions, insertions and
+    # deletions would be needed.  the cost is O((N + M) + D**2), so this is
+    # for checking sequences that should be near identical.
+    (a, b) = (str(reference), str(query))
+    (n, m) = (len(a), len(b))
+    trace = []
+    for distance in xrange(max_distance + 1):
+        furthest = [-1] * (2 * distance + 1)
+        for diagonal in xrange(-distance, distance + 1):
+            if distance:
+                x = edit_step(trace[-1], distance, diagonal, n, m)[0]
+                if x < 0:
+                    continue
+            else:
+                x = 0
+            x += common_prefix_length(a, b, x, x - diagonal)
+            furthest[diagonal + distance] = x
+            if x == n and diagonal == n - m:
+                trace.append(furthest)
+                return DiffAlignment(query, reference, merge_ops(traceback(trace, n, m)))
+        trace.append(furthest)
+    return None
+
+def edit_step(previous, distance, diagonal, n, m):
+    # the furthest point on diagonal one edit past the points of previous,
+    # which covers diagonals -(distance - 1) .. distance - 1 with -1 for
+    # those not reached.  (x, op), a substitution wins ties, op is None when
+    # the point is already at an end of a sequence.
+    (x, op) = (-1, None)
+    if -distance < diagonal < distance and previous[diagonal + distance - 1] >= 0:
+        x = previous[diagonal + distance - 1]
+        if x < n and x - diagonal < m:
+            (x, op) = (x + 1, 'X')
+    if diagonal - 1 > -distance:
+        prev_x = previous[diagonal + distance - 2]
+        if prev_x >= 0 and prev_x < n and prev_x + 1 > x:
+            (x, op) = (prev_x + 1, 'D')
+    if diagonal + 1 < distance:
+        prev_x = previous[diagonal + distance]
+        if prev_x >= 0 and prev_x - diagonal <= m and prev_x > x:
+            (x, op) = (prev_x, 'I')
+    return (x, op)
+
+def traceback(trace, n, m):
+    # walks the furthest reaching points of each distance back from (n, m)
+    ops = []
+    (x, y) = (n, m)
+    for distance in xrange(len(trace) - 1, 0, -1):
+        diagonal = x - y
+        (start, op) = edit_step(trace[distance - 1], distance, diagonal, n, m)
+        ops.append(('M', x - start))
+        if op == 'X':
+            ops.append(('M', 1))
+            (x, diagonal) = (start - 1, diagonal)
+        elif op == 'D':
+            ops.append(('D', 1))
+            (x, diagonal) = (start - 1, diagonal - 1)
+        elif op == 'I':
+            ops.append(('I', 1))
+            (x, diagonal) = (start, diagonal + 1)
+        else:
+            x = start
+        y = x - diagonal
+    ops.append(('M', x))
+    ops.reverse()
+    return ops
@@ -0,0 +1,273 @@
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+import collections
+
+__all__ = ["StageCache", "CachedStage", "file_digest", "source_digest"]
+
+def file_digest(fn, chunk_size=1 << 22):
+    digest = hashlib.sha1()
+    with open(fn, 'rb') as fh:
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+_source_digests = {}
+
+def source_digest(module_name):
+    # sha1 of the python source of the top level package module_name is in,
+    # or of the module alone when it isn't in one.  worked out once per
+    # process.
+    top = module_name.split('.')[0]
+    if top not in _source_digests:
+        module = sys.modules[top if '.' in module_name else module_name]
+        if getattr(module, "__file__", None) == None:
+            return "unknown"
+        path = os.path.splitext(module.__file__)[0] + ".py"
+        if os.path.basename(path) == "__init__.py":
+            fns = []
+            for (dirpath, dirnames, filenames) in os.walk(os.path.dirname(path)):
+                dirnames.sort()
+                fns += [os.path.join(dirpath, fn) for fn in sorted(filenames) if fn.endswith(".py")]
+        else:
+            fns = [path]
+        digest = hashlib.sha1()
+        for fn in fns:
+            digest.update(os.path.relpath(fn, os.path.dirname(path)) + '\0')
+            with open(fn, 'rb') as fh:
+                digest.update(fh.read())
+        _source_digests[top] = digest.hexdigest()
+    return _source_digests[top]
+
+def write_json(fn, obj):
+    # written aside and renamed so readers never see half a file
+    tempfn = "%s.%s.tmp" % (fn, uuid.uuid4().hex)
+    with open(tempfn, 'w') as fh:
+        json.dump(obj, fh)
+    os.rename(tempfn, fn)
+
+class StageCache(object):
+    # stage outputs stored under a key made from the stage, its version and
+    # arguments and the digests of its input files.  each entry is a
+    # directory under objects/ holding copies of the output files and an
+    # entry.json, whose mtime is bumped on every hit.  with max_bytes set,
+    # the least recently used entries are removed once the cache outgrows
+    # it.  file digests are remembered by path, size, mtime and inode in
+    # digests.json so unchanged inputs are only hashed once.
+    EntryName = "entry.json"
+    DigestsName = "digests.json"
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(path, "objects")
+        if not os.path.isdir(self.objects_dir):
+            try:
+                os.makedirs(self.objects_dir)
+            except OSError:
+                # made by someone else in the meantime
+                if not os.path.isdir(self.objects_dir):
+                    raise
+        self.lock = threading.Lock()
+        self._digests = None
+
+    def digests(self):
+        if self._digests == None:
+            fn = os.path.join(self.path, self.DigestsName)
+            self._digests = {}
+            if os.path.exists(fn):
+                with open(fn) as fh:
+                    self._digests = json.load(fh)
+        return self._digests
+
+    def file_signature(self, fn):
+        st = os.stat(fn)
+        return [st.st_size, st.st_mtime, st.st_ino]
+
+    def remember(self, fn, digest):
+        with self.lock:
+            self.digests()[os.path.abspath(fn)] = self.file_signature(fn) + [digest]
+            write_json(os.path.join(self.path, self.DigestsName), self.digests())
+
+    def digest(self, fn):
+        fn = os.path.abspath(fn)
+        with self.lock:
+            known = self.digests().get(fn)
+        if known != None and known[:3] == self.file_signature(fn):
+            return known[3]
+        digest = file_digest(fn)
+        self.remember(fn, digest)
+        return digest
+
+    def key(self, name, version, arguments, inputs):
+        # inputs is {name: [path, ...]}, only the contents of the files count
+        digests = [[name_, [self.digest(fn) for fn in fns]] for (name_, fns) in sorted(inputs.items())]
+        blob = json.dumps([name, version, arguments, digests], sort_keys=True)
+        return hashlib.sha1(blob).hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.objects_dir, key)
+
+    def fetch(self, key):
+        # the entry stored under key, or None
+        entry_fn = os.path.join(self.entry_dir(key), self.EntryName)
+        try:
+            with open(entry_fn) as fh:
+                entry = json.load(fh)
+            os.utime(entry_fn, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry
+
+    def restore(self, key, outputs):
+        # copies the entry's files over outputs ({name: [path, ...]} laid
+        # out as when stored), returns False on a miss
+        entry = self.fetch(key)
+        if entry == None:
+            return False
+        stored = entry["outputs"]
+        if sorted(stored) != sorted(outputs) or any([len(stored[name]) != len(outputs[name]) for name in outputs]):
+            return False
+        for (name, fns) in outputs.items():
+            for (fn, (object_name, digest)) in zip(fns, stored[name]):
+                # a copy, tools may later rewrite their outputs in place
+                shutil.copyfile(os.path.join(self.entry_dir(key), object_name), fn)
+                self.remember(fn, digest)
+        return True
+
+    def store(self, key, outputs):
+        # copies the files in outputs ({name: [path, ...]}) into the cache
+        if os.path.exists(self.entry_dir(key)):
+            return
+        tempdir = os.path.join(self.objects_dir, "%s.%s.tmp" % (key, uuid.uuid4().hex))
+        os.makedirs(tempdir)
+        entry = {"key": key, "created": time.time(), "outputs": {}, "size": 0}
+        try:
+            for (name, fns) in sorted(outputs.items()):
+                entry["outputs"][name] = []
+                for fn in fns:
+                    object_name = "%d" % sum([len(objects) for objects in entry["outputs"].values()])
+                    shutil.copyfile(fn, os.path.join(tempdir, object_name))
+                    entry["outputs"][name].append([object_name, self.digest(fn)])
+                    entry["size"] += os.path.getsize(fn)
+            write_json(os.path.join(tempdir, self.EntryName), entry)
+            os.rename(tempdir, self.entry_dir(key))
+        except OSError:
+            # stored by someone else first
+            if not os.path.exists(self.entry_dir(key)):
+                raise
+        finally:
+            if os.path.exists(tempdir):
+                shutil.rmtree(tempdir)
+        self.evict(keep=key)
+
+    def entries(self):
+        # [(last used, size, key)] of every entry
+        entries = []
+        for key in os.listdir(self.objects_dir):
+            entry_fn = os.path.join(self.entry_dir(key), self.EntryName)
+            if key.endswith(".tmp") or not os.path.exists(entry_fn):
+                continue
+            with open(entry_fn) as fh:
+                size = json.load(fh)["size"]
+            entries.append((os.path.getmtime(entry_fn), size, key))
+        return entries
+
+    def size(self):
+        return sum([entry[1] for entry in self.entries()])
+
+    def evict(self, keep=None):
+        if self.max_bytes == None:
+            return
+        entries = sorted(self.entries())
+        total = sum([entry[1] for entry in entries])
+        for (used, size, key) in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total -= size
+
+class CachedStage(object):
+    # mixin for pipeline stages and tasks: a stage declaring the context
+    # keys it Consumes and Produces is run through a StageCache when the
+    # context has a dir_cache.  consumed keys that name files are the
+    # inputs, produced keys that name files are the outputs.  stages with
+    # outputs that aren't in the context override output_files().
+    Consumes = None
+    Produces = None
+
+    def version(self):
+        # stages running in python change with the source they run
+        return "source %s" % source_digest(type(self).__module__)
+
+    def cache_arguments(self):
+        # whatever else changes the outputs, JSON-able
+        return []
+
+    def context_files(self, keys):
+        # {key: [path, ...]}, or None if a key isn't a file (yet)
+        files = collections.OrderedDict()
+        for key in keys or []:
+            value = self.context[key] if key in self.context else None
+            paths = [value] if isinstance(value, basestring) else value
+            if not paths or not all([isinstance(path, basestring) and os.path.isfile(path) for path in paths]):
+                return None
+            files[key] = list(paths)
+        return files
+
+    def input_files(self):
+        files = collections.OrderedDict()
+        for key in self.Consumes or []:
+            found = self.context_files([key])
+            # a consumed name outside the context, like a bwa index, is
+            # covered by the inputs it was made from
+            if found != None:
+                files.update(found)
+        return files
+
+    def output_files(self, existing=False):
+        # existing=False lists where the outputs will go, before the run
+        files = collections.OrderedDict()
+        for key in self.Produces or []:
+            value = self.context[key] if key in self.context else None
+            paths = [value] if isinstance(value, basestring) else value
+            if not paths or not all([isinstance(path, basestring) and not os.path.isdir(path) for path in paths]):
+                return None
+            if existing and not all([os.path.isfile(path) for path in paths]):
+                return None
+            files[key] = list(paths)
+        return files
+
+    def stage_cache(self):
+        if self.Produces == None or "dir_cache" not in self.context or not self.context["dir_cache"]:
+            return None
+        return StageCache(self.context["dir_cache"], self.context["cache_max_bytes"] if "cache_max_bytes" in self.context else None)
+
+    def cache_key(self, cache, kw=None):
+        if self.output_files() == None:
+            return None
+        name = "%s.%s" % (type(self).__module__, type(self).__name__)
+        return cache.key(name, self.version(), [self.cache_arguments(), kw or {}], self.input_files())
+
+    def cached_run(self, **kw):
+        # _run(**kw), unless the cache already has this stage's outputs
+        cache = self.stage_cache()
+        key = self.cache_key(cache, kw) if cache != None else None
+        if key != None and cache.restore(key, self.output_files()):
+            print "%s: restored from cache %s" % (type(self).__name__, key)
+            return None
+        ret = self._run(**kw)
+        outputs = self.output_files(existing=True) if key != None else None
+        if outputs != None:
+            cache.store(key, outputs)
+        return ret
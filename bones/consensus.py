@@ -1,9 +1,38 @@
+import os
 import pysam
 import sys
+import json
 import collections
 import operator
+import itertools
+import heapq
+import multiprocessing
+import numpy
 import sequence
-from . samfile import Samfile
+from . samfile import Samfile, handle_pool
+from . fast import FastAWriter
+
+__all__ = ["Consensus", "VectorConsensus", "RegionCounts", "CountStore", "count_region"]
+
+# pileup's default stepper ("all") drops unmapped, secondary, qcfail and
+# duplicate reads before they are counted towards the column depth
+StepperMask = 0x4 | 0x100 | 0x200 | 0x400
+# bases below this quality never show up in pileup_column.pileups
+MinBaseQuality = 13
+MinMappingQuality = 20
+
+# columns of the count matrix
+CountColumns = ("A", "C", "G", "T", "N", "del", "refskip")
+(BaseN, BaseDel, BaseRefskip) = (4, 5, 6)
+BaseColumn = numpy.empty(0x100, dtype=numpy.int64)
+BaseColumn.fill(BaseN)
+for (idx, base) in enumerate("ACGT"):
+    BaseColumn[ord(base)] = BaseColumn[ord(base.lower())] = idx
+ColumnBases = numpy.frombuffer("ACGTN", dtype=numpy.uint8)
+
+# call types, indexed by the Call* codes
+CallTypes = ("CL", "LC", "NC", "DL", "RS")
+(CallCL, CallLC, CallNC, CallDL, CallRS) = range(len(CallTypes))
 
 class Consensus(object):
     def __init__(self, read_coverage_threshold=10):
@@ -15,8 +44,11 @@ class Consensus(object):
             if self.filter_pileup_read(pileup_read):
                 continue
             alignment = pileup_read.alignment
-            if pileup_read.is_del or pileup_read.is_refskip:
-                base = ''
+            if pileup_read.is_refskip:
+                base = "refskip"
+                base_quality = -1
+            elif pileup_read.is_del:
+                base = "del"
                 base_quality = -1
             else:
                 base_quality = alignment.query_qualities[pileup_read.query_position]
@@ -27,7 +59,7 @@ class Consensus(object):
         return dict(base_count)
 
     def filter_pileup_read(self, pileup_read):
-        if pileup_read.alignment.mapq < 20:
+        if pileup_read.alignment.mapq < MinMappingQuality:
             return True
         if pileup_read.alignment.is_qcfail:
             return True
@@ -86,3 +118,598 @@ class Consensus(object):
             if self.coverage["column_count"]:
                 self.coverage["avg_coverage"] = self.coverage["avg_coverage"] / float(self.coverage["column_count"])
             yield sequence.Sequence(seq, name=name)
+
+
+def expand_blocks(starts, lengths):
+    # concatenated ranges [start, start + length) for every block
+    lengths = numpy.asarray(lengths, dtype=numpy.int64)
+    total = lengths.sum()
+    if not total:
+        return numpy.zeros(0, dtype=numpy.int64)
+    offsets = numpy.cumsum(lengths) - lengths
+    return numpy.repeat(numpy.asarray(starts, dtype=numpy.int64) - offsets, lengths) + numpy.arange(total)
+
+def span_counts(starts, ends, start, end):
+    # number of [starts, ends) spans covering each position of [start, end)
+    starts = numpy.clip(numpy.asarray(starts, dtype=numpy.int64), start, end) - start
+    ends = numpy.clip(numpy.asarray(ends, dtype=numpy.int64), start, end) - start
+    size = end - start + 1
+    diff = numpy.bincount(starts, minlength=size) - numpy.bincount(ends, minlength=size)
+    return numpy.cumsum(diff[:-1])
+
+class RegionCounts(object):
+    # per column counts for reference positions [start, end).  counts has one
+    # row per column in the order of CountColumns, depth is what pileup
+    # reports as pileup_column.n, insertions maps a column offset to the
+    # count of every base+insertion key seen there (those reads are not in
+    # counts).
+    def __init__(self, reference, start, end, counts, depth, insertions):
+        self.reference = reference
+        self.start = start
+        self.end = end
+        self.counts = counts
+        self.depth = depth
+        self.insertions = insertions
+
+def count_region(samf, reference, start, end, min_mapping_quality=MinMappingQuality, min_base_quality=MinBaseQuality, ignore_overlaps=True, max_depth=None):
+    # mirrors what Consensus sees through samf.pileup(), one python step per
+    # read and cigar operation rather than per read per column.  max_depth
+    # caps the reads counted at any column: reads are taken in BAM order
+    # while fewer than max_depth counted reads overlap their start, so the
+    # subset is the same on every run.  depth always has every read.
+    seqs = []
+    quals = []
+    spans = ([], [])
+    aligned = ([], [], [], [], [])
+    skips = dict((op, ([], [], [])) for op in (2, 3))
+    inserts = []
+    # first mate of a pair, and the reference span both mates cover
+    pairs = {}
+    overlaps = [[], []]
+    # ends of the counted reads still overlapping the current read
+    counted = []
+    offset = 0
+    for read in samf.fetch(reference, start, end):
+        flag = read.flag
+        cigar = read.cigartuples
+        if flag & StepperMask or not cigar:
+            continue
+        spans[0].append(read.reference_start)
+        spans[1].append(read.reference_end)
+        seq = read.query_sequence
+        # secondary and supplementary alignments are often stored without
+        # SEQ, they cover the reference but have no bases to count
+        if read.mapping_quality < min_mapping_quality or seq == None:
+            continue
+        if max_depth != None:
+            while counted and counted[0] <= read.reference_start:
+                heapq.heappop(counted)
+            if len(counted) >= max_depth:
+                continue
+            heapq.heappush(counted, read.reference_end)
+        qual = read.query_qualities
+        qlen = len(seq)
+        seqs.append(seq)
+        quals.append(qual.tostring() if qual != None else '\xff' * qlen)
+        # mates htslib will fold together when they overlap
+        (pair, role) = (-1, 0)
+        if ignore_overlaps and flag & 0x2 and not flag & 0x8 and abs(read.template_length) < 2 * qlen:
+            mate = pairs.pop(read.query_name, None)
+            if mate == None:
+                pair = len(overlaps[0])
+                pairs[read.query_name] = (pair, read.reference_end)
+                overlaps[0].append(0)
+                overlaps[1].append(0)
+            else:
+                (pair, role) = (mate[0], 1)
+                overlaps[0][pair] = read.reference_start
+                overlaps[1][pair] = min(mate[1], read.reference_end)
+        rpos = read.reference_start
+        qpos = 0
+        last_op = None
+        for (op, length) in cigar:
+            if op in (0, 7, 8):
+                aligned[0].append(rpos)
+                aligned[1].append(offset + qpos)
+                aligned[2].append(length)
+                aligned[3].append(pair)
+                aligned[4].append(role)
+                rpos += length
+                qpos += length
+            elif op == 1:
+                if last_op in (0, 7, 8):
+                    inserts.append((rpos - 1, offset + qpos - 1, length))
+                qpos += length
+            elif op in (2, 3):
+                # deletions are filtered on the quality of the next base
+                skips[op][0].append(rpos)
+                skips[op][1].append(length)
+                skips[op][2].append(offset + qpos if qpos < qlen else -1)
+                rpos += length
+            elif op == 4:
+                qpos += length
+            last_op = op
+        offset += qlen
+
+    size = end - start
+    counts = numpy.zeros((size, len(CountColumns)), dtype=numpy.int64)
+    depth = span_counts(spans[0], spans[1], start, end)
+    insertions = {}
+    if not seqs:
+        return RegionCounts(reference, start, end, counts, depth, insertions)
+    bases = numpy.frombuffer(str.join('', seqs), dtype=numpy.uint8)
+    # one spare slot at the end reads as quality zero for the -1 indices above
+    qualities = numpy.zeros(len(bases) + 1, dtype=numpy.int64)
+    qualities[:-1] = numpy.frombuffer(str.join('', quals), dtype=numpy.uint8)
+
+    refpos = expand_blocks(aligned[0], aligned[2])
+    querypos = expand_blocks(aligned[1], aligned[2])
+    if len(overlaps[0]):
+        pair_ids = numpy.repeat(numpy.asarray(aligned[3], dtype=numpy.int64), aligned[2])
+        roles = numpy.repeat(numpy.asarray(aligned[4], dtype=numpy.int64), aligned[2])
+        (low, high) = (numpy.array(overlaps[0] + [0]), numpy.array(overlaps[1] + [0]))
+        # pair -1 picks the empty span at the end
+        shared = numpy.flatnonzero((refpos >= low[pair_ids]) & (refpos < high[pair_ids]))
+        tweak_overlaps(bases, qualities, refpos[shared], querypos[shared], pair_ids[shared], roles[shared])
+    keep = (refpos >= start) & (refpos < end) & (qualities[querypos] >= min_base_quality)
+    cells = (refpos[keep] - start) * len(CountColumns) + BaseColumn[bases[querypos[keep]]]
+    counts += numpy.bincount(cells, minlength=counts.size).reshape(counts.shape)
+
+    for (op, column) in ((2, BaseDel), (3, BaseRefskip)):
+        (skip_starts, skip_lengths, skip_next) = [numpy.asarray(val, dtype=numpy.int64) for val in skips[op]]
+        if not len(skip_starts):
+            continue
+        keep = qualities[skip_next] >= min_base_quality
+        counts[:, column] += span_counts(skip_starts[keep], (skip_starts + skip_lengths)[keep], start, end)
+
+    raw = bases.tostring()
+    for (anchor, anchor_qpos, length) in inserts:
+        if not (start <= anchor < end) or qualities[anchor_qpos] < min_base_quality:
+            continue
+        # the read is counted under base+insertion instead of its base
+        counts[anchor - start, BaseColumn[bases[anchor_qpos]]] -= 1
+        column = insertions.setdefault(anchor - start, collections.defaultdict(int))
+        column[raw[anchor_qpos:anchor_qpos + length + 1]] += 1
+    return RegionCounts(reference, start, end, counts, depth, insertions)
+
+def tweak_overlaps(bases, qualities, refpos, querypos, pair_ids, roles):
+    # htslib's tweak_overlap_quality: where both mates align a base to the
+    # same column the first mate takes the combined quality and the second is
+    # zeroed, if they disagree the better base keeps 80% of its quality
+    if not len(refpos):
+        return
+    keys = ((pair_ids * (refpos.max() + 1) + refpos) << 1) | roles
+    order = numpy.argsort(keys)
+    keys = keys[order] >> 1
+    dup = numpy.flatnonzero(keys[1:] == keys[:-1])
+    first = querypos[order[dup]]
+    second = querypos[order[dup + 1]]
+    (qa, qb) = (qualities[first], qualities[second])
+    same = bases[first] == bases[second]
+    better = qa >= qb
+    qualities[first] = numpy.where(same, numpy.minimum(qa + qb, 200), numpy.where(better, (qa * 0.8).astype(numpy.int64), 0))
+    qualities[second] = numpy.where(same | better, 0, (qb * 0.8).astype(numpy.int64))
+
+class VectorConsensus(Consensus):
+    # same calls as Consensus, but columns are counted a region at a time
+    # into arrays by count_region and called in bulk.  regions are fixed
+    # size windows of each reference, and can be spread over a process pool.
+    DefaultRegionSize = 1 << 16
+
+    def __init__(self, read_coverage_threshold=10, region_size=None, processes=1, max_depth=None):
+        super(VectorConsensus, self).__init__(read_coverage_threshold)
+        self.region_size = region_size if region_size != None else self.DefaultRegionSize
+        # None uses every cpu
+        self.processes = processes
+        # reads counted per column, see count_region()
+        self.max_depth = max_depth
+
+    def call_region(self, region):
+        # returns the called sequence of a RegionCounts and the call type of
+        # each covered column
+        counts = region.counts
+        covered = region.depth > 0
+        winners = counts.argmax(axis=1)
+        totals = counts.sum(axis=1)
+        calls = {}
+        for (column, keys) in region.insertions.iteritems():
+            # the column as call_pileup_column() sees it, so ties go the same way
+            base_count = dict(keys)
+            base_count.update([(CountColumns[col], count) for (col, count) in enumerate(counts[column]) if count])
+            totals[column] += sum(keys.itervalues())
+            hist = sorted(base_count.items(), key=operator.itemgetter(1))
+            key = hist[-1][0]
+            if key in CountColumns:
+                winners[column] = CountColumns.index(key)
+            else:
+                calls[column] = key
+                # typed as a called base whatever the counts say
+                winners[column] = counts[column, :BaseDel].argmax()
+        types = numpy.empty(len(counts), dtype=numpy.int64)
+        types.fill(CallCL)
+        types[winners == BaseDel] = CallDL
+        types[winners == BaseRefskip] = CallRS
+        types[region.depth < self.read_coverage_threshold] = CallLC
+        types[totals == 0] = CallNC
+        emit = covered & (types == CallCL)
+        chars = ColumnBases[numpy.minimum(winners, BaseN)]
+        pieces = []
+        prev = 0
+        for column in sorted(calls):
+            if not emit[column]:
+                continue
+            pieces.append(chars[prev:column][emit[prev:column]].tostring())
+            pieces.append(calls[column])
+            prev = column + 1
+        pieces.append(chars[prev:][emit[prev:]].tostring())
+        return (str.join('', pieces), types[covered])
+
+    def regions(self, samf, reference):
+        length = samf.get_reference_length(reference)
+        for start in xrange(0, length, self.region_size):
+            yield (start, min(start + self.region_size, length))
+
+    def count_region(self, samf, reference, start, end):
+        if isinstance(samf, CountStore):
+            return samf.region(reference, start, end)
+        return count_region(samf, reference, start, end, max_depth=self.max_depth)
+
+    def region_stats(self, region, types):
+        # coverage and call type totals of one region as plain values, so
+        # they can be summed in any process
+        depth = region.depth[region.depth > 0]
+        stats = {"max_coverage": None, "min_coverage": None, "coverage_sum": int(depth.sum()), "column_count": len(depth)}
+        if len(depth):
+            stats["max_coverage"] = int(depth.max())
+            stats["min_coverage"] = int(depth.min())
+        hist = numpy.bincount(types, minlength=len(CallTypes))
+        stats["call_type_hist"] = dict((CallTypes[code], int(count)) for (code, count) in enumerate(hist) if count)
+        return stats
+
+    def process_region(self, samf, reference, start, end):
+        region = self.count_region(samf, reference, start, end)
+        (seq, types) = self.call_region(region)
+        return (seq, self.region_stats(region, types))
+
+    def merge_stats(self, region_stats):
+        # combines region_stats() of one reference into (coverage, call_type_hist)
+        coverage = {"max_coverage": None, "min_coverage": None, "avg_coverage": 0, "column_count": 0}
+        call_type_hist = collections.defaultdict(int)
+        for stats in region_stats:
+            if stats["column_count"]:
+                if coverage["max_coverage"] == None:
+                    coverage["max_coverage"] = stats["max_coverage"]
+                    coverage["min_coverage"] = stats["min_coverage"]
+                coverage["max_coverage"] = max(coverage["max_coverage"], stats["max_coverage"])
+                coverage["min_coverage"] = min(coverage["min_coverage"], stats["min_coverage"])
+                coverage["avg_coverage"] += stats["coverage_sum"]
+                coverage["column_count"] += stats["column_count"]
+            for (call_type, count) in stats["call_type_hist"].iteritems():
+                call_type_hist[call_type] += count
+        if coverage["column_count"]:
+            coverage["avg_coverage"] = coverage["avg_coverage"] / float(coverage["column_count"])
+        return (coverage, call_type_hist)
+
+    def jobs(self, samf):
+        for reference in samf.references:
+            for (start, end) in self.regions(samf, reference):
+                yield (reference, start, end)
+
+    def iter_regions(self, samf):
+        # yields (reference, start, end, sequence, stats) for every region in
+        # coordinate order, counted on a process pool unless processes is 1
+        if self.processes == 1:
+            for (reference, start, end) in self.jobs(samf):
+                yield (reference, start, end) + self.process_region(samf, reference, start, end)
+            return
+        processes = self.processes if self.processes != None else multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(samf.filename, self))
+        try:
+            # imap keeps the order the regions were handed out in
+            for result in pool.imap(_process_region, self.jobs(samf)):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def open_samfile(self, samf):
+        if isinstance(samf, CountStore):
+            return samf
+        if type(samf) in (str, unicode) and CountStore.is_store(samf):
+            return CountStore(samf)
+        if type(samf) in (str, unicode):
+            samf = Samfile(samf)
+        if isinstance(samf, Samfile):
+            samf = samf.samf
+        return samf
+
+    def iter_references(self, samf):
+        # yields (reference, regions) with the iter_regions() results of
+        # each reference in turn
+        return itertools.groupby(self.iter_regions(self.open_samfile(samf)), key=operator.itemgetter(0))
+
+    def iter_calls(self, samf):
+        # yields (consensus sequence, coverage, call_type_hist) per reference
+        for (reference, results) in self.iter_references(samf):
+            results = list(results)
+            seq = str.join('', [result[3] for result in results])
+            (coverage, call_type_hist) = self.merge_stats([result[4] for result in results])
+            yield (sequence.Sequence(seq, name="%s_consensus" % reference), coverage, call_type_hist)
+
+    def stream_calls(self, samf, writer, stats_fh=None):
+        # writes each region to a FastAWriter as soon as it is called, and its
+        # stats as a line of JSON to stats_fh.  only one region is held at a
+        # time.  yields (name, coverage, call_type_hist) as each reference is
+        # finished.
+        for (reference, results) in self.iter_references(samf):
+            name = "%s_consensus" % reference
+            writer.begin(name, sequence.Sequence('', name=name).info)
+            (coverage, call_type_hist) = self.merge_stats(self._write_regions(results, writer, stats_fh))
+            writer.end()
+            writer.flush()
+            yield (name, coverage, call_type_hist)
+
+    def _write_regions(self, results, writer, stats_fh):
+        offset = 0
+        for (reference, start, end, seq, stats) in results:
+            writer.write_bases(seq)
+            writer.flush()
+            if stats_fh != None:
+                window = {"reference": reference, "start": start, "end": end, "consensus_start": offset, "consensus_length": len(seq)}
+                window.update(stats)
+                stats_fh.write(json.dumps(window) + '\n')
+                stats_fh.flush()
+            offset += len(seq)
+            yield stats
+
+    def write_calls(self, samf, fafn, stats_fn=None):
+        # streams the consensus to fafn (and window stats to stats_fn),
+        # returns [(name, coverage, call_type_hist), ...]
+        stats_fh = open(stats_fn, 'w') if stats_fn != None else None
+        try:
+            with FastAWriter(fafn) as writer:
+                return list(self.stream_calls(samf, writer, stats_fh))
+        finally:
+            if stats_fh != None:
+                stats_fh.close()
+
+    def call_samfile(self, samf):
+        # the last reference's stats are also left on self, like Consensus
+        for (seq, coverage, call_type_hist) in self.iter_calls(samf):
+            self.coverage = coverage
+            self.call_type_hist = call_type_hist
+            yield seq
+
+# each pool worker keeps its own handle on the alignment
+_worker = {}
+
+def _init_worker(fn, caller):
+    _worker["samf"] = CountStore(fn) if CountStore.is_store(fn) else handle_pool.get(fn)
+    _worker["caller"] = caller
+
+def _process_region(job):
+    (reference, start, end) = job
+    return (reference, start, end) + _worker["caller"].process_region(_worker["samf"], reference, start, end)
+
+class CountStore(object):
+    # count_region() results kept on disk so more reads can be added later
+    # and the consensus called again without going back to the reads.  a
+    # directory with index.json, and per reference a (length, 7) counts and
+    # a depth .npy, opened as memmaps, plus the insertions as JSON.  the
+    # store can be handed to VectorConsensus in place of a BAM.
+    #
+    # the files of a reference are never changed in place.  adding to it
+    # writes the next generation of its files, and flush() switches the
+    # index over to them in one rename, so a crash part way leaves the store
+    # as it was and the add can simply be run again.
+    IndexName = "index.json"
+    Version = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.filename = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if os.path.exists(self.index_fn):
+            with open(self.index_fn) as fh:
+                self.index = json.load(fh)
+            # version 1 stores are generation 0 throughout
+            if self.index.get("version") not in (1, self.Version):
+                raise ValueError("%s: unsupported count store version %r" % (path, self.index.get("version")))
+        else:
+            self.index = {"version": self.Version, "columns": CountColumns, "references": [], "sources": []}
+        self._arrays = {}
+        self._insertions = {}
+        # reference name -> entry of the generation being written
+        self._staged = collections.OrderedDict()
+        self._staged_sources = []
+
+    @classmethod
+    def is_store(cls, path):
+        return os.path.exists(os.path.join(path, cls.IndexName))
+
+    @property
+    def index_fn(self):
+        return os.path.join(self.path, self.IndexName)
+
+    @property
+    def references(self):
+        return tuple(ref["name"] for ref in self.index["references"])
+
+    @property
+    def sources(self):
+        return [source["filename"] for source in self.index["sources"]]
+
+    def reference_entry(self, reference):
+        if reference in self._staged:
+            return self._staged[reference]
+        for ref in self.index["references"]:
+            if ref["name"] == reference:
+                return ref
+        raise KeyError(reference)
+
+    def get_reference_length(self, reference):
+        return self.reference_entry(reference)["length"]
+
+    def add_reference(self, reference, length):
+        # stages the next generation of reference's files, a copy of the
+        # current ones or zeros for a new reference
+        try:
+            entry = self.reference_entry(reference)
+        except KeyError:
+            entry = None
+        if entry != None and entry["length"] != length:
+            raise ValueError("%s is %d bases in the store, not %d" % (reference, entry["length"], length))
+        if reference in self._staged:
+            return entry
+        if entry == None:
+            stem = "ref_%d" % (len(self.index["references"]) + len([ref for ref in self._staged.values() if ref.get("new")]))
+            staged = {"name": reference, "length": length, "stem": stem, "generation": 0, "new": True}
+        else:
+            staged = dict(entry, generation=entry.get("generation", 0) + 1)
+        counts = numpy.lib.format.open_memmap(self.array_fn(staged, "counts"), mode="w+", dtype=numpy.int32, shape=(length, len(CountColumns)))
+        depth = numpy.lib.format.open_memmap(self.array_fn(staged, "depth"), mode="w+", dtype=numpy.int32, shape=(length, ))
+        if entry != None:
+            (counts[:], depth[:]) = self.arrays(reference)
+            insertions = dict((pos, dict(keys)) for (pos, keys) in self.insertions(reference)[0].iteritems())
+        else:
+            insertions = {}
+        self._staged[reference] = staged
+        self._arrays[reference] = (counts, depth)
+        self._insertions[reference] = (insertions, None)
+        return staged
+
+    def array_fn(self, entry, kind):
+        if not entry.get("generation"):
+            return os.path.join(self.path, "%s.%s.npy" % (entry["stem"], kind))
+        return os.path.join(self.path, "%s.%s.%d.npy" % (entry["stem"], kind, entry["generation"]))
+
+    def insertions_fn(self, entry):
+        if not entry.get("generation"):
+            return os.path.join(self.path, "%s.insertions.json" % entry["stem"])
+        return os.path.join(self.path, "%s.insertions.%d.json" % (entry["stem"], entry["generation"]))
+
+    def arrays(self, reference):
+        if reference not in self._arrays:
+            entry = self.reference_entry(reference)
+            self._arrays[reference] = (numpy.load(self.array_fn(entry, "counts"), mmap_mode="r"), numpy.load(self.array_fn(entry, "depth"), mmap_mode="r"))
+        return self._arrays[reference]
+
+    def insertions(self, reference):
+        # {position: {key: count}}, and its positions sorted for lookups
+        if reference not in self._insertions:
+            insertions = {}
+            fn = self.insertions_fn(self.reference_entry(reference))
+            if os.path.exists(fn):
+                with open(fn) as fh:
+                    for (pos, keys) in json.load(fh).iteritems():
+                        insertions[int(pos)] = dict((str(key), count) for (key, count) in keys.iteritems())
+            self._insertions[reference] = (insertions, None)
+        (insertions, positions) = self._insertions[reference]
+        if positions is None:
+            positions = numpy.array(sorted(insertions), dtype=numpy.int64)
+            self._insertions[reference] = (insertions, positions)
+        return (insertions, positions)
+
+    def region(self, reference, start, end):
+        (counts, depth) = self.arrays(reference)
+        (insertions, positions) = self.insertions(reference)
+        lo = numpy.searchsorted(positions, start)
+        hi = numpy.searchsorted(positions, end)
+        region_insertions = dict((pos - start, insertions[pos]) for pos in positions[lo:hi].tolist())
+        return RegionCounts(reference, start, end, numpy.array(counts[start:end], dtype=numpy.int64), numpy.array(depth[start:end], dtype=numpy.int64), region_insertions)
+
+    def add_region(self, region):
+        # kept in the staged generation until flush()
+        if region.reference not in self._staged:
+            self.add_reference(region.reference, self.get_reference_length(region.reference))
+        (counts, depth) = self.arrays(region.reference)
+        counts[region.start:region.end] += region.counts.astype(numpy.int32)
+        depth[region.start:region.end] += region.depth.astype(numpy.int32)
+        (insertions, positions) = self.insertions(region.reference)
+        for (offset, keys) in region.insertions.iteritems():
+            column = insertions.setdefault(region.start + offset, {})
+            for (key, count) in keys.iteritems():
+                column[key] = column.get(key, 0) + count
+        if region.insertions:
+            self._insertions[region.reference] = (insertions, None)
+
+    def add_samfile(self, samf, region_size=None):
+        # counts every read of an indexed BAM into the store, all or nothing
+        fn = samf if type(samf) in (str, unicode) else samf.filename
+        source = {"filename": os.path.abspath(fn), "size": os.path.getsize(fn), "mtime": os.path.getmtime(fn)}
+        if source in self.index["sources"]:
+            raise ValueError("%s has already been added to %s" % (fn, self.path))
+        if type(samf) in (str, unicode):
+            samf = handle_pool.get(samf)
+        region_size = region_size if region_size != None else VectorConsensus.DefaultRegionSize
+        try:
+            for (reference, length) in zip(samf.references, samf.lengths):
+                self.add_reference(reference, length)
+                for start in xrange(0, length, region_size):
+                    self.add_region(count_region(samf, reference, start, min(start + region_size, length)))
+            self._staged_sources.append(source)
+            self.flush()
+        except:
+            self.discard()
+            raise
+
+    def staged_files(self, entry):
+        return [self.array_fn(entry, "counts"), self.array_fn(entry, "depth"), self.insertions_fn(entry)]
+
+    def discard(self):
+        # drops whatever was staged since the last flush()
+        for (reference, entry) in self._staged.items():
+            self._arrays.pop(reference, None)
+            self._insertions.pop(reference, None)
+            for fn in self.staged_files(entry):
+                if os.path.exists(fn):
+                    os.unlink(fn)
+        self._staged = collections.OrderedDict()
+        self._staged_sources = []
+
+    def flush(self):
+        # writes out the staged generations, then commits them by replacing
+        # the index in one rename.  the files they supersede go after that.
+        if not self._staged and not self._staged_sources:
+            return
+        for (reference, entry) in self._staged.items():
+            (counts, depth) = self._arrays[reference]
+            counts.flush()
+            depth.flush()
+            with open(self.insertions_fn(entry), 'w') as fh:
+                json.dump(self.insertions(reference)[0], fh)
+        index = dict(self.index)
+        (index["references"], superseded) = ([], [])
+        for ref in self.index["references"]:
+            if ref["name"] in self._staged:
+                superseded.append(ref)
+                ref = self._staged[ref["name"]]
+            index["references"].append(ref)
+        index["references"] += [entry for entry in self._staged.values() if entry.get("new")]
+        for entry in index["references"]:
+            entry.pop("new", None)
+        index["sources"] = self.index["sources"] + self._staged_sources
+        index["version"] = self.Version
+        tmpfn = self.index_fn + ".tmp"
+        with open(tmpfn, 'w') as fh:
+            json.dump(index, fh)
+        os.rename(tmpfn, self.index_fn)
+        self.index = index
+        (self._staged, self._staged_sources) = (collections.OrderedDict(), [])
+        for entry in superseded:
+            for fn in self.staged_files(entry):
+                if os.path.exists(fn):
+                    os.unlink(fn)
+        # read back from the committed files from now on
+        self._arrays = {}
+
+    def close(self):
+        self._arrays = {}
+        self._insertions = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,144 @@
+import re
+import threading
+
+__all__ = ["Context", "ContextError"]
+
+class ContextError(Exception):
+    pass
+
+class Context(dict):
+    # a dict whose string values may be %(key)s templates over other keys.
+    # the keys a template refers to are found once when it is set, resolved
+    # values are cached, and setting a key only drops the cached values of
+    # the templates that depend on it.  a template refering to a missing
+    # key, or to itself through others, raises ContextError when read; use
+    # check() to find those up front.  strings without %(key) references
+    # are plain values.
+    ReferencePattern = re.compile(r"%\(([^)]*)\)")
+
+    def __init__(self, *args, **kw):
+        super(Context, self).__init__()
+        self._lock = threading.RLock()
+        self._references = {}
+        self._dependents = {}
+        self._resolved = {}
+        self.init(*args, **kw)
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def references(self, value):
+        if not isinstance(value, basestring):
+            return ()
+        return tuple(set(self.ReferencePattern.findall(value)))
+
+    def invalidate(self, key):
+        # drops the cached value of key and of everything built on it
+        (pending, seen) = ([key], set())
+        while pending:
+            key = pending.pop()
+            if key in seen:
+                continue
+            seen.add(key)
+            self._resolved.pop(key, None)
+            pending.extend(self._dependents.get(key, ()))
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            for ref in self._references.pop(key, ()):
+                self._dependents[ref].discard(key)
+            refs = self.references(value)
+            if refs:
+                self._references[key] = refs
+                for ref in refs:
+                    self._dependents.setdefault(ref, set()).add(key)
+            super(Context, self).__setitem__(key, value)
+            self.invalidate(key)
+
+    def __delitem__(self, key):
+        with self._lock:
+            super(Context, self).__delitem__(key)
+            for ref in self._references.pop(key, ()):
+                self._dependents[ref].discard(key)
+            self.invalidate(key)
+
+    def update(self, *args, **kw):
+        for (key, value) in dict(*args, **kw).iteritems():
+            self[key] = value
+
+    def setdefault(self, key, value=None):
+        if key not in self:
+            self[key] = value
+        return self[key]
+
+    def pop(self, *args):
+        # pop() restores the last push(), pop(key[, default]) is dict.pop
+        if not args:
+            return self.pop_history()
+        (key, default) = (args[0], args[1:])
+        if key not in self and default:
+            return default[0]
+        value = self[key]
+        del self[key]
+        return value
+
+    def clear(self):
+        with self._lock:
+            super(Context, self).clear()
+            self._references.clear()
+            self._dependents.clear()
+            self._resolved.clear()
+
+    def __getitem__(self, key):
+        # cached values are read without the lock, writers only ever drop them
+        try:
+            return self._resolved[key]
+        except KeyError:
+            with self._lock:
+                return self.resolve(key, ())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def resolve(self, key, stack):
+        if key in stack:
+            cycle = stack[stack.index(key):] + (key,)
+            raise ContextError("Cyclic context templates: %s" % str.join(" -> ", cycle))
+        value = super(Context, self).__getitem__(key)
+        refs = self._references.get(key)
+        if refs:
+            values = {}
+            for ref in refs:
+                if ref not in self:
+                    raise ContextError("Context key '%s' refers to missing key '%s'" % (key, ref))
+                values[ref] = self._resolved[ref] if ref in self._resolved else self.resolve(ref, stack + (key,))
+            try:
+                value = value % values
+            except (TypeError, ValueError) as err:
+                raise ContextError("Bad context template for '%s' (%r): %s" % (key, value, err))
+        self._resolved[key] = value
+        return value
+
+    def check(self):
+        # resolves every key, raising the first ContextError
+        for key in self.keys():
+            self[key]
+
+    def init(self, context=None, **kw):
+        context = context if context != None else {}
+        self.update(context)
+        self.update(kw)
+        if "_history_stack" not in self:
+            self._history_stack = []
+
+    def push(self):
+        ctxt = self.copy()
+        del ctxt["_history_stack"]
+        self["_history_stack"].append(ctxt)
+
+    def pop_history(self):
+        assert len(self._history_stack), "pop requested on empty history stack"
+        ctxt = self._history_stack.pop()
+        ctxt["_history_stack"] = self._history_stack
+        self.clear()
+        self.init(ctxt)
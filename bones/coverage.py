@@ -1,14 +1,278 @@
+import json
+import struct
+import collections
+import numpy
+from . consensus import StepperMask, span_counts
+from . samfile import handle_pool
 
-class CoverageMap(object):
-    def __init__(self):
-        pass
-    
-    def parse_coverage_file(self, coverage_fn):
-        f = open(coverage_fn)
-        last_coord = 0
-        for line in f:
-            line = line.strip()
-            (reference_name, coord, coverage) = line.split('\t')
-            last_coord = coord
+__all__ = ["CoverageMap", "CoverageTrack"]
 
+class CoverageTrack(object):
+    # per base depth of one reference, run-length encoded: run i covers
+    # [starts[i], starts[i + 1]) at depth values[i].  range queries go through
+    # prefix sums over the runs (and a sparse table for min/max), so they
+    # cost a couple of binary searches whatever the range.
+    BlockSize = 64
+    # per threshold prefix sums kept for fraction_at_least()
+    MaxThresholds = 8
 
+    def __init__(self, name, length, starts, values):
+        self.name = name
+        self.length = length
+        self.starts = starts
+        self.values = values
+        self._sums = None
+        self._tables = None
+        self._at_least = collections.OrderedDict()
+
+    @classmethod
+    def from_array(cls, name, depth):
+        depth = numpy.asarray(depth)
+        if not len(depth):
+            return cls(name, 0, numpy.zeros(0, dtype=numpy.uint32), numpy.zeros(0, dtype=numpy.uint32))
+        starts = numpy.concatenate(([0], numpy.flatnonzero(depth[1:] != depth[:-1]) + 1))
+        return cls(name, len(depth), starts.astype(numpy.uint32), depth[starts].astype(numpy.uint32))
+
+    @classmethod
+    def from_runs(cls, name, length, runs):
+        # joins (starts, values) pieces of consecutive windows
+        runs = list(runs)
+        if not runs:
+            return cls.from_array(name, numpy.zeros(length, dtype=numpy.uint32))
+        starts = numpy.concatenate([run[0] for run in runs]).astype(numpy.int64)
+        values = numpy.concatenate([run[1] for run in runs])
+        keep = numpy.concatenate(([True], values[1:] != values[:-1]))
+        return cls(name, length, starts[keep].astype(numpy.uint32), values[keep].astype(numpy.uint32))
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return "CoverageTrack(%r, %d bases, %d runs)" % (self.name, self.length, len(self.starts))
+
+    @property
+    def run_lengths(self):
+        ends = numpy.append(self.starts[1:].astype(numpy.int64), self.length)
+        return ends - self.starts
+
+    def to_array(self, start=None, end=None):
+        (start, end) = self.check_range(start, end)
+        depth = numpy.repeat(self.values, self.run_lengths)
+        return depth[start:end]
+
+    def check_range(self, start, end):
+        start = 0 if start == None else start
+        end = self.length if end == None else end
+        if not (0 <= start < end <= self.length):
+            raise ValueError("Invalid range [%s, %s) for %s of length %d" % (start, end, self.name, self.length))
+        return (start, end)
+
+    def run_of(self, pos):
+        # searching with a python int would convert the whole array
+        return int(numpy.searchsorted(self.starts, self.starts.dtype.type(pos), side="right")) - 1
+
+    def depth(self, pos):
+        (pos, _) = self.check_range(pos, pos + 1)
+        return int(self.values[self.run_of(pos)])
+
+    def _prefix(self, cumulative, weights, pos):
+        # sum of weights over [0, pos) given per-run cumulative sums
+        if pos == self.length:
+            return int(cumulative[-1])
+        run = self.run_of(pos)
+        return int(cumulative[run]) + int(weights[run]) * (pos - int(self.starts[run]))
+
+    def sums(self):
+        if self._sums is None:
+            self._sums = numpy.concatenate(([0], numpy.cumsum(self.values.astype(numpy.int64) * self.run_lengths)))
+        return self._sums
+
+    def sum(self, start=None, end=None):
+        (start, end) = self.check_range(start, end)
+        return self._prefix(self.sums(), self.values, end) - self._prefix(self.sums(), self.values, start)
+
+    def mean(self, start=None, end=None):
+        (start, end) = self.check_range(start, end)
+        return self.sum(start, end) / float(end - start)
+
+    def fraction_at_least(self, threshold, start=None, end=None):
+        # fraction of bases in [start, end) with depth >= threshold
+        (start, end) = self.check_range(start, end)
+        if threshold in self._at_least:
+            # most recently used last
+            self._at_least[threshold] = self._at_least.pop(threshold)
+        else:
+            hits = (self.values >= threshold).astype(numpy.int64)
+            self._at_least[threshold] = (numpy.concatenate(([0], numpy.cumsum(hits * self.run_lengths))), hits)
+            while len(self._at_least) > self.MaxThresholds:
+                self._at_least.popitem(last=False)
+        (cumulative, hits) = self._at_least[threshold]
+        return (self._prefix(cumulative, hits, end) - self._prefix(cumulative, hits, start)) / float(end - start)
+
+    def tables(self):
+        # sparse tables over blocks of BlockSize runs, level j holds the
+        # min/max of blocks [i, i + 2**j).  blocks keep the tables small when
+        # nearly every base is its own run.
+        if self._tables is None:
+            pad = -len(self.values) % self.BlockSize
+            blocks = numpy.append(self.values, self.values[-1:].repeat(pad)).reshape(-1, self.BlockSize)
+            (mins, maxs) = ([blocks.min(axis=1)], [blocks.max(axis=1)])
+            width = 1
+            while width * 2 <= len(mins[0]):
+                mins.append(numpy.minimum(mins[-1][:-width], mins[-1][width:]))
+                maxs.append(numpy.maximum(maxs[-1][:-width], maxs[-1][width:]))
+                width *= 2
+            self._tables = (mins, maxs)
+        return self._tables
+
+    def _range_query(self, tables, func, start, end):
+        (first, last) = (self.run_of(start), self.run_of(end - 1))
+        (first_block, last_block) = (first // self.BlockSize + 1, last // self.BlockSize)
+        if first_block >= last_block:
+            # within a block or two, look at the runs themselves
+            return int(func(self.values[first:last + 1]))
+        # partial blocks at either end, whole blocks from the table
+        level = (last_block - first_block).bit_length() - 1
+        table = tables[level]
+        left = func(self.values[first:first_block * self.BlockSize])
+        right = func(self.values[last_block * self.BlockSize:last + 1])
+        return int(func([table[first_block], table[last_block - (1 << level)], left, right]))
+
+    def min(self, start=None, end=None):
+        (start, end) = self.check_range(start, end)
+        return self._range_query(self.tables()[0], numpy.min, start, end)
+
+    def max(self, start=None, end=None):
+        (start, end) = self.check_range(start, end)
+        return self._range_query(self.tables()[1], numpy.max, start, end)
+
+class CoverageMap(collections.OrderedDict):
+    # CoverageTracks by reference name.  saved as one binary file: a magic
+    # and header size, a JSON header listing each reference's runs, then the
+    # run starts and values as uint32 arrays that load() maps in place.
+    Magic = "BCOV"
+    Version = 1
+    HeaderFormat = "<4sII"
+    WindowSize = 1 << 20
+
+    def add_track(self, track):
+        self[track.name] = track
+        return track
+
+    @classmethod
+    def from_depths(cls, depths):
+        # {name: per base depth array}
+        cmap = cls()
+        for (name, depth) in depths.items():
+            cmap.add_track(CoverageTrack.from_array(name, depth))
+        return cmap
+
+    @classmethod
+    def from_samfile(cls, samf, min_mapping_quality=0):
+        # depth as samtools depth counts it: aligned bases of reads that are
+        # mapped, primary, not qcfail and not duplicates
+        if isinstance(samf, basestring):
+            samf = handle_pool.get(samf)
+        cmap = cls()
+        for (name, length) in zip(samf.references, samf.lengths):
+            runs = []
+            for start in xrange(0, length, cls.WindowSize):
+                end = min(start + cls.WindowSize, length)
+                blocks = ([], [])
+                for read in samf.fetch(name, start, end):
+                    if read.flag & StepperMask or read.mapping_quality < min_mapping_quality:
+                        continue
+                    for (block_start, block_end) in read.get_blocks():
+                        blocks[0].append(block_start)
+                        blocks[1].append(block_end)
+                track = CoverageTrack.from_array(name, span_counts(blocks[0], blocks[1], start, end))
+                runs.append((track.starts.astype(numpy.int64) + start, track.values))
+            cmap.add_track(CoverageTrack.from_runs(name, length, runs))
+        return cmap
+
+    @classmethod
+    def from_depth_file(cls, coverage_fn, lengths=None):
+        cmap = cls()
+        cmap.parse_coverage_file(coverage_fn, lengths)
+        return cmap
+
+    def parse_coverage_file(self, coverage_fn, lengths=None):
+        # samtools depth output: reference, 1-based position and depth per
+        # line.  positions left out are zero.  references end at their last
+        # line unless lengths gives {name: length}.
+        lengths = lengths if lengths != None else {}
+        depths = collections.OrderedDict()
+        with open(coverage_fn) as fh:
+            while True:
+                lines = fh.readlines(1 << 24)
+                if not lines:
+                    break
+                fields = str.join('', lines).split()
+                if len(fields) % 3:
+                    raise ValueError("%s: expected reference, position and depth on every line" % coverage_fn)
+                names = fields[0::3]
+                positions = numpy.fromstring(str.join(' ', fields[1::3]), dtype=numpy.int64, sep=' ') - 1
+                values = numpy.fromstring(str.join(' ', fields[2::3]), dtype=numpy.int64, sep=' ')
+                # lines come grouped by reference
+                bounds = [0] + [idx for idx in xrange(1, len(names)) if names[idx] != names[idx - 1]] + [len(names)]
+                for (lo, hi) in zip(bounds[:-1], bounds[1:]):
+                    depths.setdefault(names[lo], []).append((positions[lo:hi], values[lo:hi]))
+        for (name, pieces) in depths.items():
+            positions = numpy.concatenate([piece[0] for piece in pieces])
+            values = numpy.concatenate([piece[1] for piece in pieces])
+            depth = numpy.zeros(lengths.get(name, positions.max() + 1), dtype=numpy.uint32)
+            depth[positions] = values
+            self.add_track(CoverageTrack.from_array(name, depth))
+        for (name, length) in lengths.items():
+            if name not in self:
+                self.add_track(CoverageTrack.from_array(name, numpy.zeros(length, dtype=numpy.uint32)))
+
+    def save(self, fn):
+        header = {"version": self.Version, "references": []}
+        offset = 0
+        for track in self.values():
+            header["references"].append({"name": track.name, "length": track.length, "runs": len(track.starts), "offset": offset})
+            offset += len(track.starts) * 8
+        header = json.dumps(header)
+        # pad so the arrays start on an 8 byte boundary
+        header += ' ' * (-(struct.calcsize(self.HeaderFormat) + len(header)) % 8)
+        with open(fn, 'wb') as fh:
+            fh.write(struct.pack(self.HeaderFormat, self.Magic, self.Version, len(header)))
+            fh.write(header)
+            for track in self.values():
+                track.starts.astype("<u4").tofile(fh)
+                track.values.astype("<u4").tofile(fh)
+
+    @classmethod
+    def load(cls, fn):
+        with open(fn, 'rb') as fh:
+            (magic, version, header_size) = struct.unpack(cls.HeaderFormat, fh.read(struct.calcsize(cls.HeaderFormat)))
+            if magic != cls.Magic:
+                raise ValueError("%s is not a coverage map" % fn)
+            if version != cls.Version:
+                raise ValueError("%s: unsupported coverage map version %d" % (fn, version))
+            header = json.loads(fh.read(header_size))
+        base = struct.calcsize(cls.HeaderFormat) + header_size
+        cmap = cls()
+        data = numpy.memmap(fn, dtype="<u4", mode='r', offset=base) if any([ref["runs"] for ref in header["references"]]) else None
+        for ref in header["references"]:
+            first = ref["offset"] // 4
+            runs = ref["runs"]
+            if runs:
+                (starts, values) = (data[first:first + runs], data[first + runs:first + 2 * runs])
+            else:
+                starts = values = numpy.zeros(0, dtype=numpy.uint32)
+            cmap.add_track(CoverageTrack(str(ref["name"]), ref["length"], starts, values))
+        return cmap
+
+    def mean(self, name, start=None, end=None):
+        return self[name].mean(start, end)
+
+    def min(self, name, start=None, end=None):
+        return self[name].min(start, end)
+
+    def max(self, name, start=None, end=None):
+        return self[name].max(start, end)
+
+    def fraction_at_least(self, name, threshold, start=None, end=None):
+        return self[name].fraction_at_least(threshold, start, end)
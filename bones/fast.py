@@ -1,10 +1,36 @@
 # XXX: move to io module
+import os
+import io
 import re
 import json
+import mmap
+import gzip
+import itertools
+import collections
+import numpy
+import pysam
 from . sequence import Sequence
+from . utils import is_stale
 from cStringIO import StringIO
 
-__all__ = ["FastSequenceList", "FastA"]
+__all__ = ["FastSequenceList", "FastA", "FastAWriter", "FastAIndex", "IndexedFastA", "FastQ", "FastQRecord", "FastQWriter"]
+
+GzipMagic = "\x1f\x8b"
+
+def open_fast(fn, mode='r'):
+    # .bgz is written as BGZF so samtools and tabix can seek into it.  it
+    # is a series of gzip members, so gzip reads both.
+    if 'w' in mode or 'a' in mode:
+        if fn.endswith(".bgz"):
+            return pysam.BGZFile(fn, mode.replace('b', '') + 'b')
+        if fn.endswith(".gz"):
+            return gzip.open(fn, mode.replace('b', '') + 'b')
+        return open(fn, mode)
+    with open(fn, 'rb') as fh:
+        magic = fh.read(2)
+    if magic == GzipMagic:
+        return io.BufferedReader(gzip.open(fn, 'rb'))
+    return open(fn, mode)
 
 class ParseError(Exception):
     pass
@@ -15,45 +41,72 @@ class FastSequenceList(list):
 class FastA(FastSequenceList):
     re_infoname = re.compile("^>\s*(?P<name>[^{]*?)\s*(?P<info>{.+})\s*$")
 
-    def _iter_load(self, iterable):
-        seq = ''
-        kw = None
+    @classmethod
+    def parse_header(cls, line, name=None):
+        # name, when given, wins over the one in the header
+        m = cls.re_infoname.match(line)
+        if not m:
+            return {"name": name if name != None else line[1:].strip()}
+        infoname = m.groupdict()
+        kw = json.loads(infoname["info"])
+        if name != None:
+            kw["name"] = name
+        elif "name" not in kw:
+            kw["name"] = infoname.get("name", "").strip()
+        return kw
+
+    @classmethod
+    def build_sequence(cls, header, lines, name=None):
+        seq = Sequence(str.join('', lines))
+        if '{' in header:
+            # defer the JSON parse until someone asks for .info
+            seq._info_loader = lambda: cls.parse_header(header, name)
+        else:
+            seq.name = name if name != None else header[1:].strip()
+        return seq
+
+    @classmethod
+    def stream(cls, iterable):
+        header = None
+        lines = []
         for line in iterable:
             if line[0] == '>':
-                if seq != '':
-                    _seq = Sequence(seq, **kw)
-                    self.append(_seq)
-                    seq = ''
-                    kw = None
-                m = self.re_infoname.match(line)
-                if m:
-                    infoname = m.groupdict()
-                    kw = json.loads(infoname["info"])
-                    if "name" not in kw:
-                        kw["name"] = infoname.get("name", "").strip()
-                else:
-                    kw = {"name": line[1:].strip()}
+                if lines:
+                    yield cls.build_sequence(header, lines)
+                    lines = []
+                header = line
             else:
-                if kw == None:
+                if header == None:
                     raise ParseError("Sequence specified without name")
-                seq += line.strip()
+                line = line.strip()
+                if line:
+                    lines.append(line)
         # check for left over sequence
-        if seq != '':
-            _seq = Sequence(seq, **kw)
-            self.append(_seq)
+        if lines:
+            yield cls.build_sequence(header, lines)
+
+    @classmethod
+    def iter(cls, fafn):
+        with open(fafn) as fafh:
+            for seq in cls.stream(fafh):
+                yield seq
+
+    def _iter_load(self, iterable):
+        self.extend(self.stream(iterable))
+
+    @classmethod
+    def format_header(cls, name, info=None, strict=False):
+        if info != None and not strict:
+            return ">%s %s\n" % (name, json.dumps(info))
+        return ">%s\n" % name
 
     def to_string(self, strict=False):
         for seq in self:
-            name = getattr(seq, "name", "")
-            info = getattr(seq, "info", None)
-            if info != None and not strict:
-                yield ">%s %s\n" % (name, json.dumps(info))
-            else:
-                yield ">%s\n" % name
+            yield self.format_header(getattr(seq, "name", ""), getattr(seq, "info", None), strict)
             yield "%s\n" % seq
 
     def from_string(self, fastr):
-        buf = cStringIO(fastr)
+        buf = StringIO(fastr)
         self._iter_load(buf)
 
     @classmethod
@@ -67,3 +120,313 @@ class FastA(FastSequenceList):
         with open(fafn, 'w') as fa:
             for line in self.to_string(strict=strict):
                 fa.write(line)
+
+class FastAWriter(object):
+    # writes records as they come, either whole with write() or in pieces
+    # with begin(), write_bases() and end() so a long sequence never has to
+    # be held in memory.  width wraps sequence lines, None writes one line.
+    def __init__(self, fafn, mode='w', strict=False, width=None):
+        self.fafn = fafn
+        self.strict = strict
+        self.width = width
+        self._fh = open_fast(fafn, mode)
+        self._column = None
+
+    def begin(self, name, info=None):
+        if self._column != None:
+            self.end()
+        self._fh.write(FastA.format_header(name, info, self.strict))
+        self._column = 0
+
+    def write_bases(self, bases):
+        assert self._column != None, "write_bases() outside of begin() and end()"
+        bases = str(bases)
+        if not self.width:
+            self._fh.write(bases)
+            self._column += len(bases)
+            return
+        pos = 0
+        while pos < len(bases):
+            if self._column == self.width:
+                self._fh.write('\n')
+                self._column = 0
+            chunk = bases[pos:pos + self.width - self._column]
+            self._fh.write(chunk)
+            self._column += len(chunk)
+            pos += len(chunk)
+
+    def end(self):
+        if self._column != None:
+            self._fh.write('\n')
+            self._column = None
+
+    def write(self, seq):
+        self.begin(getattr(seq, "name", ""), getattr(seq, "info", None))
+        self.write_bases(seq)
+        self.end()
+
+    def flush(self):
+        self._fh.flush()
+
+    def close(self):
+        self.end()
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+FastAIndexEntry = collections.namedtuple("FastAIndexEntry", ["name", "length", "offset", "linebases", "linewidth"])
+
+class FastAIndex(collections.OrderedDict):
+    # samtools faidx compatible, see http://www.htslib.org/doc/faidx.html.
+    # header_offsets holds where each record's header line starts, it isn't
+    # part of the .fai so an index loaded from one has none.
+
+    def __init__(self, *args, **kw):
+        super(FastAIndex, self).__init__(*args, **kw)
+        self.header_offsets = {}
+
+    @classmethod
+    def build(cls, fafn):
+        index = cls()
+        with open(fafn, 'rb') as fafh:
+            for (entry, header_offset) in cls._scan(fafh):
+                if entry.name in index:
+                    raise ParseError("Duplicate sequence name '%s' in %s" % (entry.name, fafn))
+                index[entry.name] = entry
+                index.header_offsets[entry.name] = header_offset
+        return index
+
+    @classmethod
+    def _scan(cls, fafh):
+        name = None
+        pos = 0
+        for line in fafh:
+            if line[0] == '>':
+                if name != None:
+                    yield (FastAIndexEntry(name, length, offset, linebases, linewidth), header_offset)
+                tokens = line[1:].split()
+                name = tokens[0] if tokens else ''
+                header_offset = pos
+                pos += len(line)
+                (length, offset, linebases, linewidth) = (0, pos, 0, 0)
+                short_line = False
+                continue
+            if name == None:
+                raise ParseError("Sequence specified without name")
+            pos += len(line)
+            bases = len(line.rstrip("\r\n"))
+            if bases == 0:
+                short_line = True
+                continue
+            if short_line:
+                raise ParseError("Inconsistent line length in sequence '%s'" % name)
+            if linebases == 0:
+                (linebases, linewidth) = (bases, len(line))
+            elif bases > linebases or (bases == linebases and len(line) != linewidth and line.endswith('\n')):
+                # the last line of the file may be missing its newline
+                raise ParseError("Inconsistent line length in sequence '%s'" % name)
+            short_line = bases < linebases
+            length += bases
+        if name != None:
+            yield (FastAIndexEntry(name, length, offset, linebases, linewidth), header_offset)
+
+    @classmethod
+    def load(cls, faifn):
+        index = cls()
+        with open(faifn) as faifh:
+            for line in faifh:
+                (name, length, offset, linebases, linewidth) = line.rstrip("\r\n").split('\t')[:5]
+                index[name] = FastAIndexEntry(name, int(length), int(offset), int(linebases), int(linewidth))
+        return index
+
+    def save(self, faifn):
+        with open(faifn, 'w') as faifh:
+            for entry in self.values():
+                faifh.write("%s\t%d\t%d\t%d\t%d\n" % entry)
+
+class IndexedFastA(object):
+    # records by their index name, the first word of the header as samtools
+    # has it, which is also the name of the sequences fetched
+    def __init__(self, fafn, faifn=None):
+        self.fafn = fafn
+        self.faifn = faifn if faifn != None else fafn + ".fai"
+        self.index = self.load_index()
+        self._fh = open(self.fafn, 'rb')
+        if os.fstat(self._fh.fileno()).st_size:
+            self._map = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = ''
+
+    def load_index(self):
+        if os.path.exists(self.faifn) and not is_stale(self.fafn, self.faifn):
+            return FastAIndex.load(self.faifn)
+        index = FastAIndex.build(self.fafn)
+        try:
+            index.save(self.faifn)
+        except IOError:
+            # read-only location, keep the index in memory
+            pass
+        return index
+
+    def close(self):
+        if self._map:
+            self._map.close()
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def names(self):
+        return list(self.index.keys())
+
+    def length(self, name):
+        return self.index[name].length
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        # as FastA.iter(), records without bases are left out
+        return (self.fetch(name) for (name, entry) in self.index.items() if entry.length)
+
+    def __getitem__(self, name):
+        return self.fetch(name)
+
+    def _byte_offset(self, entry, pos):
+        (row, col) = divmod(pos, entry.linebases)
+        return entry.offset + row * entry.linewidth + col
+
+    def header(self, name):
+        entry = self.index[name]
+        if name not in self.index.header_offsets:
+            # from a .fai, the header is the single line before the bases
+            self.index.header_offsets[name] = self._map.rfind('\n', 0, entry.offset - 1) + 1
+        return self._map[self.index.header_offsets[name]:entry.offset]
+
+    def fetch(self, name, start=None, end=None):
+        entry = self.index[name]
+        start = 0 if start == None else max(0, min(start, entry.length))
+        end = entry.length if end == None else max(start, min(end, entry.length))
+        seq = ''
+        if end > start:
+            raw = self._map[self._byte_offset(entry, start):self._byte_offset(entry, end)]
+            seq = raw.replace('\n', '').replace('\r', '')
+        return FastA.build_sequence(self.header(name), [seq], name)
+
+class FastQRecord(object):
+    __slots__ = ("name", "sequence", "quality")
+    QualityOffset = 33
+
+    def __init__(self, name, sequence, quality):
+        self.name = name
+        self.sequence = sequence
+        self.quality = quality
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __eq__(self, other):
+        if not isinstance(other, FastQRecord):
+            return NotImplemented
+        return (self.name, self.sequence, self.quality) == (other.name, other.sequence, other.quality)
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __repr__(self):
+        return "FastQRecord(%r, %r, %r)" % (self.name, self.sequence, self.quality)
+
+    @property
+    def qualities(self):
+        # read-only view over the quality string, no copy
+        return numpy.frombuffer(self.quality, dtype=numpy.uint8)
+
+    @property
+    def phred(self):
+        return self.qualities - numpy.uint8(self.QualityOffset)
+
+    def to_sequence(self):
+        return Sequence(self.sequence, name=self.name)
+
+    def to_string(self):
+        return "@%s\n%s\n+\n%s\n" % (self.name, self.sequence, self.quality)
+
+class FastQ(FastSequenceList):
+    DefaultBatchSize = 10000
+
+    @classmethod
+    def stream(cls, iterable):
+        lines = iter(iterable)
+        for (header, seq, plus, qual) in itertools.izip_longest(lines, lines, lines, lines):
+            if qual == None:
+                if seq == None and not header.strip():
+                    break
+                raise ParseError("Truncated record at end of input")
+            if header[0] != '@' or plus[0] != '+':
+                raise ParseError("Malformed record '%s'" % header.strip())
+            seq = seq.rstrip("\r\n")
+            qual = qual.rstrip("\r\n")
+            if len(seq) != len(qual):
+                raise ParseError("Sequence and quality length differ in '%s'" % header.strip())
+            yield FastQRecord(header[1:].rstrip("\r\n"), seq, qual)
+
+    @classmethod
+    def iter(cls, fqfn):
+        with open_fast(fqfn) as fqfh:
+            for record in cls.stream(fqfh):
+                yield record
+
+    @classmethod
+    def iter_batches(cls, fqfn, batch_size=None):
+        batch_size = batch_size if batch_size != None else cls.DefaultBatchSize
+        records = cls.iter(fqfn)
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+            yield batch
+
+    @classmethod
+    def load(cls, fqfn):
+        fq = cls()
+        fq.extend(cls.iter(fqfn))
+        return fq
+
+    def to_string(self):
+        for record in self:
+            yield record.to_string()
+
+    def save(self, fqfn):
+        with FastQWriter(fqfn) as writer:
+            writer.write_batch(self)
+
+class FastQWriter(object):
+    def __init__(self, fqfn, mode='w'):
+        self.fqfn = fqfn
+        self._fh = open_fast(fqfn, mode)
+
+    def write(self, record):
+        self._fh.write(record.to_string())
+
+    def write_batch(self, records):
+        self._fh.write(str.join('', [record.to_string() for record in records]))
+
+    def close(self):
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import errno
+import cProfile
+import resource
+import threading
+
+__all__ = ["StageRecorder", "InstrumentedStage", "wait_child", "io_counters", "read_report", "format_report"]
+
+def io_counters():
+    # bytes this process and the children it has reaped read and wrote.
+    # rchar/wchar count everything through read()/write(), read_bytes and
+    # write_bytes what hit storage.  without /proc only the block counts
+    # from getrusage are known.
+    try:
+        with open("/proc/self/io") as fh:
+            fields = dict([line.split(":") for line in fh if ":" in line])
+        return dict([(key, int(fields[key])) for key in ("rchar", "wchar", "read_bytes", "write_bytes")])
+    except (IOError, KeyError, ValueError):
+        (usage, children) = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+        return {"read_bytes": (usage.ru_inblock + children.ru_inblock) * 512, "write_bytes": (usage.ru_oublock + children.ru_oublock) * 512}
+
+def wait_child(pid):
+    # waitpid() that also returns the child's rusage, which is recorded
+    # against the stage running on this thread.  (status, rusage)
+    while True:
+        try:
+            (_, status, rusage) = os.wait4(pid, 0)
+            break
+        except OSError as err:
+            if err.errno != errno.EINTR:
+                raise
+    recorder = StageRecorder.current()
+    if recorder != None:
+        recorder.children.append(rusage)
+    return (status, rusage)
+
+class StageRecorder(object):
+    # measures one run of a stage, as a context manager: wall time, cpu
+    # time and peak rss of this process and of its children, and bytes
+    # read and written.  the process wide counters can't tell concurrent
+    # stages apart, records of stages that overlapped others are marked.
+    # children reaped through wait_child() are counted exactly either way.
+    _local = threading.local()
+    _lock = threading.Lock()
+    _running = set()
+
+    def __init__(self, name, profile_fn=None):
+        self.name = name
+        self.profile_fn = profile_fn
+        self.children = []
+        self.record = None
+
+    @classmethod
+    def current(cls):
+        return getattr(cls._local, "recorder", None)
+
+    def __enter__(self):
+        with self._lock:
+            self.overlapped = bool(self._running)
+            for other in self._running:
+                other.overlapped = True
+            self._running.add(self)
+        self.parent = self.current()
+        self._local.recorder = self
+        self.start = time.time()
+        self.usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.io = io_counters()
+        self.profiler = None
+        if self.profile_fn != None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profiler != None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_fn)
+        (usage, children_usage) = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+        io = io_counters()
+        self._local.recorder = self.parent
+        with self._lock:
+            self._running.discard(self)
+        self.record = {
+            "stage": self.name,
+            "start": self.start,
+            "wall_seconds": time.time() - self.start,
+            "user_seconds": usage.ru_utime - self.usage.ru_utime,
+            "system_seconds": usage.ru_stime - self.usage.ru_stime,
+            # ru_maxrss is in kilobytes on linux, the peak so far
+            "max_rss_kb": usage.ru_maxrss,
+            "children": len(self.children),
+            "overlapped": self.overlapped,
+            "status": "ok" if exc_type == None else "error",
+        }
+        if self.overlapped:
+            # only what was waited on here can be told apart
+            self.record["children_user_seconds"] = sum([rusage.ru_utime for rusage in self.children])
+            self.record["children_system_seconds"] = sum([rusage.ru_stime for rusage in self.children])
+        else:
+            self.record["children_user_seconds"] = children_usage.ru_utime - self.children_usage.ru_utime
+            self.record["children_system_seconds"] = children_usage.ru_stime - self.children_usage.ru_stime
+        if self.children:
+            self.record["children_max_rss_kb"] = max([rusage.ru_maxrss for rusage in self.children])
+        elif children_usage.ru_maxrss > self.children_usage.ru_maxrss:
+            self.record["children_max_rss_kb"] = children_usage.ru_maxrss
+        else:
+            self.record["children_max_rss_kb"] = None
+        for (key, value) in io.items():
+            self.record[key] = value - self.io.get(key, 0)
+        if self.profile_fn != None:
+            self.record["profile"] = self.profile_fn
+        return False
+
+class InstrumentedStage(object):
+    # mixin for pipeline stages and tasks: recorded_run() appends a
+    # StageRecorder record to ReportName in dir_reports (or reports/ under
+    # dir_output) for every run.  with profile set in the context, True or a
+    # list of stage names, the python side of the run is also profiled into
+    # <stage>.prof next to the report, see pstats.
+    ReportName = "stages.jsonl"
+    _report_lock = threading.Lock()
+
+    def stage_name(self):
+        return getattr(self, "Name", None) or getattr(self, "TaskName", None) or type(self).__name__
+
+    def report_dir(self):
+        context = self.context if self.context != None else {}
+        if context.get("dir_reports"):
+            return context["dir_reports"]
+        if context.get("dir_output"):
+            return os.path.join(context["dir_output"], "reports")
+        return None
+
+    def profile_fn(self, report_dir):
+        profile = self.context.get("profile") if self.context != None else None
+        if report_dir == None or not profile:
+            return None
+        if profile is not True and self.stage_name() not in profile:
+            return None
+        return os.path.join(report_dir, "%s.prof" % self.stage_name())
+
+    def recorded_run(self, func, *args, **kw):
+        report_dir = self.report_dir()
+        if report_dir != None and not os.path.isdir(report_dir):
+            try:
+                os.makedirs(report_dir)
+            except OSError:
+                if not os.path.isdir(report_dir):
+                    raise
+        recorder = StageRecorder(self.stage_name(), self.profile_fn(report_dir))
+        try:
+            with recorder:
+                return func(*args, **kw)
+        finally:
+            self.__dict__["run_record"] = recorder.record
+            if report_dir != None:
+                self.write_record(os.path.join(report_dir, self.ReportName), recorder.record)
+
+    def write_record(self, fn, record):
+        if self.context != None and self.context.get("runid"):
+            record["runid"] = self.context["runid"]
+        with self._report_lock:
+            with open(fn, 'a') as fh:
+                fh.write(json.dumps(record, sort_keys=True) + '\n')
+
+def read_report(fn):
+    with open(fn) as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+def format_report(records):
+    # a table of the records, longest running first
+    lines = ["%-24s %10s %10s %10s %12s %12s %12s" % ("stage", "wall s", "cpu s", "child s", "max rss kb", "read MB", "written MB")]
+    for record in sorted(records, key=lambda record: -record["wall_seconds"]):
+        lines.append("%-24s %10.2f %10.2f %10.2f %12s %12.1f %12.1f%s" % (
+            record["stage"], record["wall_seconds"],
+            record["user_seconds"] + record["system_seconds"],
+            record["children_user_seconds"] + record["children_system_seconds"],
+            max(record["max_rss_kb"], record.get("children_max_rss_kb") or 0),
+            record.get("rchar", record.get("read_bytes", 0)) / 1e6,
+            record.get("wchar", record.get("write_bytes", 0)) / 1e6,
+            " *" if record["overlapped"] else ""))
+    return str.join('\n', lines)
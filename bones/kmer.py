@@ -0,0 +1,453 @@
+import os
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+import numpy
+from . sequence import PackedSequence, BaseCodes, ComplimentTable, EncodeTable, NoCode, encode_windows
+from . fast import FastA, FastQ, IndexedFastA
+from . utils import is_stale
+
+__all__ = ["KmerCounter", "ReferenceIndex", "count_kmers", "merge_counts", "sequence_kmers", "batch_kmers", "sequence_minimizers", "encode_kmer", "canonical_kmer", "decode_kmer"]
+
+MaxK = 31
+# largest k counted with a dense 4**k table
+DenseMaxK = 11
+
+def encode_kmer(kmer):
+    value = 0
+    for base in kmer.upper():
+        value = (value << 2) | BaseCodes.index(base)
+    return value
+
+def canonical_kmer(kmer):
+    return min(encode_kmer(kmer), encode_kmer(kmer[::-1].translate(ComplimentTable)))
+
+def decode_kmer(value, k):
+    value = int(value)
+    bases = []
+    for idx in xrange(k):
+        bases.append(BaseCodes[value & 0x3])
+        value >>= 2
+    return str.join('', reversed(bases))
+
+def sequence_kmers(seq, k, canonical=True):
+    if not isinstance(seq, PackedSequence):
+        # FastQRecord keeps its bases in .sequence
+        seq = PackedSequence.from_sequence(str(getattr(seq, "sequence", seq)))
+    return seq.kmers(k, canonical=canonical)
+
+def batch_kmers(sequences, k, canonical=True):
+    # the k-mers of many records at once.  the records are joined with an N
+    # between them, so the k-mers that would cross from one record into the
+    # next are dropped along with those over ambiguous bases.
+    raw = numpy.frombuffer(str.join('N', sequences), dtype=numpy.uint8)
+    count = len(raw) - k + 1
+    if count <= 0:
+        return numpy.zeros(0, dtype=numpy.uint64)
+    codes = EncodeTable[raw]
+    ambiguous = codes == NoCode
+    codes[ambiguous] = 0
+    kmers = encode_windows(codes, k)
+    if canonical:
+        kmers = numpy.minimum(kmers, encode_windows(3 - codes[::-1], k)[::-1])
+    blocked = numpy.concatenate(([0], numpy.cumsum(ambiguous, dtype=numpy.int64)))
+    return kmers[(blocked[k:] - blocked[:count]) == 0]
+
+def merge_counts(kmers, counts):
+    # collapse duplicate k-mers, returns sorted unique k-mers and summed counts
+    if not len(kmers):
+        return (numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=numpy.uint64))
+    order = numpy.argsort(kmers, kind="mergesort")
+    kmers = kmers[order]
+    counts = counts[order]
+    starts = numpy.concatenate(([0], numpy.flatnonzero(kmers[1:] != kmers[:-1]) + 1))
+    return (kmers[starts], numpy.add.reduceat(counts, starts).astype(numpy.uint64))
+
+def merge_sorted(kmers, counts, other_kmers, other_counts):
+    # both sides sorted and unique, so this is a merge rather than a sort
+    if not len(kmers):
+        return (other_kmers, other_counts)
+    positions = numpy.searchsorted(kmers, other_kmers)
+    found = positions < len(kmers)
+    found[found] = kmers[positions[found]] == other_kmers[found]
+    counts = counts.copy()
+    counts[positions[found]] += other_counts[found]
+    missing = ~found
+    (other_kmers, other_counts) = (other_kmers[missing], other_counts[missing])
+    # final slot of every element is its own index plus the number of
+    # elements from the other side that sort before it
+    slots = numpy.searchsorted(other_kmers, kmers) + numpy.arange(len(kmers))
+    other_slots = positions[missing] + numpy.arange(len(other_kmers))
+    merged_kmers = numpy.empty(len(kmers) + len(other_kmers), dtype=numpy.uint64)
+    merged_counts = numpy.empty(len(merged_kmers), dtype=numpy.uint64)
+    (merged_kmers[slots], merged_counts[slots]) = (kmers, counts)
+    (merged_kmers[other_slots], merged_counts[other_slots]) = (other_kmers, other_counts)
+    return (merged_kmers, merged_counts)
+
+def count_array(kmers):
+    if not len(kmers):
+        return (numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=numpy.uint64))
+    kmers = numpy.sort(kmers)
+    starts = numpy.concatenate(([0], numpy.flatnonzero(kmers[1:] != kmers[:-1]) + 1))
+    counts = numpy.diff(numpy.concatenate((starts, [len(kmers)])))
+    return (kmers[starts], counts.astype(numpy.uint64))
+
+class KmerCounter(object):
+    # mode "dense" keeps a 4**k table, "sorted" keeps sorted unique k-mers and
+    # their counts.  with max_kmers set, the sorted table is spilled to
+    # range-partitioned files on disk whenever it grows past that size.
+    DefaultChunkSize = 1 << 22
+    SpillPartitions = 64
+    # bases encoded together by add_sequences()
+    BatchBases = 1 << 20
+
+    def __init__(self, k, canonical=True, mode="auto", max_kmers=None, tempdir=None, chunk_size=None):
+        if not (0 < k <= MaxK):
+            raise ValueError("k must be between 1 and %d, not %s" % (MaxK, k))
+        if mode == "auto":
+            mode = "dense" if k <= DenseMaxK else "sorted"
+        if mode not in ("dense", "sorted"):
+            raise ValueError("mode must be 'auto', 'dense' or 'sorted', not %r" % mode)
+        self.k = k
+        self.canonical = canonical
+        self.mode = mode
+        self.max_kmers = max_kmers
+        self.tempdir = tempdir
+        self.chunk_size = chunk_size if chunk_size != None else self.DefaultChunkSize
+        self.spill_dir = None
+        # whether the partitions on disk are each sorted and unique
+        self._spill_merged = True
+        self._pending = []
+        self._pending_size = 0
+        self._dense = numpy.zeros(4 ** k, dtype=numpy.uint64) if mode == "dense" else None
+        self._kmers = numpy.zeros(0, dtype=numpy.uint64)
+        self._counts = numpy.zeros(0, dtype=numpy.uint64)
+
+    def add(self, seq):
+        self.add_kmers(sequence_kmers(seq, self.k, self.canonical))
+
+    def add_sequences(self, sequences):
+        # records are encoded BatchBases at a time, see batch_kmers()
+        (batch, size) = ([], 0)
+        for seq in sequences:
+            if isinstance(seq, PackedSequence):
+                self.add(seq)
+                continue
+            seq = str(getattr(seq, "sequence", seq))
+            batch.append(seq)
+            size += len(seq) + 1
+            if size >= self.BatchBases:
+                self.add_kmers(batch_kmers(batch, self.k, self.canonical))
+                (batch, size) = ([], 0)
+        if batch:
+            self.add_kmers(batch_kmers(batch, self.k, self.canonical))
+
+    def add_fasta(self, fafn):
+        self.add_sequences(FastA.iter(fafn))
+
+    def add_fastq(self, fqfn):
+        self.add_sequences(FastQ.iter(fqfn))
+
+    def add_kmers(self, kmers):
+        self._pending.append(kmers)
+        self._pending_size += len(kmers)
+        if self._pending_size >= self.chunk_size:
+            self.flush()
+
+    def add_counts(self, kmers, counts):
+        if self.mode == "dense":
+            self._dense[kmers.astype(numpy.intp)] += counts.astype(numpy.uint64)
+            return
+        self._merge(kmers, counts)
+
+    def flush(self):
+        if not self._pending:
+            return
+        kmers = numpy.concatenate(self._pending)
+        self._pending = []
+        self._pending_size = 0
+        if self.mode == "dense":
+            self._dense += numpy.bincount(kmers.astype(numpy.intp), minlength=len(self._dense)).astype(numpy.uint64)
+            return
+        self._merge(*count_array(kmers))
+
+    def _merge(self, kmers, counts):
+        (self._kmers, self._counts) = merge_sorted(self._kmers, self._counts, kmers, counts)
+        if self.max_kmers != None and len(self._kmers) > self.max_kmers:
+            self.spill()
+
+    def partition_of(self, kmers):
+        # the top six bits, so partitions are ordered k-mer ranges
+        return (kmers >> numpy.uint64(max(0, 2 * self.k - 6))).astype(numpy.intp)
+
+    def spill_fn(self, partition, ext):
+        return os.path.join(self.spill_dir, "partition_%03d.%s" % (partition, ext))
+
+    def spill(self):
+        if self.spill_dir == None:
+            self.spill_dir = tempfile.mkdtemp(prefix="kmer_", dir=self.tempdir)
+        partitions = self.partition_of(self._kmers)
+        # _kmers is sorted, so each partition is a contiguous run
+        bounds = numpy.searchsorted(partitions, numpy.arange(self.SpillPartitions + 1))
+        for partition in xrange(self.SpillPartitions):
+            (start, end) = bounds[partition:partition + 2]
+            if start == end:
+                continue
+            with open(self.spill_fn(partition, "kmers"), 'ab') as fh:
+                self._kmers[start:end].tofile(fh)
+            with open(self.spill_fn(partition, "counts"), 'ab') as fh:
+                self._counts[start:end].tofile(fh)
+        if len(self._kmers):
+            self._spill_merged = False
+        self._kmers = numpy.zeros(0, dtype=numpy.uint64)
+        self._counts = numpy.zeros(0, dtype=numpy.uint64)
+
+    def iter_counts(self):
+        # yields (kmers, counts) blocks in ascending k-mer order
+        self.flush()
+        if self.mode == "dense":
+            kmers = numpy.flatnonzero(self._dense)
+            yield (kmers.astype(numpy.uint64), self._dense[kmers])
+            return
+        if self.spill_dir == None:
+            yield (self._kmers, self._counts)
+            return
+        self.merge_spilled()
+        for partition in xrange(self.SpillPartitions):
+            if os.path.exists(self.spill_fn(partition, "kmers")):
+                yield self.read_partition(partition)
+
+    def read_partition(self, partition):
+        kmers = numpy.fromfile(self.spill_fn(partition, "kmers"), dtype=numpy.uint64)
+        counts = numpy.fromfile(self.spill_fn(partition, "counts"), dtype=numpy.uint64)
+        return (kmers, counts)
+
+    def merge_spilled(self):
+        # spills what is in memory and rewrites each partition sorted and
+        # unique, only when something was spilled since the last time
+        self.spill()
+        if self._spill_merged:
+            return
+        for partition in xrange(self.SpillPartitions):
+            if not os.path.exists(self.spill_fn(partition, "kmers")):
+                continue
+            (kmers, counts) = merge_counts(*self.read_partition(partition))
+            kmers.tofile(self.spill_fn(partition, "kmers"))
+            counts.tofile(self.spill_fn(partition, "counts"))
+        self._spill_merged = True
+
+    def counts(self):
+        blocks = list(self.iter_counts())
+        if not blocks:
+            return (numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=numpy.uint64))
+        return (numpy.concatenate([block[0] for block in blocks]), numpy.concatenate([block[1] for block in blocks]))
+
+    def count(self, kmer):
+        value = canonical_kmer(kmer) if self.canonical else encode_kmer(kmer)
+        if self.mode == "dense":
+            self.flush()
+            return int(self._dense[value])
+        value = numpy.uint64(value)
+        blocks = self.iter_counts()
+        if self.spill_dir != None:
+            # only the partition holding value is read
+            self.flush()
+            self.merge_spilled()
+            partition = self.partition_of(numpy.array([value], dtype=numpy.uint64))[0]
+            blocks = [self.read_partition(partition)] if os.path.exists(self.spill_fn(partition, "kmers")) else []
+        for (kmers, counts) in blocks:
+            idx = numpy.searchsorted(kmers, value)
+            if idx < len(kmers) and kmers[idx] == value:
+                return int(counts[idx])
+        return 0
+
+    def close(self):
+        if self.spill_dir != None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _count_chunk(args):
+    (sequences, k, canonical, mode) = args
+    counter = KmerCounter(k, canonical=canonical, mode=mode)
+    counter.add_sequences(sequences)
+    return counter.counts()
+
+def _chunks(sequences, chunk_bases):
+    chunk = []
+    size = 0
+    for seq in sequences:
+        seq = str(getattr(seq, "sequence", seq))
+        chunk.append(seq)
+        size += len(seq)
+        if size >= chunk_bases:
+            yield chunk
+            chunk = []
+            size = 0
+    if chunk:
+        yield chunk
+
+def count_kmers(sequences, k, canonical=True, mode="auto", processes=None, chunk_bases=1 << 22, max_kmers=None, tempdir=None):
+    counter = KmerCounter(k, canonical=canonical, mode=mode, max_kmers=max_kmers, tempdir=tempdir)
+    if processes == 1:
+        counter.add_sequences(sequences)
+        return counter
+    processes = processes if processes != None else multiprocessing.cpu_count()
+    jobs = ((chunk, k, canonical, counter.mode) for chunk in _chunks(sequences, chunk_bases))
+    pool = multiprocessing.Pool(processes)
+    try:
+        # hand out a few chunks at a time so the input is never read far ahead
+        while True:
+            batch = list(itertools.islice(jobs, processes * 2))
+            if not batch:
+                break
+            for (kmers, counts) in pool.imap_unordered(_count_chunk, batch):
+                counter.add_counts(kmers, counts)
+    finally:
+        pool.close()
+        pool.join()
+    return counter
+
+NoMinimizer = numpy.uint64(0xffffffffffffffff)
+
+def mix_hash(values):
+    # invertible 64 bit mix (murmur3's finalizer), so the smallest hash in a
+    # window is not always the k-mer with the longest run of As
+    values = values.astype(numpy.uint64)
+    values ^= values >> numpy.uint64(33)
+    values *= numpy.uint64(0xff51afd7ed558ccd)
+    values ^= values >> numpy.uint64(33)
+    values *= numpy.uint64(0xc4ceb9fe1a85ec53)
+    values ^= values >> numpy.uint64(33)
+    return values
+
+def window_minimum(values, w):
+    # minimum of every w long window, built by doubling like encode_windows
+    count = len(values) - w + 1
+    result = None
+    (block, span, pos) = (values, 1, 0)
+    while True:
+        if w & span:
+            piece = block[pos:pos + count]
+            result = piece.copy() if result is None else numpy.minimum(result, piece)
+            pos += span
+        if span * 2 > w:
+            break
+        block = numpy.minimum(block[:len(block) - span], block[span:])
+        span *= 2
+    return result
+
+def sequence_minimizers(seq, k=15, w=10):
+    # sorted unique hashes of the smallest canonical k-mer in every window
+    # of w consecutive k-mers
+    codes = EncodeTable[numpy.frombuffer(str(getattr(seq, "sequence", seq)), dtype=numpy.uint8)]
+    count = len(codes) - k + 1
+    if count <= 0:
+        return numpy.zeros(0, dtype=numpy.uint64)
+    ambiguous = codes == NoCode
+    codes = codes & 0x3
+    hashes = mix_hash(numpy.minimum(encode_windows(codes, k), encode_windows(3 - codes[::-1], k)[::-1]))
+    if ambiguous.any():
+        # k-mers over an N are never picked, windows of nothing else are dropped
+        blocked = numpy.concatenate(([0], numpy.cumsum(ambiguous)))
+        hashes[(blocked[k:] - blocked[:count]) > 0] = NoMinimizer
+    minimizers = window_minimum(hashes, min(w, count))
+    # neighbouring windows mostly share their minimizer, drop the repeats
+    # before sorting
+    minimizers = minimizers[numpy.concatenate(([True], minimizers[1:] != minimizers[:-1]))]
+    minimizers = numpy.unique(minimizers)
+    return minimizers[minimizers != NoMinimizer]
+
+class ReferenceIndex(object):
+    # minimizers of every sequence in a reference FastA, sorted, alongside
+    # the reference each one came from.  a query's candidates are found with
+    # one searchsorted over the table and a bincount of the hits.  names are
+    # the IndexedFastA keys, the first word of each header.
+    Version = 2
+
+    def __init__(self, names, minimizers, ref_ids, k=15, w=10):
+        self.names = list(names)
+        self.minimizers = minimizers
+        self.ref_ids = ref_ids
+        self.k = k
+        self.w = w
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return "ReferenceIndex(%d references, %d minimizers, k=%d, w=%d)" % (len(self.names), len(self.minimizers), self.k, self.w)
+
+    @classmethod
+    def build(cls, references, k=15, w=10):
+        if isinstance(references, basestring):
+            with IndexedFastA(references) as fa:
+                return cls.build(iter(fa), k, w)
+        (names, tables) = ([], [])
+        for (ref_id, ref) in enumerate(references):
+            names.append(ref.name)
+            tables.append(sequence_minimizers(ref, k, w))
+        if not tables:
+            return cls(names, numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=numpy.uint32), k, w)
+        minimizers = numpy.concatenate(tables)
+        ref_ids = numpy.repeat(numpy.arange(len(tables), dtype=numpy.uint32), [len(table) for table in tables])
+        order = numpy.argsort(minimizers, kind="mergesort")
+        return cls(names, minimizers[order], ref_ids[order], k, w)
+
+    def save(self, fn):
+        # written through a file handle, savez would append .npz to the name
+        with open(fn, 'wb') as fh:
+            numpy.savez(fh, version=self.Version, k=self.k, w=self.w, names=numpy.array(self.names, dtype=str), minimizers=self.minimizers, ref_ids=self.ref_ids)
+
+    @classmethod
+    def load(cls, fn):
+        with open(fn, 'rb') as fh:
+            data = numpy.load(fh)
+            if int(data["version"]) != cls.Version:
+                raise ValueError("%s: unsupported reference index version %d" % (fn, data["version"]))
+            return cls([str(name) for name in data["names"]], data["minimizers"], data["ref_ids"], int(data["k"]), int(data["w"]))
+
+    @classmethod
+    def for_fasta(cls, fafn, index_fn=None, k=15, w=10):
+        # loads the index saved next to fafn, (re)building it when it is
+        # missing, older than the FastA or built with other parameters
+        index_fn = index_fn if index_fn != None else fafn + ".minimizers.npz"
+        if os.path.exists(index_fn) and not is_stale(fafn, index_fn):
+            try:
+                index = cls.load(index_fn)
+            except ValueError:
+                # from an older version
+                index = None
+            if index != None and (index.k, index.w) == (k, w):
+                return index
+        index = cls.build(fafn, k, w)
+        try:
+            index.save(index_fn)
+        except IOError:
+            # read-only location, keep the index in memory
+            pass
+        return index
+
+    def shared_counts(self, query):
+        # minimizers each reference shares with query
+        query = sequence_minimizers(query, self.k, self.w)
+        lo = numpy.searchsorted(self.minimizers, query, side="left")
+        hi = numpy.searchsorted(self.minimizers, query, side="right")
+        sizes = hi - lo
+        (lo, sizes) = (lo[sizes > 0], sizes[sizes > 0])
+        # every index in lo[i]:hi[i], without a python loop over the ranges
+        offsets = numpy.repeat(lo - numpy.concatenate(([0], numpy.cumsum(sizes)[:-1])), sizes)
+        hits = self.ref_ids[offsets + numpy.arange(len(offsets))]
+        return numpy.bincount(hits, minlength=len(self.names))
+
+    def candidates(self, query, count=5, min_shared=1):
+        # [(name, shared minimizers)] of the best count references
+        shared = self.shared_counts(query)
+        order = numpy.argsort(-shared.astype(numpy.int64), kind="mergesort")[:count]
+        return [(self.names[idx], int(shared[idx])) for idx in order if shared[idx] >= min_shared]
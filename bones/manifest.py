@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import threading
+from . cache import write_json
+
+__all__ = ["RunManifest", "json_values", "context_changes"]
+
+def plain(obj):
+    # json hands back unicode, the rest of the tree expects str
+    if isinstance(obj, unicode):
+        return obj.encode("utf-8")
+    if isinstance(obj, list):
+        return [plain(item) for item in obj]
+    if isinstance(obj, dict):
+        return dict([(plain(key), plain(value)) for (key, value) in obj.items()])
+    return obj
+
+def json_values(values, ignore=()):
+    # the items of values that survive a round trip through JSON
+    found = {}
+    for (key, value) in values.items():
+        if key in ignore:
+            continue
+        try:
+            found[key] = plain(json.loads(json.dumps(value)))
+        except (TypeError, ValueError):
+            continue
+    return found
+
+def context_changes(before, after, keys=None):
+    # (changes, removed): the values in after that are new or differ from
+    # before and the keys after lost, only those in keys when it's given
+    changes = dict([(key, value) for (key, value) in after.items() if key not in before or before[key] != value])
+    removed = [key for key in before if key not in after]
+    if keys != None:
+        changes = dict([(key, value) for (key, value) in changes.items() if key in keys])
+        removed = [key for key in removed if key in keys]
+    return (changes, removed)
+
+class RunManifest(object):
+    # what a pipeline run in dir_output got through, kept in Name there:
+    # the arguments the run started with and, for every step that finished,
+    # its name and version, the size and mtime of the files it read and
+    # wrote and the raw context values it set or removed.  a step is still
+    # complete while each of its files is as the last step to touch it left
+    # it, steps later in the run can rewrite the files of earlier ones.
+    Name = "manifest.json"
+
+    def __init__(self, dir_output):
+        self.fn = os.path.join(dir_output, self.Name)
+        self.lock = threading.Lock()
+        self.data = {"arguments": None, "steps": {}}
+        if os.path.exists(self.fn):
+            try:
+                with open(self.fn) as fh:
+                    self.data = plain(json.load(fh))
+            except ValueError:
+                pass
+
+    def save(self):
+        write_json(self.fn, self.data)
+
+    def matches(self, arguments):
+        return self.data["arguments"] == arguments
+
+    def reset(self, arguments):
+        with self.lock:
+            self.data = {"arguments": arguments, "steps": {}}
+            self.save()
+
+    def keep(self, keys):
+        # forgets every step but keys
+        with self.lock:
+            self.data["steps"] = dict([(key, step) for (key, step) in self.data["steps"].items() if key in keys])
+            self.save()
+
+    def file_signature(self, path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime]
+
+    def record(self, key, order, name, version, files, changes, removed):
+        # files is {name: [path, ...]} as from CachedStage.input_files().
+        # False if the changes can't be kept, the step then isn't recorded.
+        kept = json_values(changes)
+        if len(kept) != len(changes):
+            return False
+        paths = sorted(set([path for fns in files.values() for path in fns if os.path.exists(path)]))
+        step = {
+            "order": order,
+            "name": name,
+            "version": version,
+            "files": [[path] + self.file_signature(path) for path in paths],
+            "changes": kept,
+            "removed": sorted(removed),
+            "finished": time.time(),
+        }
+        with self.lock:
+            self.data["steps"][key] = step
+            self.save()
+        return True
+
+    def latest(self):
+        # {path: signature} as the last step to touch each file left it
+        signatures = {}
+        for step in sorted(self.data["steps"].values(), key=lambda step: step["order"]):
+            for (path, size, mtime) in step["files"]:
+                signatures[path] = [size, mtime]
+        return signatures
+
+    def complete(self, key, name, version):
+        # the step stored under key, if it is still complete
+        step = self.data["steps"].get(key)
+        if step == None or step["name"] != name or step["version"] != version:
+            return None
+        latest = self.latest()
+        for (path, size, mtime) in step["files"]:
+            if not os.path.exists(path) or self.file_signature(path) != latest[path]:
+                return None
+        return step
+
+    def replay(self, step, context):
+        for (key, value) in step["changes"].items():
+            context[key] = value
+        for key in step["removed"]:
+            if key in context:
+                del context[key]
@@ -2,54 +2,37 @@ import plumbum
 import shutil
 from . import utils
 from . import consensus
+from . import align
+from . import kmer
+from . import schedule
+from . import log
+from . cache import CachedStage
+from . context import Context, ContextError
+from . instrument import InstrumentedStage, format_report
+from . process import command_version
+from . manifest import RunManifest, json_values, context_changes
 import os
 import uuid
 from celery import Celery, Task
-from . fast import FastA
+from . fast import FastA, IndexedFastA
+from . samfile import Samfile, handle_pool, SortMemory
+from . tools import samtools
 import inspect
+import operator
+import multiprocessing
+import collections
 import pysam
 import ssw
 import json
 
 default_output_dir = os.getenv("BONES_OUTPUT_DIR", "/tmp")
 
+logger = log.get_logger(__name__)
+
 def plumcmd(cmd):
     cmd = plumbum.path.LocalPath(cmd)
     return plumbum.cmd.__getattr__(cmd)
 
-class Context(dict):
-    def __init__(self, *args, **kw):
-        super(Context, self).__init__()
-        self.init(*args, **kw)
-
-    def __getitem__(self, key):
-        # XXX: is this too goofy?
-        val = super(Context, self).__getitem__(key)
-        try:
-            val = val % self
-        except:
-            pass
-        return val
-
-    def init(self, context=None, **kw):
-        context = context if context != None else {}
-        self.update(context)
-        self.update(kw)
-        if "_history_stack" not in self:
-            self._history_stack = []
-
-    def push(self):
-        ctxt = self.copy()
-        del ctxt["_history_stack"]
-        self["_history_stack"].append(ctxt)
-
-    def pop(self):
-        assert len(self._history_stack), "pop requested on empty history stack"
-        ctxt = self._history_stack.pop()
-        ctxt["_history_stack"] = self._history_stack
-        self.clear()
-        self.init(ctxt)
-
 class Bindable(object):
     def bind_context(self, context):
         self.__dict__["context"] = context
@@ -75,6 +58,11 @@ class Bindable(object):
 class Pipeline(list, Bindable):
     Directories = []
     DefaultContext = {}
+    # context keys that don't change what a run produces, a run can resume
+    # one that differed only in these
+    ResumeIgnores = ["profile", "processes", "dir_cache", "cache_max_bytes"]
+    # the table of the run's stages, next to InstrumentedStage.ReportName
+    ReportTableName = "stages.txt"
 
     def __init__(self, **context):
         self.context = Context(self.DefaultContext)
@@ -83,16 +71,101 @@ class Pipeline(list, Bindable):
     def init(self):
         pass
 
-    def run(self):
+    def run(self, concurrency=1, resume=False):
+        # stages that declare what they consume and produce run side by side,
+        # up to concurrency at a time, see schedule.stage_dependencies().
+        # with resume, a run started with the same arguments into the
+        # dir_output of one that failed skips the stages that one finished,
+        # see resumable().
+        self.__dict__.update(manifest=None, resume=resume, concurrency=concurrency)
+        self.__dict__["arguments"] = json_values(self.context, self.ResumeIgnores)
         self.bind_context(self.context)
         self.init()
-        for stage in self:
-            if inspect.isclass(stage):
-                stage = stage()
-            stage.bind_context(self.context)
+        stages = [stage() if inspect.isclass(stage) else stage for stage in self]
+        for (idx, stage) in enumerate(stages):
+            stage.__dict__["stage_index"] = idx
+        skipped = self.resumable(stages)
+        stages = [stage for (idx, stage) in enumerate(stages) if idx not in skipped]
+        if concurrency == 1:
+            for stage in stages:
+                self.run_stage(stage)
+        else:
+            schedule.run_graph(stages, self.run_stage, concurrency)
+        self.write_report(stages)
+        self.unbind_context()
+
+    def write_report(self, stages):
+        # the stages' records as a table into ReportTableName and the debug
+        # log, shown when profiling
+        records = [stage.__dict__.get("run_record") for stage in stages]
+        records = [record for record in records if record != None]
+        if not records:
+            return
+        table = format_report(records)
+        logger.log(log.INFO if self.context.get("profile") else log.DEBUG, "stages of run %s:\n%s", self.context.get("runid"), table)
+        report_dir = self.context.get("dir_reports") or (self.context.get("dir_output") and os.path.join(self.context["dir_output"], "reports"))
+        if report_dir and os.path.isdir(report_dir):
+            with open(os.path.join(report_dir, self.ReportTableName), 'w') as fh:
+                fh.write(table + '\n')
+
+    def get_manifest(self):
+        # the RunManifest in dir_output, None until there is one
+        if self.__dict__.get("manifest") == None and self.context.get("dir_output"):
+            manifest = RunManifest(self.context["dir_output"])
+            if not (self.__dict__.get("resume") and manifest.matches(self.__dict__["arguments"])):
+                manifest.reset(self.__dict__["arguments"])
+            self.__dict__["manifest"] = manifest
+        return self.__dict__.get("manifest")
+
+    def step_name(self, obj):
+        return "%s.%s" % (type(obj).__module__, type(obj).__name__)
+
+    def resumable(self, stages):
+        # indices of the stages to skip: those the manifest has as complete
+        # whose earlier stages, as far as they depend on them, are skipped
+        # too.  their context changes are replayed in order and what the
+        # manifest has on every other stage is forgotten.
+        manifest = self.get_manifest()
+        if not self.__dict__.get("resume") or manifest == None:
+            return set()
+        skipped = set()
+        for (idx, deps) in enumerate(schedule.stage_dependencies(stages)):
+            if not deps <= skipped:
+                continue
+            step = manifest.complete(str(idx), self.step_name(stages[idx]), stages[idx].version())
+            if step != None:
+                manifest.replay(step, self.context)
+                skipped.add(idx)
+                print "%s: complete in %s, skipped" % (stages[idx].Name or self.step_name(stages[idx]), manifest.fn)
+        manifest.keep([str(idx) for idx in skipped] + ["init"])
+        return skipped
+
+    def checkpoint(self, key, order, obj, before, files):
+        # records a finished step in the manifest with the context keys it
+        # set or removed since before.  of a step that declares what it
+        # Produces only those keys count, stages run side by side change the
+        # context too.  a step whose changes can't be stored isn't recorded,
+        # a resumed run will run it again.
+        manifest = self.get_manifest()
+        if manifest == None:
+            return
+        (changes, removed) = context_changes(before, dict(self.context), getattr(obj, "Produces", None))
+        version = obj.version() if hasattr(obj, "version") else "unknown"
+        if not manifest.record(key, order, self.step_name(obj), version, files, changes, removed):
+            unstored = sorted(set(changes) - set(json_values(changes)))
+            print "%s: not checkpointed, can't store %s" % (getattr(obj, "Name", None) or self.step_name(obj), str.join(", ", unstored))
+
+    def run_stage(self, stage):
+        stage.bind_context(self.context)
+        try:
+            before = dict(self.context)
             stage.run()
+            # the stage's files as it left them, outputs are None if missing
+            files = stage.input_files()
+            files.update(stage.output_files(existing=True) or {})
+            self.checkpoint(str(stage.__dict__["stage_index"]), stage.__dict__["stage_index"], stage, before, files)
+        finally:
             stage.unbind_context()
-        self.unbind_context()
 
 class SequencingPipeline(Pipeline):
     # XXX: r1/r2 for pooled runs
@@ -101,6 +174,16 @@ class SequencingPipeline(Pipeline):
         "runid": None,
         "reference": None,
         "reads": None,
+        # stage results are reused from here when set, see cache.StageCache
+        "dir_cache": os.getenv("BONES_CACHE_DIR", None),
+        # least recently used results are dropped past this size
+        "cache_max_bytes": None,
+        # True, or the names of stages, to cProfile into dir_reports
+        "profile": None,
+        # worker processes for the parallel stages, None uses every cpu
+        "processes": None,
+        # reads counted per column when calling the consensus, None for all
+        "max_depth": None,
         # directories
         "dir_output": None,
         "dir_reference": "%(dir_output)s/reference",
@@ -113,6 +196,7 @@ class SequencingPipeline(Pipeline):
         "dir_assembly": "%(dir_output)s/assembly",
         # files
         "fn_reference": "%(dir_reference)s/reference.fa",
+        "fn_reference_index": "%(dir_reference)s/reference.minimizers.npz",
         "fn_alignment": "%(dir_alignment)s/alignment.bam",
         "fn_reads": None,
     }
@@ -122,8 +206,21 @@ class SequencingPipeline(Pipeline):
             self.context["runid"] = str(uuid.uuid4()).split('-')[0]
         if self.context.get("dir_output", None) == None:
             self.context["dir_output"] = os.path.join(default_output_dir, self.runid)
+        # templates that can't be resolved fail here rather than mid-run
+        self.context.check()
         self.init_directories()
+        # on resume the reads are only linked again if their files changed
+        manifest = self.get_manifest()
+        step = manifest.complete("init", self.step_name(self), "unknown") if self.__dict__.get("resume") else None
+        if step != None:
+            manifest.replay(step, self.context)
+            return
+        before = dict(self.context)
         self.init_filesystem()
+        files = {"fn_reads": list(self.fn_reads)}
+        if os.path.exists(self.fn_reference):
+            files["fn_reference"] = [self.fn_reference]
+        self.checkpoint("init", -1, self, before, files)
 
     def init_directories(self):
         if not os.path.isdir(self.dir_output):
@@ -132,6 +229,8 @@ class SequencingPipeline(Pipeline):
             if not key.startswith("dir_"):
                 continue
             dirpath = self.context[key]
+            if dirpath == None:
+                continue
             if not os.path.isdir(dirpath):
                 os.makedirs(dirpath)
 
@@ -156,19 +255,29 @@ class SequencingPipeline(Pipeline):
         # filenames
         self.fn_alignment = os.path.join(self.dir_alignment, "alignment.bam")
 
-class PipelineStage(Bindable):
+def with_bam_index(files, bamfn, existing=False):
+    # output_files() plus the .bai of bamfn
+    baifn = bamfn + ".bai"
+    if files == None or (existing and not os.path.isfile(baifn)):
+        return None
+    files["fn_alignment_index"] = [baifn]
+    return files
+
+class PipelineStage(Bindable, CachedStage, InstrumentedStage):
     Name = None
     context = None
+    # context keys (or names of other things left on disk, like a bwa index)
+    # the stage reads and writes.  a stage that declares neither runs alone,
+    # one that declares both is cached when dir_cache is set.
+    Consumes = None
+    Produces = None
 
-    def version(self):
-        return "unknown"
-    
     def execute(self):
         pass
 
     def run(self, context=None, **kw):
         self.init()
-        ret = self._run(**kw)
+        ret = self.recorded_run(self.cached_run, **kw)
         ret = ret if ret != None else context
         return ret
     
@@ -180,10 +289,26 @@ class PipelineStage(Bindable):
 
 class PipelineCommand(PipelineStage):
     Command = "false"
+    # what makes Command print its version
+    VersionArguments = ["--version"]
+
+    def version(self):
+        return command_version(self.Command, self.VersionArguments)
 
     def args(self):
         return []
 
+    def cache_arguments(self):
+        # args() with the file names of consumed and produced keys swapped
+        # for the keys, so the same inputs in another run hit the same entry
+        self.__dict__.setdefault("extra", [])
+        names = {}
+        for key in (self.Consumes or []) + (self.Produces or []):
+            value = self.context[key] if key in self.context else None
+            for path in ([value] if isinstance(value, basestring) else value if isinstance(value, list) else []):
+                names[path] = key
+        return [names.get(arg, arg) for arg in self.args()]
+
     def command(self):
         cmd = plumcmd(self.Command)
         cmd = cmd[self.args()]
@@ -191,7 +316,8 @@ class PipelineCommand(PipelineStage):
         
     def _run(self):
         # XXX: extra
-        self.extra = []
+        # kept on the stage, concurrent stages share the context
+        self.__dict__["extra"] = []
         cmd = self.command()
         print "executing: '%s'" % cmd
         cmd()
@@ -205,28 +331,74 @@ class SamtoolsBAM(PipelineCommand):
 
 class SamtoolsSort(PipelineCommand):
     Name = "samtools_sort"
+    Consumes = ["fn_alignment"]
+    Produces = ["fn_alignment"]
     Command = "samtools"
 
+    def prefix(self):
+        return os.path.splitext(self.fn_alignment)[0]
+
+    def cache_arguments(self):
+        # the prefix follows fn_alignment, which isn't part of the key
+        prefix = self.prefix()
+        return [arg if arg != prefix else "fn_alignment prefix" for arg in super(SamtoolsSort, self).cache_arguments()]
+
     def args(self):
-        prefix = os.path.splitext(self.fn_alignment)[0]
-        return ["sort"] + self.extra + [self.fn_alignment, prefix]
+        return ["sort"] + self.extra + [self.fn_alignment, self.prefix()]
 
 class SamtoolsIndex(PipelineCommand):
     Name = "samtools_index"
+    Consumes = ["fn_alignment"]
+    Produces = ["fn_alignment"]
     Command = "samtools"
 
+    def output_files(self, existing=False):
+        files = super(SamtoolsIndex, self).output_files(existing)
+        return with_bam_index(files, self.fn_alignment, existing)
+
     def args(self):
         return ["index"] + self.extra + [self.fn_alignment]
 
+class PrepareAlignment(PipelineStage):
+    Name = "prepare_alignment"
+    Consumes = ["fn_alignment"]
+    Produces = ["fn_alignment"]
+
+    def version(self):
+        # the sort and index run in pysam
+        return "pysam %s, %s" % (pysam.__version__, super(PrepareAlignment, self).version())
+
+    def output_files(self, existing=False):
+        files = super(PrepareAlignment, self).output_files(existing)
+        return with_bam_index(files, self.fn_alignment, existing)
+
+    def _run(self):
+        # sorts and indexes fn_alignment, converting from SAM in the same pass
+        threads = self.processes if self.processes != None else multiprocessing.cpu_count()
+        Samfile(self.fn_alignment).prepare(threads=threads, tempdir=self.dir_alignment)
+
 class BWA_Index(PipelineCommand):
     Name = "bwa_index"
+    Consumes = ["fn_reference"]
+    Produces = ["bwa_index"]
     Command = "bwa"
+    # bwa has no --version, its usage has the version in it
+    VersionArguments = []
+    IndexExtensions = ["amb", "ann", "bwt", "pac", "sa"]
+
+    def output_files(self, existing=False):
+        paths = ["%s.%s" % (self.fn_reference, ext) for ext in self.IndexExtensions]
+        if existing and not all([os.path.isfile(path) for path in paths]):
+            return None
+        return collections.OrderedDict([("bwa_index", paths)])
 
     def args(self):
         return ["index"] + self.extra + [self.fn_reference]
 
 class Megahit(PipelineCommand):
     Name = "megahit"
+    Consumes = ["fn_reads"]
+    Produces = ["dir_assembly"]
     Command = "megahit"
 
     def init(self):
@@ -246,7 +418,10 @@ class Megahit(PipelineCommand):
 
 class BWA_Align(PipelineCommand):
     Name = "bwa_align"
+    Consumes = ["fn_reference", "fn_reads", "bwa_index"]
+    Produces = ["fn_alignment"]
     Command = "bwa"
+    VersionArguments = []
 
     def args(self):
         return ["mem"] + self.extra + [self.fn_reference] + self.fn_reads 
@@ -263,8 +438,45 @@ class BWA_Align(PipelineCommand):
             cmd = (plumcmd(self.Command)[self.args()] | self.samtools_tobam() > self.fn_alignment)
         return cmd
 
+class BWA_AlignSorted(BWA_Align):
+    # bwa piped straight into samtools sort, fn_alignment comes out sorted
+    # and indexed without a SAM or unsorted BAM on disk
+    Name = "bwa_align_sorted"
+    SortMemory = SortMemory
+
+    def output_files(self, existing=False):
+        files = super(BWA_AlignSorted, self).output_files(existing)
+        return with_bam_index(files, self.fn_alignment, existing)
+
+    def sort_threads(self):
+        # samtools counts threads besides the main one
+        threads = self.processes if self.processes != None else multiprocessing.cpu_count()
+        return str(max(0, threads - 1))
+
+    def samtools_sort(self):
+        prefix = os.path.join(self.dir_alignment, utils.temp_filename())
+        args = ["sort", "-@", self.sort_threads(), "-m", self.SortMemory, "-T", prefix, "-O", "bam"]
+        if samtools.sort_writes_index():
+            # the index is written as the BAM is
+            args += ["--write-index", "-o", "%s##idx##%s.bai" % (self.fn_alignment, self.fn_alignment)]
+        else:
+            args += ["-o", self.fn_alignment]
+        return plumcmd("samtools")[args + ["-"]]
+
+    def command(self):
+        if not self.fn_alignment:
+            self.fn_alignment = os.path.join(self.dir_alignment, "alignment.bam")
+        return (plumcmd(self.Command)[self.args()] | self.samtools_sort())
+
+    def _run(self):
+        super(BWA_AlignSorted, self)._run()
+        if utils.is_stale(self.fn_alignment, self.fn_alignment + ".bai"):
+            plumcmd("samtools")["index", "-@", self.sort_threads(), self.fn_alignment]()
+
 class FastQC(PipelineCommand):
     Name = "fastqc"
+    Consumes = ["fn_reads"]
+    Produces = ["dir_qc"]
     Command = "FastQC"
 
     def run(self):
@@ -272,50 +484,88 @@ class FastQC(PipelineCommand):
 
 class Consensus(PipelineStage):
     Name = "consensus_analysis"
+    Consumes = ["fn_reference", "fn_alignment"]
+    Produces = ["fn_reference_index", "fn_consensus", "fn_consensus_windows", "fn_results_json", "fn_results_txt"]
+    DNAAlphabet = "AGTCNRYSWKMBDHV"
+    # single base edits allowed before verification falls back to ssw
+    MaxDiffDistance = 1000
+    # references a consensus is aligned to when its name matches none
+    MaxCandidates = 5
 
-    def _run(self):
+    def init(self):
+        # set before the run so the outputs are known to the cache
         self.fn_results_json = os.path.join(self.dir_reports, "consensus_results.json")
         self.fn_results_txt = os.path.join(self.dir_reports, "consensus_results.txt")
         self.fn_consensus = os.path.join(self.dir_consensus, "consensus.fa")
-        self.references = FastA.load(self.fn_reference)
-        self.write_report()
+        self.fn_consensus_windows = os.path.join(self.dir_reports, "consensus_windows.jsonl")
+
+    def cache_arguments(self):
+        return [self.max_depth, self.MaxDiffDistance, self.MaxCandidates]
+
+    def _run(self):
+        # the stage's own objects stay out of the context
+        self.__dict__["references"] = IndexedFastA(self.fn_reference)
+        self.__dict__["reference_index"] = kmer.ReferenceIndex.for_fasta(self.fn_reference, self.fn_reference_index)
+        try:
+            self.write_report()
+        finally:
+            self.references.close()
 
     def call_consensus(self):
-        self.cc = consensus.Consensus()
-        samf = pysam.AlignmentFile(self.fn_alignment, "rb")
-        seqs = []
-        for sequence in self.cc.call_samfile(samf):
-            yield (sequence, self.cc)
-            seqs.append(sequence)
-        fa = FastA(seqs)
-        fa.save(self.fn_consensus)
+        self.__dict__["cc"] = consensus.VectorConsensus(processes=self.processes, max_depth=self.max_depth)
+        samf = handle_pool.get(self.fn_alignment)
+        # the consensus is streamed to disk window by window, then read back
+        # one sequence at a time (by name, FastA skips empty records)
+        summaries = self.cc.write_calls(samf, self.fn_consensus, self.fn_consensus_windows)
+        with IndexedFastA(self.fn_consensus) as consensus_fa:
+            for (name, coverage, call_type_hist) in summaries:
+                yield (consensus_fa.fetch(name), coverage)
+
+    def candidate_references(self, query):
+        # the consensus of reference X is called X_consensus, anything else
+        # goes to the references sharing the most minimizers with it
+        name = query.name
+        if name.endswith("_consensus"):
+            name = name[:-len("_consensus")]
+        if name in self.references:
+            return [self.references.fetch(name)]
+        candidates = self.reference_index.candidates(query, self.MaxCandidates)
+        if not candidates:
+            return list(self.references)
+        return [self.references.fetch(name) for (name, shared) in candidates]
+
+    def get_aligner(self):
+        # one ssw aligner for the whole stage, kept out of the context
+        if "_aligner" not in self.__dict__:
+            matrix = ssw.DNA_ScoreMatrix(alphabet=self.DNAAlphabet)
+            self.__dict__["_aligner"] = ssw.Aligner(matrix=matrix)
+        return self.__dict__["_aligner"]
 
     def execute_alignment(self, query):
-        row = []
-        self.dna_alphabet = "AGTCNRYSWKMBDHV"
-        matrix = ssw.DNA_ScoreMatrix(alphabet=self.dna_alphabet)
-        aligner = ssw.Aligner(matrix=matrix)
-        for reference in self.references:
-            alignment = aligner.align(query, reference)
-            row.append(alignment)
-        row.sort(cmp=lambda x, y: cmp(x.score, y.score), reverse=True)
-        winner = row[0]
+        # a near identical consensus is checked against the best candidate
+        # with a linear diff, ssw is only needed when that gives up
+        candidates = self.candidate_references(query)
+        alignment = align.diff_align(query, candidates[0], self.MaxDiffDistance)
+        if alignment != None:
+            return (candidates[0], alignment)
+        aligner = self.get_aligner()
+        row = [aligner.align(query, reference) for reference in candidates]
+        winner = max(row, key=operator.attrgetter("score"))
         return (winner.reference, winner)
 
     def compare_consensus(self):
-        for (consensus_sequence, consensus_caller) in self.call_consensus():
+        for (consensus_sequence, coverage) in self.call_consensus():
             (reference, alignment) = self.execute_alignment(consensus_sequence)
-            yield (reference, alignment, consensus_caller)
+            yield (reference, alignment, coverage)
 
     def build_report(self):
-        refs = FastA.load(self.fn_reference)
         report = {
-            "reference_count": len(refs),
+            "reference_count": len(self.references),
             "references": [],
         }
 
         global_verified_flag = True
-        for (reference, alignment, consensus_caller) in self.compare_consensus():
+        for (reference, alignment, coverage) in self.compare_consensus():
             verified_flag = alignment.match_count == len(reference)
             global_verified_flag &= verified_flag
             alstat = {
@@ -324,7 +574,7 @@ class Consensus(PipelineStage):
                 "cigar": alignment.cigar,
                 "alignment": alignment.alignment_report(),
             }
-            alstat.update(consensus_caller.coverage)
+            alstat.update(coverage)
             report["references"].append(alstat)
         report["verified"] = global_verified_flag
         return report
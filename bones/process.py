@@ -1,9 +1,34 @@
 import os
+import re
 import operator
+import threading
 import subprocess
 from . utils import which
-
-__all__ = ["Process", "ProcessArgument", "Pipe"]
+from . instrument import wait_child
+
+__all__ = ["Process", "ProcessArgument", "Pipe", "command_version"]
+
+_versions = {}
+_versions_lock = threading.Lock()
+
+def command_version(command, arguments=("--version",)):
+    # the first version number command prints, on stdout or stderr, when
+    # run with arguments.  "unknown" when it can't be run or prints none.
+    # each binary is only asked once.
+    command_path = which(command) if command else None
+    if command_path == None:
+        return "unknown"
+    key = (command_path, tuple(arguments))
+    with _versions_lock:
+        if key not in _versions:
+            try:
+                proc = subprocess.Popen([command_path] + list(arguments), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                output = proc.communicate()[0]
+            except OSError:
+                output = ''
+            match = re.search(r"(\d+\.\d+(?:[.-][0-9A-Za-z]+)*)", output)
+            _versions[key] = match.group(1) if match else "unknown"
+        return _versions[key]
 
 class ProcessArgument(object):
     def __init__(self, name=None, argument=None, type=None, default=None, required=False, position=None, help=None):
@@ -67,8 +92,9 @@ class Process(object):
                         cli.extend(map(str, value))
                     else:
                         cli.append("%s" % value)
-                elif parg.type == bool and value:
-                    cli.append(parg.argument)
+                elif parg.type == bool:
+                    if value:
+                        cli.append(parg.argument)
                 else:
                     cli.append(parg.argument)
                     cli.append("%s" % value)
@@ -105,10 +131,25 @@ class Process(object):
         subprocess_args = self.subprocess_arguments(**kw)
         self.proc = subprocess.Popen(cli, **subprocess_args)
         if wait:
-            self.proc.wait()
+            self.reap()
         return self.proc
     __call__ = run = execute
 
+    def reap(self):
+        # waits through wait4 so the child's resource use is recorded
+        if self.proc.returncode != None:
+            return self.proc.returncode
+        try:
+            (status, self.rusage) = wait_child(self.proc.pid)
+        except OSError:
+            # reaped elsewhere
+            return self.proc.wait()
+        if os.WIFSIGNALED(status):
+            self.proc.returncode = -os.WTERMSIG(status)
+        else:
+            self.proc.returncode = os.WEXITSTATUS(status)
+        return self.proc.returncode
+
     def assert_return_code(self):
         if self.ReturnCode == None:
             return
@@ -118,7 +159,7 @@ class Process(object):
             raise RuntimeError, "The command '%s' did not return the expected return code (%s instead of %s)" % (self.command_path, self.proc.returncode, self.ReturnCode)
 
     def wait(self):
-        self.proc.wait()
+        self.reap()
         self.assert_return_code()
         return self.proc.returncode
 
@@ -136,6 +177,9 @@ class Pipe(object):
     def execute(self, stdin_args=None, stdout_args=None):
         self.stdout_proc = self.stdout.execute(args=stdout_args, stdout=subprocess.PIPE)
         self.stdin_proc = self.stdin.execute(args=stdin_args, stdin=self.stdout_proc.stdout)
+        # only the reader holds the pipe now, so the writer gets SIGPIPE if
+        # the reader dies instead of blocking
+        self.stdout_proc.stdout.close()
         return (self.stdout_proc, self.stdin_proc)
     __call__ = execute
 
@@ -2,16 +2,132 @@ import errno
 import glob
 import sys
 import os
+import time
+import threading
+import collections
 
 import pysam
 
 from . utils import *
 
-__all__ = ["Samfile"]
+__all__ = ["Samfile", "HandlePool", "handle_pool", "pysam_samtools_version", "SortMemory"]
+
+def pysam_samtools_version():
+    # of the samtools bundled with pysam, which runs Samfile.sort().  sorts
+    # piped through the samtools binary check tools.samtools.sort_writes_index()
+    return tuple([int(part) for part in pysam.__samtools_version__.split('.')[:2]])
+
+# sort writes the index as it goes from samtools 1.10 on
+SortWritesIndex = pysam_samtools_version() >= (1, 10)
+
+# samtools sort memory per thread, for every sort the package runs
+SortMemory = "768M"
+
+class HandlePool(object):
+    # open AlignmentFiles shared by everything in the process.  each thread
+    # has its own handles, keyed by filename and mode, of which at most
+    # max_handles are kept open with the least recently used closed first,
+    # so don't hold on to a handle across many other get()s.  a thread only
+    # closes the handles of another thread once it has finished, until then
+    # they are marked to be reopened.  a handle is reopened when its file's size, mtime or inode
+    # changes, checked with a stat at most every stat_interval seconds, the
+    # Samfile methods that rewrite a BAM invalidate it straight away.  after
+    # a fork the child starts an empty pool instead of sharing file offsets
+    # with its parent.
+    DefaultMaxHandles = 64
+    DefaultStatInterval = 0.25
+    # signature of a handle to reopen on its thread's next get()
+    Stale = "stale"
+
+    def __init__(self, max_handles=None, stat_interval=None):
+        self.max_handles = max_handles if max_handles != None else self.DefaultMaxHandles
+        self.stat_interval = stat_interval if stat_interval != None else self.DefaultStatInterval
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        # forgets every handle without closing them, a forked child's copies
+        # belong to the parent
+        self.pid = os.getpid()
+        self._handles = {}
+        self._stats = {}
+
+    def check_fork(self):
+        if os.getpid() != self.pid:
+            self.reset()
+
+    def __len__(self):
+        return sum([len(handles) for handles in self._handles.values()])
+
+    def thread_handles(self):
+        # {(filename, mode): (handle, signature)} of this thread, oldest first
+        return self._handles.setdefault(threading.current_thread().ident, collections.OrderedDict())
+
+    def stat(self, fn):
+        # (size, mtime, inode) of fn or None if it doesn't exist
+        fn = os.path.abspath(fn)
+        with self.lock:
+            self.check_fork()
+            now = time.time()
+            cached = self._stats.get(fn)
+            if cached != None and now - cached[0] < self.stat_interval:
+                return cached[1]
+            try:
+                st = os.stat(fn)
+                signature = (st.st_size, st.st_mtime, st.st_ino)
+            except OSError:
+                signature = None
+            self._stats[fn] = (now, signature)
+            return signature
+
+    def get(self, fn, mode="rb"):
+        fn = os.path.abspath(fn)
+        with self.lock:
+            self.check_fork()
+            handles = self.thread_handles()
+            key = (fn, mode)
+            signature = self.stat(fn)
+            entry = handles.pop(key, None)
+            if entry != None:
+                if entry[1] == signature:
+                    handles[key] = entry
+                    return entry[0]
+                entry[0].close()
+            handle = pysam.AlignmentFile(fn, mode)
+            handles[key] = (handle, signature)
+            while len(handles) > self.max_handles:
+                handles.popitem(last=False)[1][0].close()
+            return handle
+
+    def invalidate(self, fn=None):
+        # closes the handles on fn (or every handle) of this thread and of
+        # threads that have finished, marks those of running threads stale
+        # and forgets fn's stat
+        with self.lock:
+            self.check_fork()
+            fn = os.path.abspath(fn) if fn != None else None
+            ident = threading.current_thread().ident
+            running = set([thread.ident for thread in threading.enumerate()])
+            for (owner, handles) in self._handles.items():
+                for key in handles.keys():
+                    if fn != None and key[0] != fn:
+                        continue
+                    if owner == ident or owner not in running:
+                        handles.pop(key)[0].close()
+                    else:
+                        handles[key] = (handles[key][0], self.Stale)
+            if fn == None:
+                self._stats.clear()
+            else:
+                self._stats.pop(fn, None)
+    close = invalidate
+
+handle_pool = HandlePool()
 
 class Samfile(object):
+    SortMemory = SortMemory
+
     def __init__(self, basename, reffn=None):
-        self._cache = {}
         basename_parts = basename.split('.')
         if basename_parts[-1].lower() in ("sam", "bam"):
             basename = str.join('.', basename_parts[:-1])
@@ -36,25 +152,20 @@ class Samfile(object):
         return self.bamfn + ".bai"
 
     def get_samf(self, fn):
-        (samf, cache_mtime) = self._cache.get(fn, (None, 0))
-        source_mtime = os.path.getmtime(fn)
-        if source_mtime != cache_mtime:
-            if samf != None:
-                samf.close()
-            samf = pysam.AlignmentFile(fn, "rb")
-            self._cache[fn] = (samf, source_mtime)
-        return samf
+        return handle_pool.get(fn)
+
+    @property
+    def current_fn(self):
+        # the BAM, unless there's no BAM or the SAM is newer
+        bam = handle_pool.stat(self.bamfn)
+        sam = handle_pool.stat(self.samfn)
+        if bam != None and (sam == None or sam[1] <= bam[1]):
+            return self.bamfn
+        return self.samfn
 
     @property
     def samf(self):
-        if os.path.exists(self.bamfn):
-            if not os.path.exists(self.samfn):
-                # no SAM file to test against, return the BAM
-                return self.get_samf(self.bamfn)
-            # since there is a SAM file, test to see if the BAM is stale
-            if not is_stale(self.samfn, self.bamfn):
-                return self.get_samf(self.bamfn)
-        return self.get_samf(self.samfn)
+        return self.get_samf(self.current_fn)
 
     @property
     def is_sorted(self):
@@ -62,26 +173,25 @@ class Samfile(object):
 
     @property
     def is_bam(self):
-        # https://github.com/pysam-developers/pysam/issues/186
-        return self.samf.filename.lower().endswith(".bam")
+        return self.current_fn == self.bamfn
 
     @property
     def is_sam(self):
-        # https://github.com/pysam-developers/pysam/issues/186
-        return self.samf.filename.lower().endswith(".sam")
+        return self.current_fn == self.samfn
 
-    def prepare(self):
-        # are we dealing with a bam?
+    def prepare(self, threads=1, memory=None, tempdir=None):
+        # a SAM (or an unsorted BAM) is sorted straight into a BAM in one
+        # pass, samtools sort does the compression on threads
         if self.is_sam:
-            self.to_bam()
-        # is our bam sorted?
-        if not self.is_sorted:
-            self.sort()
+            self.sort(self.samfn, threads, memory, tempdir)
+        elif not self.is_sorted:
+            self.sort(self.bamfn, threads, memory, tempdir)
         # is our index stale?
         if is_stale(self.bamfn, self.baifn):
-            self.build_index()
-        # clear our cache
-        self._cache = {}
+            self.build_index(threads)
+        # reopen on next use, the stats may be cached from before
+        handle_pool.invalidate(self.samfn)
+        handle_pool.invalidate(self.bamfn)
 
     def to_bam(self):
         msg = "Converting %s to BAM %s" % (self.samfn, self.bamfn)
@@ -91,18 +201,33 @@ class Samfile(object):
         bamf = pysam.AlignmentFile(self.bamfn, "wb", template=self.samf)
         map(bamf.write, samf)
         bamf.close()
+        handle_pool.invalidate(self.bamfn)
 
-    def sort(self):
-        msg = "Sorting %s" % self.bamfn
+    def sort(self, source=None, threads=1, memory=None, tempdir=None):
+        # coordinate sorts source (the BAM by default) into the BAM, writing
+        # the index in the same pass when samtools can
+        source = source if source != None else self.bamfn
+        msg = "Sorting %s into %s" % (source, self.bamfn)
         print(msg)
-        tempfn_stem = os.path.join(self.basedir, temp_filename())
-        print self.bamfn, tempfn_stem
-        pysam.sort(self.bamfn, tempfn_stem)
-        tempfn_glob = glob.glob(tempfn_stem + '*')
-        assert len(tempfn_glob) == 1, "Unexpected number of temporary output files: %r" % tempfn_glob
-        tempfn = tempfn_glob[0]
-        # rename our sorted bamfn 
-        os.rename(tempfn, self.bamfn)
+        tempdir = tempdir if tempdir != None else self.basedir
+        tempfn_stem = os.path.join(tempdir, temp_filename())
+        tempfn = os.path.join(self.basedir, temp_filename(ext="bam"))
+        output = tempfn
+        if SortWritesIndex:
+            output = "%s##idx##%s.bai" % (tempfn, tempfn)
+        # -@ counts threads besides the main one
+        args = ["-@", str(max(0, threads - 1)), "-m", memory if memory != None else self.SortMemory, "-T", tempfn_stem, "-O", "bam", "-o", output]
+        if SortWritesIndex:
+            args.insert(0, "--write-index")
+        try:
+            pysam.sort(*(args + [source]))
+            os.rename(tempfn, self.bamfn)
+            handle_pool.invalidate(self.bamfn)
+            if SortWritesIndex:
+                os.rename(tempfn + ".bai", self.baifn)
+        finally:
+            for fn in glob.glob(tempfn + '*') + glob.glob(tempfn_stem + '*'):
+                os.unlink(fn)
 
     def rmdup(self):
         msg = "Removing duplicates in %s" % self.bamfn
@@ -114,8 +239,11 @@ class Samfile(object):
         tempfn = tempfn_glob[0]
         # rename our dedupped bamfn 
         os.rename(tempfn, self.bamfn)
+        handle_pool.invalidate(self.bamfn)
 
-    def build_index(self):
+    def build_index(self, threads=1):
         msg = "Building index %s" % self.baifn
         print(msg)
-        pysam.index(self.bamfn)
+        pysam.index("-@", str(max(0, threads - 1)), self.bamfn)
+        # open handles keep the index they were opened with
+        handle_pool.invalidate(self.bamfn)
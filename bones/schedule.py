@@ -0,0 +1,78 @@
+import sys
+import threading
+import Queue
+
+__all__ = ["stage_dependencies", "run_graph"]
+
+def stage_dependencies(stages):
+    # [set of indices each stage waits on].  stages declare the context keys
+    # they Consumes and Produces: a stage waits on the last earlier producer
+    # of every key it consumes or produces, and on the earlier consumers of
+    # what it produces.  a stage that declares neither is a barrier, it
+    # waits on everything before it and everything after waits on it.
+    deps = []
+    producers = {}
+    readers = {}
+    (barrier, since_barrier) = (None, [])
+    for (idx, stage) in enumerate(stages):
+        consumes = getattr(stage, "Consumes", None)
+        produces = getattr(stage, "Produces", None)
+        if consumes == None and produces == None:
+            waits = set(since_barrier)
+            if barrier != None:
+                waits.add(barrier)
+            (barrier, since_barrier) = (idx, [])
+            producers.clear()
+            readers.clear()
+            deps.append(waits)
+            continue
+        (consumes, produces) = (consumes or [], produces or [])
+        waits = set([barrier]) if barrier != None else set()
+        for key in list(consumes) + list(produces):
+            if key in producers:
+                waits.add(producers[key])
+        for key in produces:
+            waits |= readers.get(key, set())
+        for key in consumes:
+            readers.setdefault(key, set()).add(idx)
+        for key in produces:
+            producers[key] = idx
+            readers[key] = set()
+        waits.discard(idx)
+        since_barrier.append(idx)
+        deps.append(waits)
+    return deps
+
+def run_graph(stages, run_stage, concurrency=1):
+    # calls run_stage(stage) for every stage on up to concurrency threads,
+    # each as soon as the stages it depends on have finished.  ready stages
+    # start in list order.  after a failure nothing new is started and the
+    # first exception is raised once the running stages are done.
+    waiting = dict(enumerate(stage_dependencies(stages)))
+    finished = Queue.Queue()
+    def worker(idx):
+        try:
+            run_stage(stages[idx])
+            finished.put((idx, None))
+        except:
+            finished.put((idx, sys.exc_info()))
+    (running, error) = (0, None)
+    while waiting or running:
+        if error == None:
+            ready = sorted([idx for (idx, deps) in waiting.items() if not deps])
+            for idx in ready[:max(1, concurrency) - running]:
+                del waiting[idx]
+                thread = threading.Thread(target=worker, args=(idx,), name=getattr(stages[idx], "Name", None) or "stage_%d" % idx)
+                thread.daemon = True
+                thread.start()
+                running += 1
+        if not running:
+            break
+        (idx, exc_info) = finished.get()
+        running -= 1
+        if exc_info != None and error == None:
+            error = exc_info
+        for deps in waiting.values():
+            deps.discard(idx)
+    if error != None:
+        raise error[0], error[1], error[2]
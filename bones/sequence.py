@@ -2,8 +2,9 @@
 import random
 import math
 import copy
+import numpy
 
-__all__ = ["Sequence", "ComplimentTable", "random_sequence"]
+__all__ = ["Sequence", "SequenceView", "SequenceBatch", "PackedSequence", "ComplimentTable", "random_sequence", "random_sequences"]
 
 def build_compliment_table():
     cmap = ((ord('G'), ord('C')), (ord('A'), ord('T')))
@@ -17,6 +18,57 @@ def build_compliment_table():
     return str.join('', _ctable)
 ComplimentTable = build_compliment_table()
 
+# 2-bit base encoding used by PackedSequence
+BaseCodes = "ACGT"
+NoCode = 0xff
+
+def build_encode_table():
+    table = numpy.empty(0xff + 1, dtype=numpy.uint8)
+    table.fill(NoCode)
+    for (code, base) in enumerate(BaseCodes):
+        table[ord(base)] = table[ord(base.lower())] = code
+    return table
+EncodeTable = build_encode_table()
+DecodeTable = numpy.frombuffer(BaseCodes, dtype=numpy.uint8)
+ComplimentArray = numpy.frombuffer(ComplimentTable, dtype=numpy.uint8)
+UpperArray = numpy.frombuffer(str.join('', [chr(idx) for idx in xrange(0xff + 1)]).upper(), dtype=numpy.uint8)
+
+def build_gc_byte_table():
+    # number of G/C codes in each possible packed byte
+    gc = numpy.array([0, 1, 1, 0], dtype=numpy.uint8)
+    byte = numpy.arange(0xff + 1)
+    return gc[byte >> 6] + gc[(byte >> 4) & 0x3] + gc[(byte >> 2) & 0x3] + gc[byte & 0x3]
+GCByteTable = build_gc_byte_table()
+
+def build_base_table(bases):
+    table = numpy.zeros(0xff + 1, dtype=numpy.uint8)
+    for base in bases:
+        table[ord(base)] = table[ord(base.lower())] = 1
+    return table
+GCTable = build_base_table("GC")
+CalledTable = build_base_table(BaseCodes)
+
+def window_profile(hits, called, window_size=10, step=1, ambiguous="count"):
+    # fraction of hits per window from cumulative sums, O(n) regardless of window_size
+    if ambiguous not in ("count", "skip"):
+        raise ValueError("ambiguous must be 'count' or 'skip', not %r" % ambiguous)
+    for (name, value) in (("window_size", window_size), ("step", step)):
+        if not isinstance(value, (int, long, numpy.integer)) or value < 1:
+            raise ValueError("%s must be a positive integer, not %r" % (name, value))
+    length = len(hits)
+    if not length:
+        return numpy.zeros(0, dtype=numpy.float64)
+    # a window past the end covers the whole sequence, as with window()
+    window_size = min(length, window_size)
+    totals = numpy.concatenate(([0], numpy.cumsum(hits, dtype=numpy.int64)))
+    counts = (totals[window_size:] - totals[:-window_size])[::step]
+    if ambiguous == "count":
+        return counts / float(window_size)
+    totals = numpy.concatenate(([0], numpy.cumsum(called, dtype=numpy.int64)))
+    denominator = (totals[window_size:] - totals[:-window_size])[::step]
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return numpy.where(denominator > 0, counts / denominator.astype(numpy.float64), numpy.nan)
+
 class SequenceInfo(dict):
     Defaults = {
         "name": "",
@@ -84,9 +136,14 @@ class Sequence(str):
         self.info = kw
 
     def get_info(self):
+        # deferred info, see FastA.stream()
+        loader = self.__dict__.pop("_info_loader", None)
+        if loader != None:
+            self.info = loader()
         return self._info
     
     def set_info(self, info):
+        self.__dict__.pop("_info_loader", None)
         if info == None:
             info = {}
         if not isinstance(info, SequenceInfo):
@@ -123,9 +180,12 @@ class Sequence(str):
         subseq = super(Sequence, self).__getslice__(*args)
         return self.copy(subseq)
 
+    def view(self, start=0, stop=None):
+        return SequenceView(self, start, stop)
+
     def window(self, window_size):
         sz = min(len(self), window_size)
-        return (self[x:x + sz] for x in xrange(len(self) - sz + 1))
+        return (SequenceView(self, x, x + sz) for x in xrange(len(self) - sz + 1))
 
     def copy(self, sequence=None, **kw):
         sequence = sequence if sequence != None else str(self)
@@ -134,11 +194,25 @@ class Sequence(str):
         return self.__class__(sequence, **info)
 
     def gc_window(self, window_size=10):
-        return (seq.gc_content for seq in self.window(window_size))
+        return iter(self.gc_profile(window_size))
+
+    def gc_profile(self, window_size=10, step=1, ambiguous="count"):
+        # ambiguous="count" treats N as a non-GC base, "skip" leaves it out of the denominator
+        raw = numpy.frombuffer(self, dtype=numpy.uint8)
+        return window_profile(GCTable[raw], CalledTable[raw], window_size, step, ambiguous)
+
+    def at_profile(self, window_size=10, step=1, ambiguous="count"):
+        raw = numpy.frombuffer(self, dtype=numpy.uint8)
+        if ambiguous == "count":
+            # matches at_count, which is everything that isn't G or C
+            at = 1 - GCTable[raw]
+        else:
+            at = CalledTable[raw] - GCTable[raw]
+        return window_profile(at, CalledTable[raw], window_size, step, ambiguous)
 
     @property
     def reverse(self):
-        return self.copy(self[::-1])
+        return self.copy(str(self)[::-1])
 
     @property
     def compliment(self):
@@ -167,6 +241,9 @@ class Sequence(str):
     def at_content(self):
         return self.at_count / float(len(self))
 
+    def pack(self):
+        return PackedSequence.from_sequence(self)
+
     @property
     def is_palindrome(self):
         if len(self) & 0x1:
@@ -174,15 +251,533 @@ class Sequence(str):
             return False
         return self == self.rc
 
-def random_sequence(length, name=None, gc_median=0.5, gc_spread=0.1):
+class SequenceView(object):
+    # a window over a parent Sequence that shares its string and info until
+    # either needs to change.  anything that isn't implemented here is
+    # served from a materialized Sequence.
+    __slots__ = ("parent", "start", "stop", "_shared_info", "_info")
+
+    def __init__(self, parent, start=0, stop=None, info=None):
+        length = len(parent)
+        stop = length if stop == None else stop
+        (start, stop, step) = slice(start, stop).indices(length)
+        self.parent = parent
+        self.start = start
+        self.stop = max(start, stop)
+        self._shared_info = info
+        self._info = None
+
+    def get_shared_info(self):
+        if self._info is not None:
+            return self._info
+        if self._shared_info is None:
+            self._shared_info = self.parent.info
+        return self._shared_info
+
+    def get_info(self):
+        # copy on first access, the caller may mutate what we hand back
+        if self._info is None:
+            self._info = self.get_shared_info().copy()
+        return self._info
+
+    def set_info(self, info):
+        if not isinstance(info, SequenceInfo):
+            info = SequenceInfo(info)
+        self._info = info
+    info = property(get_info, set_info)
+
+    def get_name(self):
+        return self.get_shared_info().get("name", "")
+
+    def set_name(self, name):
+        self.info["name"] = name
+    name = property(get_name, set_name)
+
+    def get_strand(self):
+        return self.get_shared_info().get("strand", 1)
+
+    def set_strand(self, strand):
+        self.info["strand"] = strand
+    strand = property(get_strand, set_strand)
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __str__(self):
+        return str.__getitem__(self.parent, slice(self.start, self.stop))
+
+    def __repr__(self):
+        return "SequenceView(%r, %d, %d)" % (str(self), self.start, self.stop)
+
+    def __eq__(self, other):
+        if isinstance(other, (basestring, SequenceView)):
+            return len(self) == len(other) and str(self) == str(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    # ordered and concatenated as the str they stand for
+    def __lt__(self, other):
+        if isinstance(other, (basestring, SequenceView)):
+            return str(self) < str(other)
+        return NotImplemented
+
+    def __le__(self, other):
+        if isinstance(other, (basestring, SequenceView)):
+            return str(self) <= str(other)
+        return NotImplemented
+
+    def __gt__(self, other):
+        if isinstance(other, (basestring, SequenceView)):
+            return str(self) > str(other)
+        return NotImplemented
+
+    def __ge__(self, other):
+        if isinstance(other, (basestring, SequenceView)):
+            return str(self) >= str(other)
+        return NotImplemented
+
+    def __add__(self, other):
+        if isinstance(other, (basestring, SequenceView)):
+            return str(self) + str(other)
+        return NotImplemented
+
+    def __radd__(self, other):
+        if isinstance(other, basestring):
+            return other + str(self)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __copy__(self):
+        return SequenceView(self.parent, self.start, self.stop, self.get_shared_info())
+
+    def __reduce__(self):
+        # pickled over just its own bases, not the whole parent
+        return (SequenceView, (Sequence(str(self), **self.get_shared_info()),))
+
+    def __iter__(self):
+        return iter(str(self))
+
+    def __contains__(self, sub):
+        return str.find(self.parent, sub, self.start, self.stop) != -1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            (start, stop, step) = idx.indices(len(self))
+            if step == 1:
+                return self.view(start, stop)
+            return self.materialize()[idx]
+        if idx < 0:
+            idx += len(self)
+        if not (0 <= idx < len(self)):
+            raise IndexError("SequenceView index out of range")
+        return str.__getitem__(self.parent, self.start + idx)
+
+    def view(self, start=0, stop=None):
+        (start, stop, step) = slice(start, stop).indices(len(self))
+        return SequenceView(self.parent, self.start + start, self.start + stop, self.get_shared_info())
+
+    @property
+    def buffer(self):
+        return memoryview(self.parent)[self.start:self.stop]
+
+    def materialize(self):
+        return Sequence(str(self), **self.get_shared_info())
+
+    def count(self, sub):
+        return str.count(self.parent, sub, self.start, self.stop)
+
+    @property
+    def gc_count(self):
+        return sum(self.count(base) for base in "GCgc")
+
+    @property
+    def at_count(self):
+        return len(self) - self.gc_count
+
+    @property
+    def gc_content(self):
+        return self.gc_count / float(len(self))
+
+    @property
+    def at_content(self):
+        return self.at_count / float(len(self))
+
+    def __getattr__(self, key):
+        # private and special names are never served from a materialized
+        # copy, copy and pickle probe for those
+        if key.startswith('_'):
+            raise AttributeError(key)
+        return getattr(self.materialize(), key)
+
+class SequenceBatch(object):
+    # many records in one contiguous buffer, record i is buffer[offsets[i]:offsets[i + 1]].
+    # infos are shared between batches derived from one another, strands are
+    # kept in their own array so rc doesn't have to copy them.
+    def __init__(self, buffer, offsets, infos, strands=None):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.infos = infos
+        if strands is None:
+            strands = numpy.array([info.get("strand", 1) for info in infos], dtype=numpy.int8)
+        self.strands = strands
+
+    @classmethod
+    def from_sequences(cls, sequences):
+        chunks = []
+        infos = []
+        for seq in sequences:
+            # FastQRecord keeps its bases in .sequence
+            bases = getattr(seq, "sequence", seq)
+            chunks.append(str(bases))
+            info = getattr(seq, "info", None)
+            if info == None:
+                info = {"name": getattr(seq, "name", "")}
+            infos.append(info)
+        lengths = numpy.fromiter((len(chunk) for chunk in chunks), dtype=numpy.int64, count=len(chunks))
+        offsets = numpy.concatenate(([0], numpy.cumsum(lengths))).astype(numpy.int64)
+        buffer = numpy.frombuffer(str.join('', chunks), dtype=numpy.uint8)
+        return cls(buffer, offsets, infos)
+
+    @classmethod
+    def from_fasta(cls, fafn):
+        from . fast import FastA
+        return cls.from_sequences(FastA.iter(fafn))
+
+    @classmethod
+    def from_fastq(cls, fqfn):
+        from . fast import FastQ
+        return cls.from_sequences(FastQ.iter(fqfn))
+
+    def __len__(self):
+        return len(self.infos)
+
+    @property
+    def lengths(self):
+        return numpy.diff(self.offsets)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not (0 <= idx < len(self)):
+            raise IndexError("SequenceBatch index out of range")
+        seq = self.buffer[self.offsets[idx]:self.offsets[idx + 1]].tostring()
+        seq = Sequence(seq, **self.infos[idx])
+        seq.strand = int(self.strands[idx])
+        return seq
+
+    def __iter__(self):
+        return (self[idx] for idx in xrange(len(self)))
+
+    def copy(self, buffer, strands=None):
+        strands = self.strands if strands is None else strands
+        return self.__class__(buffer, self.offsets, self.infos, strands)
+
+    def reversed_index(self):
+        # position p of record i maps to offsets[i] + offsets[i + 1] - 1 - p
+        lengths = self.lengths
+        record_ends = (self.offsets[:-1] + self.offsets[1:] - 1)
+        return numpy.repeat(record_ends, lengths) - numpy.arange(len(self.buffer))
+
+    @property
+    def reverse(self):
+        return self.copy(self.buffer[self.reversed_index()])
+
+    @property
+    def compliment(self):
+        return self.copy(ComplimentArray[self.buffer])
+
+    @property
+    def reverse_compliment(self):
+        return self.copy(ComplimentArray[self.buffer[self.reversed_index()]], -self.strands)
+    rc = revcomp = reverse_compliment
+
+    def upper(self):
+        return self.copy(UpperArray[self.buffer])
+
+    def count_per_record(self, table):
+        totals = numpy.concatenate(([0], numpy.cumsum(table[self.buffer], dtype=numpy.int64)))
+        return totals[self.offsets[1:]] - totals[self.offsets[:-1]]
+
+    @property
+    def gc_counts(self):
+        return self.count_per_record(GCTable)
+
+    @property
+    def at_counts(self):
+        return self.lengths - self.gc_counts
+
+    @property
+    def gc_contents(self):
+        return self.gc_counts / self.lengths.astype(numpy.float64)
+
+def find_runs(values):
+    # (starts, ends, values) for each run of equal, non-zero values
+    values = numpy.asarray(values)
+    if not len(values):
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return (empty, empty, values[:0])
+    change = numpy.flatnonzero(values[1:] != values[:-1]) + 1
+    starts = numpy.concatenate(([0], change))
+    ends = numpy.concatenate((change, [len(values)]))
+    keep = values[starts] != 0
+    return (starts[keep], ends[keep], values[starts][keep])
+
+def expand_runs(runs, out):
+    (starts, ends, values) = runs
+    lengths = ends - starts
+    if not len(lengths):
+        return out
+    offsets = numpy.repeat(starts - (numpy.cumsum(lengths) - lengths), lengths)
+    out[offsets + numpy.arange(lengths.sum())] = numpy.repeat(values, lengths)
+    return out
+
+def clip_runs(runs, start, stop):
+    (starts, ends, values) = runs
+    keep = (ends > start) & (starts < stop)
+    starts = numpy.clip(starts[keep], start, stop) - start
+    ends = numpy.clip(ends[keep], start, stop) - start
+    return (starts, ends, values[keep])
+
+def reverse_runs(runs, length):
+    (starts, ends, values) = runs
+    return (length - ends[::-1], length - starts[::-1], values[::-1])
+
+def encode_windows(codes, k):
+    # 2-bit value of every k long window.  windows are built by doubling, so
+    # this takes O(log k) passes over the codes instead of k.
+    count = len(codes) - k + 1
+    block = codes.astype(numpy.uint64)
+    kmers = numpy.zeros(count, dtype=numpy.uint64)
+    (span, pos) = (1, 0)
+    while True:
+        if k & span:
+            kmers <<= numpy.uint64(2 * span)
+            kmers |= block[pos:pos + count]
+            pos += span
+        if span * 2 > k:
+            break
+        doubled = block[:len(block) - span] << numpy.uint64(2 * span)
+        doubled |= block[span:]
+        (block, span) = (doubled, span * 2)
+    return kmers
+
+class PackedSequence(object):
+    __slots__ = ("_packed", "_length", "_ambiguous", "_lower", "info")
+
+    def __init__(self, packed, length, ambiguous, lower, info=None):
+        self._packed = packed
+        self._length = length
+        self._ambiguous = ambiguous
+        self._lower = lower
+        if not isinstance(info, SequenceInfo):
+            info = SequenceInfo(info)
+        self.info = info
+
+    @classmethod
+    def from_sequence(cls, sequence, **kw):
+        info = sequence.info.copy() if isinstance(sequence, Sequence) else SequenceInfo()
+        info.update(kw)
+        raw = numpy.frombuffer(sequence, dtype=numpy.uint8)
+        codes = EncodeTable[raw]
+        ambiguous = codes == NoCode
+        codes[ambiguous] = 0
+        lower = (raw >= ord('a')) & ~ambiguous
+        return cls(cls.pack_codes(codes), len(raw), find_runs(numpy.where(ambiguous, raw, 0)), find_runs(lower.view(numpy.uint8)), info)
+
+    @staticmethod
+    def pack_codes(codes):
+        pad = -len(codes) % 4
+        if pad:
+            codes = numpy.concatenate((codes, numpy.zeros(pad, dtype=numpy.uint8)))
+        quads = codes.reshape(-1, 4)
+        return (quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3]
+
+    def codes(self, start=0, stop=None):
+        stop = self._length if stop == None else stop
+        first = start // 4
+        packed = self._packed[first:(stop + 3) // 4]
+        codes = numpy.empty((len(packed), 4), dtype=numpy.uint8)
+        codes[:, 0] = packed >> 6
+        codes[:, 1] = (packed >> 4) & 0x3
+        codes[:, 2] = (packed >> 2) & 0x3
+        codes[:, 3] = packed & 0x3
+        offset = first * 4
+        return codes.ravel()[start - offset:stop - offset]
+
+    def ambiguous_mask(self):
+        mask = numpy.zeros(self._length, dtype=numpy.bool_)
+        (starts, ends, values) = self._ambiguous
+        return expand_runs((starts, ends, numpy.ones(len(values), dtype=numpy.bool_)), mask)
+
+    def to_array(self):
+        raw = DecodeTable[self.codes()]
+        (starts, ends, values) = self._lower
+        lower = numpy.zeros(self._length, dtype=numpy.uint8)
+        raw += expand_runs((starts, ends, numpy.repeat(numpy.uint8(ord('a') - ord('A')), len(values))), lower)
+        ambiguous = numpy.zeros(self._length, dtype=numpy.uint8)
+        expand_runs(self._ambiguous, ambiguous)
+        return numpy.where(ambiguous != 0, ambiguous, raw)
+
+    def __str__(self):
+        return self.to_array().tostring()
+
+    def to_sequence(self):
+        return Sequence(str(self), **self.info)
+    unpack = to_sequence
+
+    def copy(self, packed=None, length=None, ambiguous=None, lower=None, **kw):
+        info = self.info.copy()
+        info.update(kw)
+        if packed is None:
+            (packed, length, ambiguous, lower) = (self._packed, self._length, self._ambiguous, self._lower)
+        return self.__class__(packed, length, ambiguous, lower, info)
+
+    def __len__(self):
+        return self._length
+
+    def __repr__(self):
+        return "PackedSequence(%r, name=%r)" % (str(self), self.name)
+
+    def __eq__(self, other):
+        if isinstance(other, (PackedSequence, basestring)):
+            return str(self) == str(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            (start, stop, step) = idx.indices(self._length)
+        else:
+            if idx < 0:
+                idx += self._length
+            if not (0 <= idx < self._length):
+                raise IndexError("PackedSequence index out of range")
+            (start, stop, step) = (idx, idx + 1, 1)
+        if step != 1:
+            return self.from_sequence(str(self)[idx], **self.info)
+        stop = max(start, stop)
+        packed = self.pack_codes(self.codes(start, stop))
+        return self.copy(packed, stop - start, clip_runs(self._ambiguous, start, stop), clip_runs(self._lower, start, stop))
+
+    def get_name(self):
+        return self.info.get("name", "")
+
+    def set_name(self, name):
+        self.info["name"] = name
+    name = property(get_name, set_name)
+
+    def get_strand(self):
+        return self.info.get("strand", 1)
+
+    def set_strand(self, strand):
+        self.info["strand"] = strand
+    strand = property(get_strand, set_strand)
+
+    @property
+    def reverse(self):
+        packed = self.pack_codes(self.codes()[::-1])
+        return self.copy(packed, self._length, reverse_runs(self._ambiguous, self._length), reverse_runs(self._lower, self._length))
+
+    @property
+    def compliment(self):
+        # 2-bit codes are ordered ACGT, so the compliment of a code is 3 - code
+        (starts, ends, values) = self._ambiguous
+        return self.copy(~self._packed, self._length, (starts, ends, ComplimentArray[values]), self._lower)
+
+    @property
+    def reverse_compliment(self):
+        packed = self.pack_codes(3 - self.codes()[::-1])
+        (starts, ends, values) = reverse_runs(self._ambiguous, self._length)
+        ambiguous = (starts, ends, ComplimentArray[values])
+        return self.copy(packed, self._length, ambiguous, reverse_runs(self._lower, self._length), strand=-(self.strand))
+    rc = revcomp = reverse_compliment
+
+    @property
+    def gc_count(self):
+        # ambiguous bases and padding are stored as 'A' and never count
+        return int(GCByteTable[self._packed].sum(dtype=numpy.int64))
+
+    @property
+    def at_count(self):
+        return len(self) - self.gc_count
+
+    @property
+    def gc_content(self):
+        return self.gc_count / float(len(self))
+
+    @property
+    def at_content(self):
+        return self.at_count / float(len(self))
+
+    def gc_profile(self, window_size=10, step=1, ambiguous="count"):
+        codes = self.codes()
+        gc = (codes == 1) | (codes == 2)
+        called = ~self.ambiguous_mask()
+        return window_profile(gc & called, called, window_size, step, ambiguous)
+
+    def at_profile(self, window_size=10, step=1, ambiguous="count"):
+        codes = self.codes()
+        called = ~self.ambiguous_mask()
+        at = ((codes == 0) | (codes == 3)) & called
+        if ambiguous == "count":
+            at |= ~called
+        return window_profile(at, called, window_size, step, ambiguous)
+
+    def kmers(self, k, canonical=False):
+        # 2-bit encoded k-mers for every window free of ambiguous bases
+        if not (0 < k <= 32):
+            raise ValueError("k must be between 1 and 32, not %s" % k)
+        count = self._length - k + 1
+        if count <= 0:
+            return numpy.zeros(0, dtype=numpy.uint64)
+        codes = self.codes()
+        kmers = encode_windows(codes, k)
+        if canonical:
+            rc_kmers = encode_windows(3 - codes[::-1], k)[::-1]
+            kmers = numpy.minimum(kmers, rc_kmers)
+        if len(self._ambiguous[0]):
+            blocked = numpy.concatenate(([0], numpy.cumsum(self.ambiguous_mask())))
+            kmers = kmers[(blocked[k:] - blocked[:count]) == 0]
+        return kmers
+
+def random_bases(count, length, gc_median=0.5, gc_spread=0.1, rng=None):
+    # (count, length) uint8 array, each row has its own GC count drawn
+    # uniformly from gc_median +/- gc_spread
+    rng = rng if rng != None else numpy.random
     gc_low = int(math.ceil(max(0, gc_median - gc_spread) * length))
     gc_high = int(math.floor(min(1, gc_median + gc_spread) * length))
-    gc_count = random.randint(gc_low, gc_high)
-    gc_seq = [random.choice("GC") for idx in xrange(gc_count)]
-    at_seq = [random.choice("AT") for idx in xrange(length - gc_count)]
-    seq = gc_seq + at_seq
-    random.shuffle(seq)
-    seq = str.join('', seq)
+    gc_counts = rng.randint(gc_low, gc_high + 1, size=count)
+    is_gc = numpy.arange(length) < gc_counts[:, numpy.newaxis]
+    if length >= 4096:
+        for row in is_gc:
+            rng.shuffle(row)
+    else:
+        # many short rows, shuffle them all at once by sorting random keys
+        order = numpy.argsort(rng.random_sample((count, length)), axis=1)
+        is_gc = is_gc[numpy.arange(count)[:, numpy.newaxis], order]
+    choice = rng.randint(0, 2, size=(count, length))
+    gc = numpy.frombuffer("GC", dtype=numpy.uint8)
+    at = numpy.frombuffer("AT", dtype=numpy.uint8)
+    return numpy.where(is_gc, gc[choice], at[choice]).astype(numpy.uint8)
+
+def random_sequences(count, length, name=None, gc_median=0.5, gc_spread=0.1, rng=None, chunk_bases=1 << 22):
+    name = name if name != None else "random_sequence"
+    rows = max(1, chunk_bases // max(1, length))
+    serial = 0
+    while serial < count:
+        bases = random_bases(min(rows, count - serial), length, gc_median, gc_spread, rng)
+        for row in bases:
+            yield Sequence(row.tostring(), name="%s_%d" % (name, serial))
+            serial += 1
+
+def random_sequence(length, name=None, gc_median=0.5, gc_spread=0.1, rng=None):
+    seq = random_bases(1, length, gc_median, gc_spread, rng)[0].tostring()
     name = name if name != None else "random_sequence"
     return Sequence(seq, name=name)
 
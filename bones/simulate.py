@@ -0,0 +1,118 @@
+import numpy
+from . sequence import EncodeTable, DecodeTable, ComplimentArray, NoCode
+from . fast import FastA, FastQRecord, open_fast
+
+__all__ = ["ReadSimulator", "linear_quality_profile"]
+
+def linear_quality_profile(read_length, start=38, end=30):
+    # mean phred quality per cycle
+    return numpy.linspace(start, end, read_length)
+
+class ReadSimulator(object):
+    # paired-end reads in the style of wgsim: fragments are drawn uniformly
+    # from the references (weighted by length), read 1 comes off the
+    # fragment's forward strand and read 2 off the reverse, and either
+    # strand of the reference may be sequenced.
+    def __init__(self, read_length=150, insert_size=500, insert_stddev=50, error_rate=None, quality_profile=None, quality_stddev=3, seed=None):
+        self.read_length = read_length
+        self.insert_size = insert_size
+        self.insert_stddev = insert_stddev
+        # error_rate None draws errors from the simulated base qualities
+        self.error_rate = error_rate
+        if quality_profile == None:
+            quality_profile = linear_quality_profile(read_length)
+        self.quality_profile = numpy.asarray(quality_profile, dtype=numpy.float64)
+        if len(self.quality_profile) != read_length:
+            raise ValueError("quality_profile must have one entry per cycle (%d)" % read_length)
+        self.quality_stddev = quality_stddev
+        self.rng = numpy.random.RandomState(seed)
+        self._profile = numpy.rint(self.quality_profile).astype(numpy.int16)
+        self._noise = numpy.rint(self.rng.normal(0, quality_stddev, size=0x100)).astype(numpy.int16)
+        self._error_thresholds = (10 ** (-numpy.arange(0x100) / 10.0) * 0x10000).astype(numpy.uint32)
+
+    def load_references(self, references):
+        if isinstance(references, basestring):
+            references = FastA.iter(references)
+        refs = []
+        for ref in references:
+            if len(ref) < self.read_length:
+                continue
+            refs.append((ref.name, numpy.frombuffer(str(ref), dtype=numpy.uint8)))
+        if not refs:
+            raise ValueError("No reference is at least %d bases long" % self.read_length)
+        return refs
+
+    def qualities(self, count):
+        # per cycle mean plus rounded gaussian noise, looked up from a table
+        # with random bytes since drawing normals per base is slow
+        noise = self._noise[numpy.frombuffer(self.rng.bytes(count * self.read_length), dtype=numpy.uint8)]
+        quals = self._profile + noise.reshape(count, self.read_length)
+        return numpy.clip(quals, 2, 41).astype(numpy.uint8)
+
+    def add_errors(self, bases, quals):
+        # error probabilities in units of 1/65536, one per phred score
+        if self.error_rate == None:
+            thresholds = self._error_thresholds[quals]
+        else:
+            thresholds = int(self.error_rate * 0x10000)
+        draws = numpy.frombuffer(self.rng.bytes(bases.size * 2), dtype=numpy.uint16).reshape(bases.shape)
+        codes = EncodeTable[bases]
+        errors = (draws < thresholds) & (codes != NoCode)
+        # substitute one of the other three bases
+        shift = self.rng.randint(1, 4, size=errors.sum()).astype(numpy.uint8)
+        bases = bases.copy()
+        bases[errors] = DecodeTable[(codes[errors] + shift) % 4]
+        return bases
+
+    def fragments(self, ref, count):
+        length = len(ref)
+        inserts = numpy.rint(self.rng.normal(self.insert_size, self.insert_stddev, size=count)).astype(numpy.int64)
+        inserts = numpy.clip(inserts, self.read_length, length)
+        starts = (self.rng.random_sample(count) * (length - inserts + 1)).astype(numpy.int64)
+        cycles = numpy.arange(self.read_length)
+        read1 = ref[starts[:, numpy.newaxis] + cycles]
+        read2 = ComplimentArray[ref[(starts + inserts - 1)[:, numpy.newaxis] - cycles]]
+        # fragments from the reverse strand are read from the other end
+        flip = self.rng.randint(0, 2, size=count).astype(numpy.bool_)
+        (read1[flip], read2[flip]) = (read2[flip], read1[flip])
+        return (starts, inserts, read1, read2)
+
+    def simulate_batches(self, references, count, batch_size=100000):
+        # yields (names, read 1 bases, read 1 qualities, read 2 bases, read 2 qualities),
+        # bases and qualities are (reads, read_length) ASCII arrays
+        refs = self.load_references(references)
+        weights = numpy.array([len(seq) for (name, seq) in refs], dtype=numpy.float64)
+        weights /= weights.sum()
+        serial = 0
+        while serial < count:
+            batch = min(batch_size, count - serial)
+            picks = numpy.bincount(self.rng.choice(len(refs), size=batch, p=weights), minlength=len(refs))
+            for (ref_idx, ref_count) in enumerate(picks):
+                if not ref_count:
+                    continue
+                (name, ref) = refs[ref_idx]
+                (starts, inserts, read1, read2) = self.fragments(ref, ref_count)
+                (qual1, qual2) = (self.qualities(ref_count), self.qualities(ref_count))
+                read1 = self.add_errors(read1, qual1)
+                read2 = self.add_errors(read2, qual2)
+                names = ["%s_%d_%d_%x" % (name, start + 1, start + insert, serial + idx) for (idx, (start, insert)) in enumerate(zip(starts.tolist(), inserts.tolist()))]
+                serial += ref_count
+                yield (names, read1, qual1 + 33, read2, qual2 + 33)
+
+    def simulate(self, references, count, batch_size=100000):
+        # yields (read 1, read 2) FastQRecord pairs
+        for (names, read1, qual1, read2, qual2) in self.simulate_batches(references, count, batch_size):
+            for idx in xrange(len(names)):
+                yield (FastQRecord(names[idx] + "/1", read1[idx].tostring(), qual1[idx].tostring()),
+                       FastQRecord(names[idx] + "/2", read2[idx].tostring(), qual2[idx].tostring()))
+
+    def format_reads(self, names, mate, bases, quals):
+        (bases, quals) = (bases.tostring(), quals.tostring())
+        width = self.read_length
+        return str.join('', ["@%s/%d\n%s\n+\n%s\n" % (name, mate, bases[idx * width:(idx + 1) * width], quals[idx * width:(idx + 1) * width]) for (idx, name) in enumerate(names)])
+
+    def write(self, references, r1fn, r2fn, count, batch_size=100000):
+        with open_fast(r1fn, 'w') as r1, open_fast(r2fn, 'w') as r2:
+            for (names, read1, qual1, read2, qual2) in self.simulate_batches(references, count, batch_size):
+                r1.write(self.format_reads(names, 1, read1, qual1))
+                r2.write(self.format_reads(names, 2, read2, qual2))
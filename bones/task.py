@@ -1,6 +1,8 @@
 import os
 import uuid
 from celery import Celery, Task
+from . cache import CachedStage
+from . instrument import InstrumentedStage
 
 __all__ = ["app", "Context", "BoneTask"]
 
@@ -50,7 +52,7 @@ class Context(dict):
         self.clear()
         self.init(ctxt)
 
-class ContextualizedTask(Task):
+class ContextualizedTask(Task, CachedStage, InstrumentedStage):
     context = None
 
     def bind_context(self, context):
@@ -64,7 +66,7 @@ class ContextualizedTask(Task):
     def run(self, context=None, **kw):
         self.bind_context(Context(context))
         self.init()
-        ret = self._run(**kw)
+        ret = self.recorded_run(self.cached_run, **kw)
         context = self.unbind_context()
         ret = ret if ret != None else context
         return ret
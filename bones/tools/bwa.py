@@ -7,6 +7,8 @@ from .. utils import *
 from .. process import *
 from .. task import *
 from .. package import *
+from .. samfile import SortMemory
+from . import samtools
 
 __all__ = ["Index", "Align"]
 
@@ -121,14 +123,31 @@ class BWA_IndexTask(BoneTask):
 class BWA_AlignmentTask(BoneTask):
     Directories = ["alignment"]
     TaskName = "bwa_align"
+    Consumes = ["reference", "reads"]
+    Produces = ["fn_alignment"]
 
     def _init(self):
         self.reads = [symlink(fn, self.dir_reads) for fn in self.reads]
-        self.fn_alignment = os.path.join(self.dir_alignment, "alignment.sam")
+        # with sort_alignment set, bwa streams straight into samtools sort
+        # and no SAM is written
+        if self.context.get("sort_alignment", False):
+            self.fn_alignment = os.path.join(self.dir_alignment, "alignment.bam")
+        else:
+            self.fn_alignment = os.path.join(self.dir_alignment, "alignment.sam")
+
+    def cache_arguments(self):
+        return [self.context.get("sort_alignment", False)]
+
+    def output_files(self, existing=False):
+        files = super(BWA_AlignmentTask, self).output_files(existing)
+        if files != None and self.context.get("sort_alignment", False):
+            baifn = self.fn_alignment + ".bai"
+            if existing and not os.path.isfile(baifn):
+                return None
+            files["fn_alignment_index"] = [baifn]
+        return files
 
     def _run(self, *args, **kw):
-        #if not is_stale(self.reference, self.fn_alignment):
-        #   return
         cmdkw = {
             "prefix": self.reference,
             "reads": self.reads[0],
@@ -136,10 +155,30 @@ class BWA_AlignmentTask(BoneTask):
         if len(self.reads) > 1:
             cmdkw["mates"] = self.reads[1]
         cmdkw.update(kw)
-        align = bwa.Align(**cmdkw)
+        align = Align(**cmdkw)
+        if self.context.get("sort_alignment", False):
+            return self.run_sorted(align)
         with open(self.fn_alignment, 'w') as fh:
             align.run(stdout=fh, wait=True)
 
+    def run_sorted(self, align):
+        # leaves a sorted, indexed fn_alignment.  newer samtools index while
+        # sorting, older ones need a second pass over the BAM.
+        threads = max(0, (align.threads or 1) - 1)
+        tempfn_stem = os.path.join(self.dir_alignment, temp_filename())
+        sort = samtools.Sort(threads=threads, memory=self.context.get("sort_memory", SortMemory), temp_prefix=tempfn_stem, output=self.fn_alignment)
+        # asks the binary that will do the sort
+        write_index = samtools.sort_writes_index(sort.command_path)
+        if write_index:
+            (sort.write_index, sort.output) = (True, "%s##idx##%s.bai" % (self.fn_alignment, self.fn_alignment))
+        pipe = Pipe(align, sort)
+        pipe()
+        pipe.wait()
+        if not write_index:
+            index = samtools.Index(threads=threads, alignment=self.fn_alignment)
+            index.run(wait=True)
+            index.assert_return_code()
+
 class PackageBWA(Package):
     PackageName = "bwa"
     Depends = {
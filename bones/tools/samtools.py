@@ -0,0 +1,33 @@
+import re
+
+from .. utils import *
+from .. process import *
+
+__all__ = ["Sort", "Index", "sort_writes_index"]
+
+def sort_writes_index(command_path="samtools"):
+    # samtools sort can write the index as it goes from 1.10 on.  the
+    # version is asked once per binary, see process.command_version().
+    match = re.match(r"(\d+)\.(\d+)", command_version(command_path, ["--version"]))
+    return match != None and (int(match.group(1)), int(match.group(2))) >= (1, 10)
+
+class Sort(Process):
+    Command = "samtools"
+    Arguments = [
+        ProcessArgument(name="samtools_module", type=str, default="sort", required=True, help="samtools module name"),
+        ProcessArgument(name="threads", argument="-@", type=int, help="Number of additional threads"),
+        ProcessArgument(name="memory", argument="-m", type=str, help="Memory per thread"),
+        ProcessArgument(name="temp_prefix", argument="-T", type=str, help="Prefix of temporary files"),
+        ProcessArgument(name="output_format", argument="-O", type=str, default="bam", required=True, help="Output format"),
+        ProcessArgument(name="write_index", argument="--write-index", type=bool, default=False, help="Index the output while writing it (samtools 1.10+)"),
+        ProcessArgument(name="output", argument="-o", type=str, required=True, help="Path to the sorted output"),
+        ProcessArgument(name="alignment", type=str, default="-", required=True, help="Alignments to sort, - for stdin"),
+    ]
+
+class Index(Process):
+    Command = "samtools"
+    Arguments = [
+        ProcessArgument(name="samtools_module", type=str, default="index", required=True, help="samtools module name"),
+        ProcessArgument(name="threads", argument="-@", type=int, help="Number of additional threads"),
+        ProcessArgument(name="alignment", type=str, required=True, help="Path to the sorted BAM"),
+    ]
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+import unittest
+import random
+from bones.sequence import Sequence
+from bones.align import *
+
+class TestDiffAlign(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(3)
+        self.reference = str.join('', [rng.choice("ACGT") for idx in xrange(2000)])
+
+    def test_identical(self):
+        aln = diff_align(self.reference, self.reference)
+        self.assertEquals(aln.cigar, "2000M")
+        self.assertEquals(aln.match_count, 2000)
+        self.assertEquals(aln.edit_distance, 0)
+        self.assertEquals(aln.score, 4000)
+
+    def test_mismatch(self):
+        ref = self.reference
+        query = ref[:500] + ("A" if ref[500] != "A" else "C") + ref[501:]
+        aln = diff_align(query, ref)
+        self.assertEquals(aln.cigar, "2000M")
+        self.assertEquals((aln.match_count, aln.mismatch_count), (1999, 1))
+
+    def test_substitutions(self):
+        # a single substitution is one mismatch, never an insertion and a
+        # deletion around some matches
+        rng = random.Random(5)
+        for trial in xrange(500):
+            ref = str.join('', [rng.choice("ACGT") for idx in xrange(30)])
+            pos = rng.randrange(len(ref))
+            query = ref[:pos] + rng.choice([base for base in "ACGT" if base != ref[pos]]) + ref[pos + 1:]
+            aln = diff_align(query, ref)
+            self.assertEquals(aln.cigar, "30M")
+            self.assertEquals((aln.match_count, aln.mismatch_count), (29, 1))
+        aln = diff_align("CAAAAC", "AAACA")
+        self.assertEquals(aln.edit_distance, 3)
+        self.assertEquals(aln.match_count + aln.mismatch_count + aln.deletion_count, 5)
+
+    def test_indels(self):
+        ref = self.reference
+        query = ref[:700] + "TTT" + ref[700:1200] + ref[1205:]
+        aln = diff_align(query, ref)
+        self.assertEquals((aln.insertion_count, aln.deletion_count), (3, 5))
+        self.assertEquals(aln.mismatch_count, 0)
+        self.assertEquals(aln.match_count, len(ref) - 5)
+        self.assertEquals(aln.edit_distance, 8)
+        self.assertEquals([op for (op, length) in aln.cigar_ops], ['M', 'I', 'M', 'D', 'M'])
+
+    def test_max_distance(self):
+        ref = self.reference
+        query = ref[:1000] + ref[1050:]
+        self.assertEquals(diff_align(query, ref, max_distance=10), None)
+        self.assertEquals(diff_align(query, ref, max_distance=50).deletion_count, 50)
+
+    def test_sequence_report(self):
+        ref = Sequence("ACGTACGTAC", name="ref")
+        query = Sequence("ACGTTACGTAC", name="query")
+        aln = diff_align(query, ref)
+        self.assertTrue(aln.reference is ref)
+        self.assertEquals(aln.cigar, "4M1I6M")
+        lines = aln.alignment_report().splitlines()
+        self.assertEquals(lines[2:], ["ref   ACGT-ACGTAC", "      |||| ||||||", "query ACGTTACGTAC"])
+
+    def test_common_prefix(self):
+        self.assertEquals(common_prefix_length("A" * 1000 + "C", "A" * 1000 + "G"), 1000)
+        self.assertEquals(common_prefix_length("GACGT", "ACGA", 1, 0), 3)
+        self.assertEquals(common_prefix_length("", "ACGT"), 0)
+
+if __name__ == '__main__':
+    unittest.main()
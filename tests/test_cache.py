@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+import unittest
+import tempfile
+import shutil
+import time
+import sys
+import os
+from bones.cache import *
+
+class UpperStage(CachedStage):
+    Consumes = ["fn_input"]
+    Produces = ["fn_output"]
+
+    def __init__(self, context):
+        self.context = context
+        self.runs = 0
+
+    def _run(self, suffix=''):
+        self.runs += 1
+        with open(self.context["fn_input"]) as fh:
+            text = fh.read().upper()
+        with open(self.context["fn_output"], 'w') as fh:
+            fh.write(text + suffix)
+
+class TestStageCache(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tempdir, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, name, text):
+        fn = os.path.join(self.tempdir, name)
+        with open(fn, 'w') as fh:
+            fh.write(text)
+        return fn
+
+    def read(self, fn):
+        with open(fn) as fh:
+            return fh.read()
+
+    def test_key(self):
+        cache = StageCache(self.cache_dir)
+        (one, two, other) = (self.write("one", "acgt"), self.write("two", "acgt"), self.write("other", "tgca"))
+        key = cache.key("stage", "1.0", ["-t", 4], {"fn_input": [one]})
+        # only the contents count, not where they are
+        self.assertEquals(cache.key("stage", "1.0", ["-t", 4], {"fn_input": [two]}), key)
+        self.assertNotEquals(cache.key("stage", "1.0", ["-t", 4], {"fn_input": [other]}), key)
+        self.assertNotEquals(cache.key("stage", "1.1", ["-t", 4], {"fn_input": [one]}), key)
+        self.assertNotEquals(cache.key("stage", "1.0", ["-t", 8], {"fn_input": [one]}), key)
+        self.assertEquals(file_digest(one), cache.digest(one))
+        # remembered between instances
+        self.assertTrue(os.path.abspath(one) in StageCache(self.cache_dir).digests())
+
+    def test_store_restore(self):
+        cache = StageCache(self.cache_dir)
+        outputs = {"fn_output": [self.write("out.txt", "ACGT")], "fn_index": [self.write("out.idx", "0")]}
+        cache.store("abc", outputs)
+        self.assertFalse(cache.restore("missing", outputs))
+        targets = {"fn_output": [os.path.join(self.tempdir, "restored.txt")], "fn_index": [os.path.join(self.tempdir, "restored.idx")]}
+        self.assertTrue(cache.restore("abc", targets))
+        self.assertEquals(self.read(targets["fn_output"][0]), "ACGT")
+        self.assertEquals(self.read(targets["fn_index"][0]), "0")
+        self.assertFalse(cache.restore("abc", {"fn_output": targets["fn_output"]}))
+        self.assertEquals(cache.size(), 5)
+
+    def test_eviction(self):
+        cache = StageCache(self.cache_dir, max_bytes=25)
+        for name in "abc":
+            cache.store(name, {"fn_output": [self.write(name, name * 10)]})
+            time.sleep(0.01)
+        self.assertEquals(sorted([entry[2] for entry in cache.entries()]), ["b", "c"])
+        # a hit makes b the most recently used
+        cache.fetch("b")
+        cache.store("d", {"fn_output": [self.write("d", "d" * 10)]})
+        self.assertEquals(sorted([entry[2] for entry in cache.entries()]), ["b", "d"])
+
+    def test_stage(self):
+        context = {"fn_input": self.write("in.txt", "acgt"), "fn_output": os.path.join(self.tempdir, "out.txt"), "dir_cache": self.cache_dir}
+        stage = UpperStage(context)
+        stage.cached_run()
+        self.assertEquals(stage.runs, 1)
+        os.unlink(context["fn_output"])
+        stage.cached_run()
+        self.assertEquals(stage.runs, 1)
+        self.assertEquals(self.read(context["fn_output"]), "ACGT")
+        # other arguments or inputs run again
+        stage.cached_run(suffix="!")
+        self.assertEquals(stage.runs, 2)
+        self.write("in.txt", "ttt")
+        stage.cached_run()
+        self.assertEquals((stage.runs, self.read(context["fn_output"])), (3, "TTT"))
+        # nothing is cached without a dir_cache
+        del context["dir_cache"]
+        stage.cached_run()
+        self.assertEquals(stage.runs, 4)
+
+    def test_source_digest(self):
+        # a stage's version follows the source of its package
+        for (name, source) in (("pkg_one", "x = 1\n"), ("pkg_two", "x = 2\n")):
+            os.makedirs(os.path.join(self.tempdir, name, "sub"))
+            for (fn, text) in (("__init__.py", ""), ("mod.py", source), ("sub/__init__.py", ""), ("sub/other.py", "y = 1\n")):
+                with open(os.path.join(self.tempdir, name, fn), 'w') as fh:
+                    fh.write(text)
+        sys.path.insert(0, self.tempdir)
+        try:
+            for name in ("pkg_one", "pkg_two"):
+                __import__(name + ".mod")
+            self.assertEquals(source_digest("pkg_one.mod"), source_digest("pkg_one"))
+            self.assertNotEquals(source_digest("pkg_one.mod"), source_digest("pkg_two.mod"))
+        finally:
+            sys.path.remove(self.tempdir)
+        self.assertEquals(UpperStage({}).version(), "source %s" % source_digest(UpperStage.__module__))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,11 +4,15 @@ import unittest
 import os
 import tempfile
 import shutil
+import json
+import random
+import pysam
 
 from bones import *
 from bones.sequence import random_sequence
 from bones.utils import temp_filename
 from bones.fast import FastA
+import numpy
 
 class TestConsensus(unittest.TestCase):
     def setUp(self):
@@ -49,5 +53,271 @@ class TestConsensus(unittest.TestCase):
         for seq in con.call_samfile(samf.samf):
             self.assertTrue(self.references[seq.name], seq)
 
+class TestVectorConsensus(unittest.TestCase):
+    # alignments are written directly with pysam, so no aligner is needed
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.bamfn = os.path.join(self.tempdir, "alignment.bam")
+        self.rng = random.Random(7)
+        rng = numpy.random.RandomState(7)
+        self.references = [random_sequence(3000, name="ref_1", rng=rng), random_sequence(400, name="ref_2", rng=rng)]
+        header = {"HD": {"VN": "1.0", "SO": "coordinate"}, "SQ": [{"SN": ref.name, "LN": len(ref)} for ref in self.references]}
+        reads = []
+        for (tid, ref) in enumerate(self.references):
+            # leave a hole with no reads in the middle of ref_1
+            for pos in range(0, len(ref) - 250, 4):
+                if 1200 <= pos < 1600:
+                    continue
+                reads += self.fake_pair(tid, str(ref), pos)
+        reads.sort(key=lambda read: (read.reference_id, read.reference_start))
+        bamf = pysam.AlignmentFile(self.bamfn, "wb", header=header)
+        map(bamf.write, reads)
+        bamf.close()
+        pysam.index(self.bamfn)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def fake_read(self, tid, ref, pos, name, flag):
+        rng = self.rng
+        length = rng.choice([100, 120])
+        seq = list(ref[pos:pos + length])
+        for idx in range(len(seq)):
+            if rng.random() < 0.01:
+                seq[idx] = rng.choice("ACGTN")
+        variant = rng.random()
+        if variant < 0.1:
+            # deletion
+            (seq, cigar) = (seq[:50] + seq[52:], [(0, 50), (2, 2), (0, length - 52)])
+        elif variant < 0.15:
+            # insertion
+            (seq, cigar) = (seq[:50] + list("GA") + seq[50:], [(0, 50), (1, 2), (0, length - 50)])
+        elif variant < 0.18:
+            # spliced
+            (seq, cigar) = (seq[:40] + seq[43:], [(0, 40), (3, 3), (0, length - 43)])
+        elif variant < 0.2:
+            (seq, cigar) = (list("TT") + seq, [(4, 2), (0, length)])
+        else:
+            cigar = [(0, length)]
+        # every plain read of ref_1 carries these, so they win their columns
+        for (var_pos, var_op) in ((1000, 1), (2000, 2), (2500, 3)):
+            if len(cigar) > 1 or tid or not (pos < var_pos < pos + length - 3):
+                continue
+            anchor = var_pos - pos
+            if var_op == 1:
+                (seq, cigar) = (seq[:anchor] + list("CC") + seq[anchor:], [(0, anchor), (1, 2), (0, length - anchor)])
+            else:
+                (seq, cigar) = (seq[:anchor] + seq[anchor + 2:], [(0, anchor), (var_op, 2), (0, length - anchor - 2)])
+        read = pysam.AlignedSegment()
+        read.query_name = name
+        read.query_sequence = str.join('', seq)
+        read.flag = flag
+        if rng.random() < 0.03:
+            read.flag |= rng.choice([0x100, 0x200, 0x400])
+        read.reference_id = tid
+        read.reference_start = pos
+        read.mapping_quality = rng.choice([60, 60, 60, 60, 10])
+        read.cigartuples = cigar
+        read.query_qualities = pysam.qualitystring_to_array(str.join('', [chr(33 + rng.randint(5, 40)) for base in seq]))
+        return read
+
+    def fake_pair(self, tid, ref, pos):
+        name = "read_%d_%d" % (tid, pos)
+        mate_pos = pos + self.rng.randint(20, 120)
+        read1 = self.fake_read(tid, ref, pos, name, 0x1 | 0x2 | 0x20 | 0x40)
+        read2 = self.fake_read(tid, ref, mate_pos, name, 0x1 | 0x2 | 0x10 | 0x80)
+        (read1.next_reference_id, read1.next_reference_start) = (tid, mate_pos)
+        (read2.next_reference_id, read2.next_reference_start) = (tid, pos)
+        read1.template_length = read2.reference_end - pos
+        read2.template_length = -read1.template_length
+        return [read1, read2]
+
+    def call(self, caller):
+        samf = pysam.AlignmentFile(self.bamfn, "rb")
+        results = []
+        for seq in caller.call_samfile(samf):
+            results.append((seq.name, str(seq), dict(caller.call_type_hist), caller.coverage))
+        return results
+
+    def test_matches_pileup_consensus(self):
+        expected = self.call(consensus.Consensus())
+        self.assertEquals(expected[0][2]["DL"], 2)
+        self.assertEquals(expected[0][2]["RS"], 2)
+        ref = str(self.references[0])
+        self.assertTrue(ref[990:1000] + "CC" + ref[1000:1010] in expected[0][1])
+        for region_size in (None, 500):
+            results = self.call(consensus.VectorConsensus(region_size=region_size))
+            self.assertEquals([res[0] for res in results], ["ref_1_consensus", "ref_2_consensus"])
+            for (res, exp) in zip(results, expected):
+                self.assertEquals(res[1], exp[1])
+                self.assertEquals(res[2], exp[2])
+                self.assertEquals(res[3]["column_count"], exp[3]["column_count"])
+                self.assertEquals(res[3]["min_coverage"], exp[3]["min_coverage"])
+                self.assertEquals(res[3]["max_coverage"], exp[3]["max_coverage"])
+                self.assertAlmostEquals(res[3]["avg_coverage"], exp[3]["avg_coverage"])
+
+    def test_parallel(self):
+        serial = list(consensus.VectorConsensus(region_size=700).iter_calls(self.bamfn))
+        caller = consensus.VectorConsensus(region_size=700, processes=2)
+        results = list(caller.iter_calls(self.bamfn))
+        self.assertEquals(len(results), 2)
+        for (res, exp) in zip(results, serial):
+            self.assertEquals((res[0].name, str(res[0])), (exp[0].name, str(exp[0])))
+            self.assertEquals(res[1], exp[1])
+            self.assertEquals(dict(res[2]), dict(exp[2]))
+        # stats come back as values, nothing is left on the caller
+        self.assertFalse(hasattr(caller, "coverage"))
+
+    def test_stream_calls(self):
+        fafn = os.path.join(self.tempdir, "consensus.fa")
+        statsfn = os.path.join(self.tempdir, "windows.jsonl")
+        caller = consensus.VectorConsensus(region_size=700)
+        expected = list(caller.iter_calls(self.bamfn))
+        summaries = caller.write_calls(self.bamfn, fafn, statsfn)
+        fa = FastA.load(fafn)
+        self.assertEquals([seq.name for seq in fa], [seq.name for (seq, coverage, hist) in expected])
+        self.assertEquals([str(seq) for seq in fa], [str(seq) for (seq, coverage, hist) in expected])
+        self.assertEquals([summary[1:] for summary in summaries], [exp[1:] for exp in expected])
+        with open(statsfn) as fh:
+            windows = [json.loads(line) for line in fh]
+        # 3000 bases in five windows, 400 in one
+        self.assertEquals([(win["reference"], win["start"]) for win in windows], [("ref_1", pos) for pos in range(0, 3000, 700)] + [("ref_2", 0)])
+        self.assertEquals(sum([win["column_count"] for win in windows[:5]]), expected[0][1]["column_count"])
+        self.assertEquals(sum([win["consensus_length"] for win in windows[:5]]), len(expected[0][0]))
+        self.assertEquals(windows[3]["consensus_start"], sum([win["consensus_length"] for win in windows[:3]]))
+
+    def test_count_store(self):
+        # the same reads split over two BAMs, added to the store one by one
+        samf = pysam.AlignmentFile(self.bamfn, "rb")
+        parts = [os.path.join(self.tempdir, "part_%d.bam" % idx) for idx in range(2)]
+        outs = [pysam.AlignmentFile(fn, "wb", template=samf) for fn in parts]
+        for read in samf:
+            outs[hash(read.query_name) % 2].write(read)
+        map(pysam.AlignmentFile.close, outs)
+        map(pysam.index, parts)
+        expected = list(consensus.VectorConsensus().iter_calls(self.bamfn))
+        storefn = os.path.join(self.tempdir, "counts")
+        store = consensus.CountStore(storefn)
+        store.add_samfile(parts[0])
+        self.assertRaises(ValueError, store.add_samfile, parts[0])
+        store.add_samfile(parts[1])
+        self.assertEquals(store.references, ("ref_1", "ref_2"))
+        for caller in (consensus.VectorConsensus(region_size=700), consensus.VectorConsensus(processes=2)):
+            results = list(caller.iter_calls(storefn))
+            self.assertEquals([(str(res[0]), res[1], dict(res[2])) for res in results], [(str(exp[0]), exp[1], dict(exp[2])) for exp in expected])
+        self.assertEquals(len(consensus.CountStore(storefn).sources), 2)
+
+    def test_count_store_interrupted(self):
+        storefn = os.path.join(self.tempdir, "counts")
+        store = consensus.CountStore(storefn)
+        store.add_samfile(self.bamfn)
+        before = sorted(os.listdir(storefn))
+        (counts, depth) = [numpy.array(array) for array in store.arrays("ref_1")]
+        count_region = consensus.count_region
+        calls = []
+        def failing_count_region(*args, **kw):
+            calls.append(args)
+            if len(calls) == 3:
+                raise RuntimeError("interrupted")
+            return count_region(*args, **kw)
+        bamfn = os.path.join(self.tempdir, "again.bam")
+        shutil.copy(self.bamfn, bamfn)
+        pysam.index(bamfn)
+        consensus.count_region = failing_count_region
+        try:
+            store = consensus.CountStore(storefn)
+            self.assertRaises(RuntimeError, store.add_samfile, bamfn, region_size=700)
+        finally:
+            consensus.count_region = count_region
+        # nothing of the failed add is left, in the store or on disk
+        store = consensus.CountStore(storefn)
+        self.assertEquals(sorted(os.listdir(storefn)), before)
+        self.assertEquals(len(store.sources), 1)
+        self.assertTrue(numpy.array_equal(store.arrays("ref_1")[0], counts))
+        self.assertTrue(numpy.array_equal(store.arrays("ref_1")[1], depth))
+        # the store is unchanged, so a retry counts every read once
+        store.add_samfile(bamfn, region_size=700)
+        store = consensus.CountStore(storefn)
+        self.assertTrue(numpy.array_equal(store.arrays("ref_1")[0], 2 * counts))
+        self.assertEquals(len(store.sources), 2)
+
+    def test_max_depth(self):
+        samf = pysam.AlignmentFile(self.bamfn, "rb")
+        full = consensus.count_region(samf, "ref_1", 0, 3000)
+        capped = consensus.count_region(samf, "ref_1", 0, 3000, max_depth=15)
+        self.assertTrue(full.counts.sum(axis=1).max() > 15)
+        self.assertTrue(capped.counts.sum(axis=1).max() <= 15)
+        # coverage is still the true depth
+        self.assertTrue(numpy.array_equal(capped.depth, full.depth))
+        again = consensus.count_region(samf, "ref_1", 0, 3000, max_depth=15)
+        self.assertTrue(numpy.array_equal(capped.counts, again.counts))
+        (seq, coverage, hist) = next(consensus.VectorConsensus(max_depth=15).iter_calls(self.bamfn))
+        (full_seq, full_coverage, full_hist) = next(consensus.VectorConsensus().iter_calls(self.bamfn))
+        self.assertEquals(coverage, full_coverage)
+        self.assertTrue(abs(len(seq) - len(full_seq)) < 10)
+
+    def test_missing_sequence(self):
+        samf = pysam.AlignmentFile(self.bamfn, "rb")
+        expected = consensus.count_region(samf, "ref_1", 0, 3000)
+        bamfn = os.path.join(self.tempdir, "no_seq.bam")
+        out = pysam.AlignmentFile(bamfn, "wb", template=samf)
+        for read in samf.fetch("ref_1"):
+            out.write(read)
+            if read.query_name == "read_0_100" and read.is_read1:
+                # a supplementary alignment stored with SEQ and QUAL as '*'
+                supplementary = pysam.AlignedSegment()
+                (supplementary.query_name, supplementary.flag) = (read.query_name, read.flag | 0x800)
+                (supplementary.reference_id, supplementary.reference_start) = (read.reference_id, read.reference_start)
+                (supplementary.mapping_quality, supplementary.cigartuples) = (60, [(0, 50)])
+                out.write(supplementary)
+        out.close()
+        pysam.index(bamfn)
+        region = consensus.count_region(pysam.AlignmentFile(bamfn, "rb"), "ref_1", 0, 3000)
+        self.assertTrue(numpy.array_equal(region.counts, expected.counts))
+        self.assertEquals(region.depth[100:150].tolist(), (expected.depth[100:150] + 1).tolist())
+
+    def test_call_types(self):
+        con = consensus.VectorConsensus(read_coverage_threshold=3)
+        counts = numpy.zeros((6, 7), dtype=numpy.int64)
+        counts[0, 0] = 5
+        counts[1, 5] = 5
+        counts[2, 6] = 5
+        counts[3, 2] = 2
+        counts[4, 1] = 3
+        depth = numpy.array([5, 5, 5, 2, 4, 0])
+        region = consensus.RegionCounts("ref", 0, 6, counts, depth, {4: {"CTT": 4}})
+        (seq, types) = con.call_region(region)
+        self.assertEquals(seq, "ACTT")
+        self.assertEquals([consensus.CallTypes[code] for code in types], ["CL", "DL", "RS", "LC", "CL"])
+        region.counts = numpy.zeros((6, 7), dtype=numpy.int64)
+        region.insertions = {}
+        (seq, types) = con.call_region(region)
+        self.assertEquals(seq, '')
+        self.assertEquals([consensus.CallTypes[code] for code in types], ["NC"] * 4 + ["NC"])
+
+    def test_insertion_calls(self):
+        # an insertion against deletions, skips and bases, winning, losing
+        # and tied, is called as the per column caller calls it.  ties go to
+        # whichever key its dict has last, so the counts go in in one order
+        con = consensus.VectorConsensus(read_coverage_threshold=3)
+        legacy = consensus.Consensus(read_coverage_threshold=3)
+        cases = [
+            ([("del", 5)], 6), ([("del", 6)], 6), ([("del", 7)], 6),
+            ([("refskip", 5)], 6), ([("refskip", 6)], 6),
+            ([("A", 3), ("del", 2)], 4), ([("A", 4)], 4), ([("C", 2), ("del", 2)], 2),
+        ]
+        for (column_counts, inserted) in cases:
+            counts = numpy.zeros((2, 7), dtype=numpy.int64)
+            counts[0, 0] = 10
+            for (name, count) in column_counts:
+                counts[1, consensus.CountColumns.index(name)] = count
+            depth = sum([count for (name, count) in column_counts]) + inserted
+            region = consensus.RegionCounts("ref", 0, 2, counts, numpy.array([10, depth]), {1: {"CTT": inserted}})
+            (seq, types) = con.call_region(region)
+            base_count = {"CTT": inserted}
+            base_count.update(column_counts)
+            (call, call_type) = legacy.call_pileup_column(1, depth, base_count)
+            self.assertEquals((seq, consensus.CallTypes[types[1]]), ("A" + call, call_type), (base_count, seq))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+import unittest
+import pickle
+from bones.context import *
+
+class TestContext(unittest.TestCase):
+    def setUp(self):
+        self.context = Context({
+            "dir_output": "/tmp/%(runid)s",
+            "dir_reads": "%(dir_output)s/reads",
+            "fn_reads": "%(dir_reads)s/reads.fq",
+            "runid": "run1",
+            "threads": 4,
+            "progress": "50%",
+        })
+
+    def test_resolve(self):
+        self.assertEqual(self.context["fn_reads"], "/tmp/run1/reads/reads.fq")
+        self.assertEqual(self.context.get("dir_reads"), "/tmp/run1/reads")
+        self.assertEqual(self.context.get("missing", "default"), "default")
+        self.assertEqual(self.context["threads"], 4)
+        self.assertEqual(self.context["progress"], "50%")
+
+    def test_invalidate(self):
+        self.assertEqual(self.context["fn_reads"], "/tmp/run1/reads/reads.fq")
+        self.context["runid"] = "run2"
+        self.assertEqual(self.context["fn_reads"], "/tmp/run2/reads/reads.fq")
+        self.context["dir_reads"] = "/data/%(runid)s"
+        self.assertEqual(self.context["fn_reads"], "/data/run2/reads.fq")
+        self.assertEqual(self.context["dir_output"], "/tmp/run2")
+        self.context.update(runid="run3")
+        self.assertEqual(self.context["fn_reads"], "/data/run3/reads.fq")
+        self.context.pop("runid")
+        self.assertRaises(ContextError, self.context.__getitem__, "fn_reads")
+        self.context.setdefault("runid", "run4")
+        self.assertEqual(self.context["fn_reads"], "/data/run4/reads.fq")
+
+    def test_errors(self):
+        self.context["runid"] = "%(fn_reads)s"
+        self.assertRaises(ContextError, self.context.__getitem__, "fn_reads")
+        self.assertRaises(ContextError, self.context.check)
+        self.context["runid"] = "%(nowhere)s"
+        self.assertRaises(ContextError, self.context.__getitem__, "dir_output")
+        self.context["runid"] = "run1"
+        self.context.check()
+        self.context["bad"] = "%(runid)s at 50%"
+        self.assertRaises(ContextError, self.context.__getitem__, "bad")
+
+    def test_pickle(self):
+        context = pickle.loads(pickle.dumps(self.context))
+        self.assertEqual(dict.__getitem__(context, "dir_reads"), "%(dir_output)s/reads")
+        context["runid"] = "run2"
+        self.assertEqual(context["fn_reads"], "/tmp/run2/reads/reads.fq")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+import unittest
+import tempfile
+import shutil
+import os
+import random
+import numpy
+import pysam
+from bones.coverage import *
+
+DEPTH_TEXT = \
+"""chr1\t2\t5
+chr1\t3\t5
+chr1\t4\t7
+chr2\t1\t1
+chr1\t6\t2
+"""
+
+class TestCoverageMap(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        rng = numpy.random.RandomState(3)
+        # runs of random length and depth, including zero coverage
+        runs = rng.randint(1, 40, size=300)
+        self.depth = numpy.repeat(rng.randint(0, 50, size=300), runs)
+        self.track = CoverageTrack.from_array("ref", self.depth)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_runs(self):
+        self.assertTrue(len(self.track.starts) <= 300)
+        self.assertEquals(self.track.starts.dtype, numpy.uint32)
+        self.assertTrue(numpy.array_equal(self.track.to_array(), self.depth))
+        self.assertTrue(numpy.array_equal(self.track.to_array(10, 50), self.depth[10:50]))
+        self.assertEquals(self.track.depth(77), self.depth[77])
+
+    def test_range_queries(self):
+        rng = random.Random(5)
+        track = self.track
+        for idx in range(500):
+            start = rng.randint(0, len(self.depth) - 1)
+            end = rng.randint(start + 1, len(self.depth))
+            window = self.depth[start:end]
+            self.assertEquals(track.sum(start, end), window.sum())
+            self.assertAlmostEquals(track.mean(start, end), window.mean())
+            self.assertEquals(track.min(start, end), window.min())
+            self.assertEquals(track.max(start, end), window.max())
+            self.assertAlmostEquals(track.fraction_at_least(20, start, end), (window >= 20).mean())
+        self.assertEquals(track.max(), self.depth.max())
+        # the per threshold sums are bounded
+        for threshold in range(50):
+            self.assertAlmostEquals(track.fraction_at_least(threshold), (self.depth >= threshold).mean())
+        self.assertEquals(len(track._at_least), track.MaxThresholds)
+        self.assertRaises(ValueError, track.mean, 10, 10)
+        self.assertRaises(ValueError, track.mean, 0, len(self.depth) + 1)
+
+    def test_save_load(self):
+        cmap = CoverageMap()
+        cmap.add_track(self.track)
+        cmap.add_track(CoverageTrack.from_array("empty", []))
+        cmap.add_track(CoverageTrack.from_array("flat", numpy.zeros(100)))
+        fn = os.path.join(self.tempdir, "coverage.bcov")
+        cmap.save(fn)
+        loaded = CoverageMap.load(fn)
+        self.assertEquals(loaded.keys(), ["ref", "empty", "flat"])
+        self.assertTrue(isinstance(loaded["ref"].starts, numpy.memmap))
+        self.assertTrue(numpy.array_equal(loaded["ref"].to_array(), self.depth))
+        self.assertEquals(len(loaded["empty"]), 0)
+        self.assertEquals(loaded.max("flat"), 0)
+        self.assertEquals(loaded.mean("ref", 5, 500), self.depth[5:500].mean())
+
+    def test_depth_file(self):
+        fn = os.path.join(self.tempdir, "depth.txt")
+        with open(fn, 'w') as fh:
+            fh.write(DEPTH_TEXT)
+        cmap = CoverageMap.from_depth_file(fn, lengths={"chr1": 8, "chr2": 3, "chr3": 4})
+        self.assertEquals(list(cmap["chr1"].to_array()), [0, 5, 5, 7, 0, 2, 0, 0])
+        self.assertEquals(list(cmap["chr2"].to_array()), [1, 0, 0])
+        self.assertEquals(cmap.max("chr3"), 0)
+        self.assertEquals(len(CoverageMap.from_depth_file(fn)["chr1"]), 6)
+
+    def test_samfile(self):
+        header = {"SQ": [{"SN": "ref", "LN": 300}]}
+        bamfn = os.path.join(self.tempdir, "alignment.bam")
+        bamf = pysam.AlignmentFile(bamfn, "wb", header=header)
+        expected = numpy.zeros(300, dtype=numpy.int64)
+        rng = random.Random(1)
+        for (idx, pos) in enumerate(sorted([rng.randint(0, 240) for idx in range(100)])):
+            read = pysam.AlignedSegment()
+            read.query_name = "read_%d" % idx
+            read.query_sequence = "A" * 50
+            read.flag = rng.choice([0, 0, 0, 0x400, 0x10])
+            read.reference_id = 0
+            read.reference_start = pos
+            read.mapping_quality = 60
+            read.cigartuples = rng.choice([[(0, 50)], [(0, 20), (2, 5), (0, 30)], [(4, 5), (0, 40), (1, 5)]])
+            read.query_qualities = pysam.qualitystring_to_array("I" * 50)
+            bamf.write(read)
+            # samtools depth counts aligned bases, not deletions
+            for (op, length) in read.cigartuples:
+                if op == 0 and not read.is_duplicate:
+                    expected[pos:pos + length] += 1
+                if op in (0, 2):
+                    pos += length
+        bamf.close()
+        pysam.index(bamfn)
+        cmap = CoverageMap.from_samfile(bamfn)
+        self.assertTrue(numpy.array_equal(cmap["ref"].to_array(), expected))
+
+if __name__ == '__main__':
+    unittest.main()
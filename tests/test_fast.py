@@ -5,8 +5,12 @@ import tempfile
 import shutil
 import os
 import json
+import gzip
+import numpy
+from cStringIO import StringIO
 from bones.sequence import *
 from bones.fast import *
+from bones.fast import ParseError
 
 FA_TEST = \
 """>seq1
@@ -15,6 +19,27 @@ AGTC
 AGTCAGTC
 """
 
+FA_WRAPPED = \
+""">seq1 first record
+AGTCA
+GGCCT
+TT
+>seq2 {"name": "seq2", "strand": -1}
+ACGTACGTAC
+>seq3
+"""
+
+FQ_TEST = \
+"""@read1/1
+AGTCN
++
+II#I!
+@read2/1 extra
+GGCC
++read2/1 extra
+ABCD
+"""
+
 class TestFastA(unittest.TestCase):
     def setUp(self):
         self.tempdir = tempfile.mkdtemp()
@@ -35,6 +60,104 @@ class TestFastA(unittest.TestCase):
         self.assertEquals(fa[1], "AGTCAGTC")
         self.assertEquals(fa[1].strand, -1)
 
+    def test_iter(self):
+        seqs = FastA.iter(self.fasta_paths["one"])
+        seq = next(seqs)
+        self.assertEquals(seq, "AGTC")
+        self.assertEquals(seq.name, "seq1")
+        seq = next(seqs)
+        self.assertTrue("_info_loader" in seq.__dict__)
+        self.assertEquals(seq.strand, -1)
+        self.assertFalse("_info_loader" in seq.__dict__)
+        self.assertRaises(StopIteration, next, seqs)
+
+    def test_stream_multiline(self):
+        lines = [">seq1\n", "AGTC\n", "\n", "GGCC\n", ">empty\n", ">seq2\n", "TT\n"]
+        seqs = list(FastA.stream(lines))
+        self.assertEquals(seqs, ["AGTCGGCC", "TT"])
+        self.assertEquals([seq.name for seq in seqs], ["seq1", "seq2"])
+        self.assertRaises(ParseError, list, FastA.stream(["AGTC\n"]))
+
+    def test_fai(self):
+        fafn = os.path.join(self.tempdir, "wrapped.fa")
+        with open(fafn, 'w') as fa:
+            fa.write(FA_WRAPPED)
+        index = FastAIndex.build(fafn)
+        self.assertEquals(index.keys(), ["seq1", "seq2", "seq3"])
+        self.assertEquals(tuple(index["seq1"]), ("seq1", 12, 19, 5, 6))
+        self.assertEquals(tuple(index["seq2"]), ("seq2", 10, 71, 10, 11))
+        self.assertEquals(index["seq3"].length, 0)
+        faifn = os.path.join(self.tempdir, "wrapped.fa.fai")
+        index.save(faifn)
+        self.assertEquals(FastAIndex.load(faifn), index)
+
+    def test_indexed_fetch(self):
+        fafn = os.path.join(self.tempdir, "wrapped.fa")
+        with open(fafn, 'w') as fa:
+            fa.write(FA_WRAPPED)
+        with IndexedFastA(fafn) as fa:
+            self.assertTrue(os.path.exists(fafn + ".fai"))
+            self.assertEquals(len(fa), 3)
+            self.assertEquals(fa.fetch("seq1"), "AGTCAGGCCTTT")
+            self.assertEquals(fa.fetch("seq1", 3, 11), "CAGGCCTT")
+            self.assertEquals(fa.fetch("seq1", 5, 100), "GGCCTTT")
+            self.assertEquals(fa.fetch("seq1").name, "seq1")
+            seq = fa.fetch("seq2", 2, 6)
+            self.assertEquals(seq, "GTAC")
+            self.assertEquals(seq.strand, -1)
+            self.assertEquals(fa.fetch("seq3"), "")
+            self.assertEquals(list(fa), list(FastA.iter(fafn)))
+            self.assertEquals([seq.name for seq in fa], ["seq1", "seq2"])
+
+    def test_no_trailing_newline(self):
+        fafn = os.path.join(self.tempdir, "unterminated.fa")
+        for (text, expected) in ((">s1\nACGT\nACGT", ["ACGTACGT"]), (">s1\nACGT\nACGT\n>s2\nAC\nGT", ["ACGTACGT", "ACGT"])):
+            with open(fafn, 'w') as fa:
+                fa.write(text)
+            if os.path.exists(fafn + ".fai"):
+                os.unlink(fafn + ".fai")
+            self.assertEquals([str(seq) for seq in FastA.iter(fafn)], expected)
+            with IndexedFastA(fafn) as fa:
+                self.assertEquals([str(seq) for seq in fa], expected)
+                self.assertEquals(fa.fetch("s1", 2, 6), "GTAC")
+        # only the last line may be short of its newline
+        with open(fafn, 'w') as fa:
+            fa.write(">s1\nACGT\nACGT\nACGT\r\n")
+        self.assertRaises(ParseError, FastAIndex.build, fafn)
+
+    def test_indexed_headers(self):
+        # a '>' in a JSON payload, and a payload name unlike the first word
+        fafn = os.path.join(self.tempdir, "headers.fa")
+        with open(fafn, 'w') as fa:
+            fa.write('>seq1 {"name": "other", "note": "a>b"}\nAGTC\n>seq2 {"note": ">"}\nGG\n')
+        for attempt in ("built", "loaded"):
+            with IndexedFastA(fafn) as fa:
+                self.assertEquals(fa.header("seq1"), '>seq1 {"name": "other", "note": "a>b"}\n')
+                self.assertEquals(fa.header("seq2"), '>seq2 {"note": ">"}\n')
+                self.assertEquals([(seq.name, seq.info["note"]) for seq in fa], [("seq1", "a>b"), ("seq2", ">")])
+
+    def test_writer(self):
+        fafn = os.path.join(self.tempdir, "written.fa")
+        with FastAWriter(fafn, width=5) as writer:
+            writer.write(Sequence("AGTCAGGCCT", name="seq1"))
+            writer.begin("seq2")
+            for bases in ("ACG", "TACGTA", '', "C"):
+                writer.write_bases(bases)
+            writer.flush()
+            # partial records are already on disk
+            with open(fafn) as fh:
+                self.assertTrue(fh.read().endswith(">seq2\nACGTA\nCGTAC"))
+            writer.begin("seq3", {"name": "seq3", "strand": -1})
+        with open(fafn) as fh:
+            lines = fh.read().splitlines()
+        self.assertEquals(lines[1:3], ["AGTCA", "GGCCT"])
+        self.assertEquals(lines[-1], '')
+        self.assertEquals([str(seq) for seq in FastA.load(fafn)], ["AGTCAGGCCT", "ACGTACGTAC"])
+        with IndexedFastA(fafn) as fa:
+            self.assertEquals(fa.fetch("seq2"), "ACGTACGTAC")
+            self.assertEquals(fa.fetch("seq3"), "")
+            self.assertEquals(fa.fetch("seq3").strand, -1)
+
     def test_save_strict(self):
         fa = FastA()
         seq = Sequence("AGTC", name="seq1")
@@ -62,5 +185,71 @@ class TestFastA(unittest.TestCase):
             line = fa.readline().strip()
             self.assertEquals("AGTC", line)
 
+class TestFastQ(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.fqfn = os.path.join(self.tempdir, "reads.fq")
+        with open(self.fqfn, 'w') as fq:
+            fq.write(FQ_TEST)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_load(self):
+        fq = FastQ.load(self.fqfn)
+        self.assertEquals(len(fq), 2)
+        self.assertEquals(fq[0].name, "read1/1")
+        self.assertEquals(fq[0].sequence, "AGTCN")
+        self.assertEquals(list(fq[0].phred), [40, 40, 2, 40, 0])
+        self.assertEquals(fq[1].name, "read2/1 extra")
+        self.assertEquals(fq[1].to_sequence().name, "read2/1 extra")
+
+    def test_qualities_zero_copy(self):
+        record = next(FastQ.iter(self.fqfn))
+        quals = record.qualities
+        self.assertEquals(quals.dtype, numpy.uint8)
+        self.assertFalse(quals.flags.owndata)
+        self.assertEquals(quals.tostring(), record.quality)
+
+    def test_batches(self):
+        batches = list(FastQ.iter_batches(self.fqfn, batch_size=1))
+        self.assertEquals([len(batch) for batch in batches], [1, 1])
+        batches = list(FastQ.iter_batches(self.fqfn, batch_size=10))
+        self.assertEquals([len(batch) for batch in batches], [2])
+
+    def test_gzip_roundtrip(self):
+        fq = FastQ.load(self.fqfn)
+        fqgz = os.path.join(self.tempdir, "reads.fq.gz")
+        fq.save(fqgz)
+        with open(fqgz, 'rb') as fh:
+            self.assertEquals(fh.read(2), "\x1f\x8b")
+        self.assertEquals(FastQ.load(fqgz), fq)
+
+    def test_bgzf_writer(self):
+        fq = FastQ.load(self.fqfn)
+        fqbgz = os.path.join(self.tempdir, "reads.fq.bgz")
+        fq.save(fqbgz)
+        with open(fqbgz, 'rb') as fh:
+            # gzip header with the BGZF "BC" extra subfield
+            self.assertEquals(fh.read(14)[12:], "BC")
+        self.assertEquals(FastQ.load(fqbgz), fq)
+
+    def test_multi_member_gzip(self):
+        # BGZF files are concatenated gzip members
+        fqgz = os.path.join(self.tempdir, "reads.fq.bgz")
+        records = FQ_TEST.splitlines(True)
+        with open(fqgz, 'wb') as fh:
+            for chunk in (records[:4], records[4:]):
+                buf = StringIO()
+                member = gzip.GzipFile(fileobj=buf, mode='wb')
+                member.write(str.join('', chunk))
+                member.close()
+                fh.write(buf.getvalue())
+        self.assertEquals(FastQ.load(fqgz), FastQ.load(self.fqfn))
+
+    def test_truncated(self):
+        lines = FQ_TEST.splitlines(True)[:6]
+        self.assertRaises(ParseError, list, FastQ.stream(lines))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import unittest
+import tempfile
+import shutil
+import threading
+import os
+from bones.instrument import *
+from bones.process import Process, ProcessArgument
+
+class SleepCommand(Process):
+    Command = "sleep"
+    Arguments = [
+        ProcessArgument(name="seconds", type=str, help="Seconds to sleep"),
+    ]
+
+class BusyStage(InstrumentedStage):
+    Name = "busy"
+
+    def __init__(self, context):
+        self.context = context
+
+    def _run(self, size=1 << 20, fail=False):
+        with open(os.path.join(self.context["dir_output"], "busy.out"), 'w') as fh:
+            fh.write('x' * size)
+        SleepCommand(seconds="0").run(wait=True)
+        if fail:
+            raise RuntimeError("failed")
+        return sum(xrange(10000))
+
+class TestInstrument(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_recorder(self):
+        with StageRecorder("sleep") as recorder:
+            cmd = SleepCommand(seconds="0.1")
+            cmd.run(wait=True)
+        record = recorder.record
+        self.assertEqual(cmd.proc.returncode, 0)
+        self.assertEqual(record["stage"], "sleep")
+        self.assertEqual(record["children"], 1)
+        self.assertEqual(record["status"], "ok")
+        self.assertFalse(record["overlapped"])
+        self.assertTrue(record["wall_seconds"] >= 0.1)
+        self.assertTrue(record["children_max_rss_kb"] > 0)
+        self.assertTrue(record["max_rss_kb"] > 0)
+
+    def test_overlapped(self):
+        started = threading.Event()
+        finish = threading.Event()
+        def other():
+            with StageRecorder("other"):
+                started.set()
+                finish.wait()
+        thread = threading.Thread(target=other)
+        thread.start()
+        started.wait()
+        with StageRecorder("sleep") as recorder:
+            SleepCommand(seconds="0").run(wait=True)
+        finish.set()
+        thread.join()
+        self.assertTrue(recorder.record["overlapped"])
+        # only the child waited on by this stage counts
+        self.assertEqual(recorder.record["children"], 1)
+
+    def test_report(self):
+        context = {"dir_output": self.tempdir, "runid": "run1", "profile": ["busy"]}
+        stage = BusyStage(context)
+        self.assertEqual(stage.recorded_run(stage._run, size=1 << 20), sum(xrange(10000)))
+        self.assertRaises(RuntimeError, stage.recorded_run, stage._run, fail=True)
+        records = read_report(os.path.join(self.tempdir, "reports", InstrumentedStage.ReportName))
+        self.assertEqual([record["status"] for record in records], ["ok", "error"])
+        self.assertEqual(records[0]["runid"], "run1")
+        self.assertEqual(records[0]["children"], 1)
+        self.assertTrue(records[0].get("wchar", records[0]["write_bytes"]) >= 1 << 20)
+        self.assertTrue(os.path.exists(records[0]["profile"]))
+        self.assertEqual(stage.run_record, records[1])
+        table = format_report(records).splitlines()
+        self.assertEqual(len(table), 3)
+        self.assertTrue(table[1].startswith("busy"))
+
+if __name__ == '__main__':
+    unittest.main()
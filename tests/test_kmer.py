@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+import unittest
+import tempfile
+import shutil
+import os
+import collections
+import numpy
+from bones.sequence import *
+from bones.fast import FastA, IndexedFastA
+from bones.kmer import *
+from bones.kmer import mix_hash
+
+def naive_counts(seqs, k):
+    counts = collections.Counter()
+    for seq in seqs:
+        for idx in xrange(len(seq) - k + 1):
+            kmer = seq[idx:idx + k].upper()
+            if set(kmer) <= set("ACGT"):
+                counts[canonical_kmer(kmer)] += 1
+    return counts
+
+class TestKmer(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.seqs = [random_sequence(500, name="seq_%d" % idx) for idx in xrange(10)]
+        self.seqs.append(Sequence("ACGTNNACGTacgtNACG", name="ambiguous"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def assertCounts(self, counter, k):
+        (kmers, counts) = counter.counts()
+        self.assertEquals(list(kmers), sorted(kmers))
+        expected = naive_counts(self.seqs, k)
+        self.assertEquals(dict(zip(map(int, kmers), map(int, counts))), dict(expected))
+
+    def test_encoding(self):
+        self.assertEquals(encode_kmer("ACGT"), 0b00011011)
+        self.assertEquals(decode_kmer(0b00011011, 4), "ACGT")
+        # AAC and GTT are reverse compliments
+        self.assertEquals(canonical_kmer("GTT"), encode_kmer("AAC"))
+
+    def test_sorted(self):
+        counter = KmerCounter(15, mode="sorted", chunk_size=1000)
+        counter.add_sequences(self.seqs)
+        self.assertCounts(counter, 15)
+        self.assertEquals(counter.count("ACGTACGTACGTACG"), 0)
+
+    def test_dense(self):
+        counter = KmerCounter(4)
+        self.assertEquals(counter.mode, "dense")
+        counter.add_sequences(self.seqs)
+        self.assertCounts(counter, 4)
+        self.assertEquals(counter.count("ACGT"), naive_counts(self.seqs, 4)[encode_kmer("ACGT")])
+
+    def test_batch_kmers(self):
+        # nothing across the record boundaries
+        seqs = ["ACGTA", "", "CCGTT", "AC", "GTNAC"]
+        expected = numpy.concatenate([sequence_kmers(seq, 3) for seq in seqs])
+        self.assertEquals(list(batch_kmers(seqs, 3)), list(expected))
+        self.assertEquals(len(batch_kmers(["AC", "GT"], 3)), 0)
+
+    def test_spill(self):
+        with KmerCounter(21, max_kmers=500, chunk_size=100, tempdir=self.tempdir) as counter:
+            counter.add_sequences(self.seqs[:5])
+            counter.add_sequences(self.seqs[5:])
+            self.assertTrue(counter.spill_dir != None)
+            self.assertCounts(counter, 21)
+            # merged once, then read as is
+            self.assertTrue(counter._spill_merged)
+            self.assertCounts(counter, 21)
+            kmer = str(self.seqs[0][:21])
+            self.assertEquals(counter.count(kmer), naive_counts(self.seqs, 21)[canonical_kmer(kmer)])
+            counter.add_sequences([self.seqs[0]])
+            self.assertEquals(counter.count(kmer), naive_counts(self.seqs, 21)[canonical_kmer(kmer)] + 1)
+        self.assertEquals(os.listdir(self.tempdir), [])
+
+    def test_fasta(self):
+        fafn = os.path.join(self.tempdir, "kmers.fa")
+        FastA(self.seqs).save(fafn)
+        counter = KmerCounter(11)
+        counter.add_fasta(fafn)
+        self.assertCounts(counter, 11)
+
+    def test_multiprocessing(self):
+        counter = count_kmers(self.seqs, 17, processes=2, chunk_bases=1000)
+        self.assertCounts(counter, 17)
+
+def naive_minimizers(seq, k, w):
+    hashes = [int(mix_hash(numpy.array([canonical_kmer(seq[idx:idx + k])], dtype=numpy.uint64))[0])
+        if set(seq[idx:idx + k].upper()) <= set("ACGT") else None for idx in xrange(len(seq) - k + 1)]
+    minimizers = set()
+    for idx in xrange(max(1, len(hashes) - w + 1)):
+        window = [value for value in hashes[idx:idx + w] if value != None]
+        if window:
+            minimizers.add(min(window))
+    return sorted(minimizers)
+
+class TestReferenceIndex(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.fafn = os.path.join(self.tempdir, "panel.fa")
+        self.refs = FastA([random_sequence(2000, name="construct_%d" % idx) for idx in xrange(20)])
+        self.refs.save(self.fafn, strict=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_minimizers(self):
+        for seq in [str(self.refs[0])[:300], "ACGTNNACGTacgtNACGTTGCAAGGCTAGCTTACGA", "ACGTACGTACGTACGTA", "ACG"]:
+            self.assertEquals(sequence_minimizers(seq, 5, 4).tolist(), naive_minimizers(seq, 5, 4))
+
+    def test_candidates(self):
+        index = ReferenceIndex.build(self.refs)
+        seq = str(self.refs[7])
+        # a fragment with a few substitutions, and the other strand
+        query = seq[100:800] + "A" + seq[801:1500] + "C" + seq[1501:1900]
+        self.assertEquals(index.candidates(query, 1)[0][0], "construct_7")
+        query = Sequence(seq[300:1200]).reverse_compliment
+        candidates = index.candidates(query, 3)
+        self.assertEquals(candidates[0][0], "construct_7")
+        self.assertTrue(all([candidates[0][1] > 10 * shared for (name, shared) in candidates[1:]]))
+        self.assertEquals(len(index.candidates(query, 3, min_shared=0)), 3)
+        self.assertEquals(index.candidates("NNNN" * 20), [])
+
+    def test_for_fasta(self):
+        index = ReferenceIndex.for_fasta(self.fafn)
+        index_fn = self.fafn + ".minimizers.npz"
+        self.assertTrue(os.path.exists(index_fn))
+        loaded = ReferenceIndex.load(index_fn)
+        self.assertEquals(loaded.names, [ref.name for ref in self.refs])
+        self.assertEquals(loaded.minimizers.tolist(), index.minimizers.tolist())
+        self.assertEquals(loaded.ref_ids.tolist(), index.ref_ids.tolist())
+        # other parameters rebuild the index
+        self.assertEquals(ReferenceIndex.for_fasta(self.fafn, k=11).k, 11)
+        self.assertEquals(ReferenceIndex.load(index_fn).k, 11)
+
+    def test_described_headers(self):
+        # named by the first word of the header, as IndexedFastA keys them
+        fafn = os.path.join(self.tempdir, "described.fa")
+        with open(fafn, 'w') as fh:
+            for ref in self.refs[:3]:
+                fh.write(">%s some description\n%s\n" % (ref.name, ref))
+        index = ReferenceIndex.for_fasta(fafn)
+        self.assertEquals(index.names, [ref.name for ref in self.refs[:3]])
+        (name, shared) = index.candidates(str(self.refs[1])[200:900], 1)[0]
+        with IndexedFastA(fafn) as fa:
+            self.assertEquals(fa.fetch(name), str(self.refs[1]))
+
+if __name__ == '__main__':
+    unittest.main()
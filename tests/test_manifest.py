@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import unittest
+import tempfile
+import shutil
+import time
+import os
+from bones.manifest import *
+
+class TestRunManifest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.fn_input = self.write("input.txt", "acgt")
+        self.fn_output = os.path.join(self.tempdir, "output.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, name, text):
+        fn = os.path.join(self.tempdir, name)
+        with open(fn, 'w') as fh:
+            fh.write(text)
+        return fn
+
+    def record_stage(self, manifest):
+        self.write("output.txt", "ACGT")
+        files = {"fn_input": [self.fn_input], "fn_output": [self.fn_output]}
+        return manifest.record("0", 0, "stage", "1", files, {"fn_output": self.fn_output}, ["scratch"])
+
+    def test_complete(self):
+        manifest = RunManifest(self.tempdir)
+        manifest.reset({"reads": [u"reads.fq"]})
+        self.assertTrue(self.record_stage(manifest))
+        manifest = RunManifest(self.tempdir)
+        self.assertTrue(manifest.matches({"reads": ["reads.fq"]}))
+        self.assertFalse(manifest.matches({"reads": ["other.fq"]}))
+        step = manifest.complete("0", "stage", "1")
+        self.assertNotEqual(step, None)
+        self.assertEqual(manifest.complete("0", "stage", "2"), None)
+        self.assertEqual(manifest.complete("1", "stage", "1"), None)
+        context = {"scratch": 1}
+        manifest.replay(step, context)
+        self.assertEqual(context, {"fn_output": self.fn_output})
+        self.assertTrue(isinstance(context["fn_output"], str))
+
+    def test_changed_files(self):
+        manifest = RunManifest(self.tempdir)
+        manifest.reset({})
+        self.record_stage(manifest)
+        # a later step rewriting the output leaves the first complete
+        time.sleep(0.01)
+        self.write("output.txt", "TGCA!")
+        manifest.record("1", 1, "rewrite", "1", {"fn_output": [self.fn_output]}, {}, [])
+        self.assertNotEqual(manifest.complete("0", "stage", "1"), None)
+        self.write("input.txt", "tttt!")
+        self.assertEqual(manifest.complete("0", "stage", "1"), None)
+        self.assertNotEqual(manifest.complete("1", "rewrite", "1"), None)
+        os.unlink(self.fn_output)
+        self.assertEqual(manifest.complete("1", "rewrite", "1"), None)
+        manifest.keep(["1"])
+        self.assertEqual(sorted(RunManifest(self.tempdir).data["steps"]), ["1"])
+
+    def test_unserializable(self):
+        manifest = RunManifest(self.tempdir)
+        manifest.reset({})
+        self.assertFalse(manifest.record("0", 0, "stage", "1", {}, {"handle": object()}, []))
+        self.assertEqual(manifest.complete("0", "stage", "1"), None)
+        self.assertEqual(json_values({"a": 1, "b": object(), "c": None}, ignore=["c"]), {"a": 1})
+
+    def test_context_changes(self):
+        before = {"fn_a": "a", "fn_b": "b", "keep": 1, "gone": 2}
+        after = {"fn_a": "a2", "fn_b": "b", "keep": 1, "handle": object()}
+        (changes, removed) = context_changes(before, after)
+        self.assertEqual((sorted(changes), removed), (["fn_a", "handle"], ["gone"]))
+        # only what the step Produces, so an object left behind by another
+        # step doesn't stop it being recorded
+        (changes, removed) = context_changes(before, after, ["fn_a", "fn_b"])
+        self.assertEqual((changes, removed), ({"fn_a": "a2"}, []))
+        manifest = RunManifest(self.tempdir)
+        manifest.reset({})
+        self.assertTrue(manifest.record("0", 0, "stage", "1", {}, changes, removed))
+
+if __name__ == '__main__':
+    unittest.main()
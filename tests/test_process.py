@@ -2,6 +2,8 @@
 
 import os
 import unittest
+import tempfile
+import shutil
 import time
 from bones.process import *
 
@@ -36,6 +38,8 @@ class TestProcess(unittest.TestCase):
         self.assertEquals(args[1:], ["-a", "1"])
         args = cmd.cli(arg2=True)
         self.assertEquals(args[1:], ["-a", "1", "-x"])
+        args = cmd.cli(arg2=False)
+        self.assertEquals(args[1:], ["-a", "1"])
 
     def test_attribute_interface(self):
         cmd = GenericCommand()
@@ -65,5 +69,22 @@ class TestProcess(unittest.TestCase):
         output = stdin_proc.stdout.read()
         self.assertEquals(output, "15\n")
 
+    def test_command_version(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            # like bwa, the version only in the usage on stderr
+            fn = os.path.join(tempdir, "tool")
+            with open(fn, 'w') as fh:
+                fh.write("#!/bin/sh\necho 'Program: tool\nVersion: 0.7.17-r1188' >&2\nexit 1\n")
+            os.chmod(fn, 0755)
+            self.assertEquals(command_version(fn, []), "0.7.17-r1188")
+            # asked once
+            with open(fn, 'w') as fh:
+                fh.write("#!/bin/sh\necho 'Version: 0.8'\n")
+            self.assertEquals(command_version(fn, []), "0.7.17-r1188")
+            self.assertEquals(command_version(os.path.join(tempdir, "missing")), "unknown")
+        finally:
+            shutil.rmtree(tempdir)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import unittest
+import tempfile
+import shutil
+import random
+import os
+import threading
+import pysam
+from bones.samfile import *
+
+class TestSamfile(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.samfn = os.path.join(self.tempdir, "alignment.sam")
+        header = {"HD": {"VN": "1.0"}, "SQ": [{"SN": "ref_1", "LN": 5000}, {"SN": "ref_2", "LN": 1000}]}
+        rng = random.Random(5)
+        with pysam.AlignmentFile(self.samfn, "w", header=header) as samf:
+            # written in no particular order
+            for idx in xrange(500):
+                read = pysam.AlignedSegment()
+                read.query_name = "read_%d" % idx
+                read.query_sequence = str.join('', [rng.choice("ACGT") for pos in xrange(50)])
+                read.query_qualities = pysam.qualitystring_to_array("I" * 50)
+                read.reference_id = rng.randint(0, 1)
+                read.reference_start = rng.randint(0, 900)
+                read.mapping_quality = 60
+                read.cigartuples = [(0, 50)]
+                samf.write(read)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_prepare_sam(self):
+        samfile = Samfile(self.samfn)
+        self.assertTrue(samfile.is_sam)
+        samfile.prepare(threads=2, memory="10M")
+        self.assertEquals(sorted(os.listdir(self.tempdir)), ["alignment.bam", "alignment.bam.bai", "alignment.sam"])
+        self.assertTrue(samfile.is_bam)
+        self.assertTrue(samfile.is_sorted)
+        reads = list(samfile.samf.fetch("ref_1"))
+        starts = [read.reference_start for read in reads]
+        self.assertEquals(starts, sorted(starts))
+        self.assertEquals(samfile.samf.mapped, 500)
+
+    def test_prepare_unsorted_bam(self):
+        bamfn = os.path.join(self.tempdir, "unsorted.bam")
+        with pysam.AlignmentFile(self.samfn) as samf:
+            with pysam.AlignmentFile(bamfn, "wb", template=samf) as bamf:
+                for read in samf:
+                    bamf.write(read)
+        tempdir = os.path.join(self.tempdir, "sort")
+        os.mkdir(tempdir)
+        samfile = Samfile(bamfn)
+        self.assertFalse(samfile.is_sorted)
+        samfile.prepare(tempdir=tempdir)
+        self.assertTrue(samfile.is_sorted)
+        self.assertTrue(os.path.exists(samfile.baifn))
+        self.assertEquals(os.listdir(tempdir), [])
+        self.assertEquals(samfile.samf.count("ref_2"), len([read for read in pysam.AlignmentFile(self.samfn) if read.reference_name == "ref_2"]))
+
+class TestHandlePool(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        header = {"HD": {"VN": "1.0", "SO": "coordinate"}, "SQ": [{"SN": "ref_1", "LN": 1000}]}
+        self.fns = [os.path.join(self.tempdir, "aln_%d.bam" % idx) for idx in xrange(4)]
+        for fn in self.fns:
+            self.write_bam(fn, header, 1)
+        self.pool = HandlePool(max_handles=2, stat_interval=60)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.tempdir)
+
+    def write_bam(self, fn, header, count):
+        with pysam.AlignmentFile(fn, "wb", header=header) as bamf:
+            for idx in xrange(count):
+                read = pysam.AlignedSegment()
+                (read.query_name, read.query_sequence, read.reference_id) = ("read_%d" % idx, "ACGT", 0)
+                (read.reference_start, read.cigartuples) = (idx, [(0, 4)])
+                bamf.write(read)
+
+    def test_reuse(self):
+        handle = self.pool.get(self.fns[0])
+        self.assertTrue(self.pool.get(os.path.relpath(self.fns[0])) is handle)
+        self.assertFalse(self.pool.get(self.fns[0], "r") is handle)
+
+    def test_lru(self):
+        handles = [self.pool.get(fn) for fn in self.fns[:2]]
+        # touching the first makes the second the oldest
+        self.pool.get(self.fns[0])
+        self.pool.get(self.fns[2])
+        self.assertEquals(len(self.pool), 2)
+        self.assertFalse(handles[0].closed)
+        self.assertTrue(handles[1].closed)
+        self.assertTrue(self.pool.get(self.fns[0]) is handles[0])
+
+    def test_stale(self):
+        handle = self.pool.get(self.fns[0])
+        self.write_bam(self.fns[0], handle.header.to_dict(), 3)
+        # the stat is cached for stat_interval
+        self.assertTrue(self.pool.get(self.fns[0]) is handle)
+        self.pool.stat_interval = 0
+        fresh = self.pool.get(self.fns[0])
+        self.assertTrue(handle.closed)
+        self.assertEquals(len(list(fresh.fetch(until_eof=True))), 3)
+
+    def test_threads(self):
+        # each thread has its own handles and only evicts those
+        handle = self.pool.get(self.fns[0])
+        (found, opened, done) = ({}, threading.Event(), threading.Event())
+        def other():
+            found["handles"] = [self.pool.get(fn) for fn in self.fns]
+            found["closed"] = handle.closed
+            opened.set()
+            done.wait()
+        thread = threading.Thread(target=other)
+        thread.start()
+        opened.wait()
+        self.assertFalse(found["closed"])
+        self.assertFalse(handle.closed)
+        self.assertFalse(found["handles"][0] is handle)
+        self.assertEquals(len(self.pool), 3)
+        # a running thread's handles are only marked
+        self.pool.invalidate(self.fns[3])
+        self.assertFalse(found["handles"][3].closed)
+        self.pool.invalidate(self.fns[0])
+        self.assertTrue(handle.closed)
+        done.set()
+        thread.join()
+        self.pool.invalidate()
+        self.assertTrue(all([other.closed for other in found["handles"]]))
+        self.assertEquals(len(self.pool), 0)
+
+    def test_fork(self):
+        handle = self.pool.get(self.fns[0])
+        pid = os.fork()
+        if not pid:
+            os._exit(0 if self.pool.get(self.fns[0]) is not handle and len(self.pool) == 1 else 1)
+        self.assertEquals(os.waitpid(pid, 0)[1], 0)
+        self.assertFalse(handle.closed)
+        self.assertTrue(self.pool.get(self.fns[0]) is handle)
+
+if __name__ == '__main__':
+    unittest.main()
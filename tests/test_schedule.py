@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import unittest
+import threading
+import time
+from bones.schedule import *
+
+class Stage(object):
+    def __init__(self, name, consumes=None, produces=None, delay=0, fail=False):
+        (self.Name, self.Consumes, self.Produces) = (name, consumes, produces)
+        (self.delay, self.fail) = (delay, fail)
+
+class TestSchedule(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.active = 0
+        self.max_active = 0
+
+    def run_stage(self, stage):
+        with self.lock:
+            self.events.append(("start", stage.Name))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(stage.delay)
+        with self.lock:
+            self.active -= 1
+            self.events.append(("end", stage.Name))
+        if stage.fail:
+            raise RuntimeError(stage.Name)
+
+    def assertBefore(self, first, second):
+        self.assertTrue(self.events.index(("end", first)) < self.events.index(("start", second)))
+
+    def test_dependencies(self):
+        stages = [
+            Stage("fastqc", ["fn_reads"], ["dir_qc"]),
+            Stage("bwa_index", ["fn_reference"], ["bwa_index"]),
+            Stage("megahit", ["fn_reads"], ["dir_assembly"]),
+            Stage("bwa_align", ["fn_reference", "fn_reads", "bwa_index"], ["fn_alignment"]),
+            Stage("prepare", ["fn_alignment"], ["fn_alignment"]),
+            Stage("consensus", ["fn_reference", "fn_alignment"], ["fn_consensus"]),
+            # rewrites what consensus reads
+            Stage("rewrite", [], ["fn_alignment"]),
+        ]
+        deps = stage_dependencies(stages)
+        self.assertEquals(deps, [set(), set(), set(), set([1]), set([3]), set([4]), set([4, 5])])
+
+    def test_barrier(self):
+        stages = [Stage("a", [], ["x"]), Stage("b", [], ["y"]), Stage("undeclared"), Stage("c", ["x"], [])]
+        self.assertEquals(stage_dependencies(stages), [set(), set(), set([0, 1]), set([2])])
+
+    def test_concurrent(self):
+        stages = [Stage(name, ["in"], [name], delay=0.2) for name in "abc"]
+        stages.append(Stage("d", ["a", "b", "c"], ["d"]))
+        start = time.time()
+        run_graph(stages, self.run_stage, concurrency=3)
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEquals(self.max_active, 3)
+        for name in "abc":
+            self.assertBefore(name, "d")
+
+    def test_concurrency_limit(self):
+        stages = [Stage(name, [], [name], delay=0.05) for name in "abcd"]
+        run_graph(stages, self.run_stage, concurrency=2)
+        self.assertEquals(self.max_active, 2)
+        self.assertEquals(len(self.events), 8)
+
+    def test_failure(self):
+        stages = [Stage("a", [], ["x"], fail=True), Stage("b", [], ["y"], delay=0.1), Stage("c", ["x"], [])]
+        self.assertRaises(RuntimeError, run_graph, stages, self.run_stage, 2)
+        # b was already running and finished, c never started
+        self.assertTrue(("end", "b") in self.events)
+        self.assertFalse(("start", "c") in self.events)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
 import unittest
+import copy
+import pickle
+import numpy
 from bones.sequence import *
 
 class TestSequence(unittest.TestCase):
@@ -55,5 +58,166 @@ class TestSequence(unittest.TestCase):
         gc_content = seq.gc_window(4)
         self.assertEquals(list(gc_content), answer)
 
+    def test_gc_profile(self):
+        seq = Sequence("GGGGAGAGTTTT")
+        profile = seq.gc_profile(4)
+        self.assertEquals(list(profile), [1, .75, .75, .5, .5, .5, .25, .25, 0])
+        self.assertEquals(list(seq.gc_profile(4, step=3)), [1, .5, .25])
+        self.assertEquals(list(seq.at_profile(4, step=4)), [0, .5, 1])
+        self.assertEquals(list(seq.gc_profile(20)), [.5])
+        self.assertEquals(list(seq.pack().gc_profile(4)), list(profile))
+        for window_size in (0, -1, 2.5):
+            self.assertRaises(ValueError, seq.gc_profile, window_size)
+            self.assertRaises(ValueError, seq.pack().gc_profile, window_size)
+        self.assertRaises(ValueError, seq.at_profile, 4, 0)
+
+    def test_gc_profile_ambiguous(self):
+        seq = Sequence("GCNNATNNNN")
+        self.assertEquals(list(seq.gc_profile(4, step=2)), [.5, 0, 0, 0])
+        profile = seq.gc_profile(4, step=2, ambiguous="skip")
+        self.assertEquals(list(profile[:3]), [1, 0, 0])
+        self.assertTrue(numpy.isnan(profile[3]))
+        self.assertEquals(list(seq.at_profile(4, step=2, ambiguous="skip"))[:3], [0, 1, 1])
+        self.assertRaises(ValueError, seq.gc_profile, 4, ambiguous="bogus")
+
+class TestSequenceView(unittest.TestCase):
+    def test_view(self):
+        seq = Sequence("AGTGCGATGT", name="parent")
+        view = seq.view(2, 6)
+        self.assertTrue(isinstance(view, SequenceView))
+        self.assertEquals(view, "TGCG")
+        self.assertEquals(len(view), 4)
+        self.assertEquals(view[1], "G")
+        self.assertEquals(view[1:3], "GC")
+        self.assertEquals(view.buffer.tobytes(), "TGCG")
+        self.assertEquals(view.gc_count, 3)
+        self.assertEquals(view.rc, "CGCA")
+        self.assertEquals(view.lower(), "tgcg")
+        self.assertTrue("GC" in view)
+        self.assertFalse("AG" in view)
+
+    def test_info_copy_on_write(self):
+        seq = Sequence("AGTGCGATGT", name="parent")
+        view = seq.view(2, 6)
+        self.assertEquals(view.name, "parent")
+        self.assertTrue(view._info is None)
+        view.name = "child"
+        self.assertEquals(view.name, "child")
+        self.assertEquals(seq.name, "parent")
+        subview = view[1:3]
+        self.assertEquals(subview.name, "child")
+        view.info["strand"] = -1
+        self.assertEquals(seq.strand, 1)
+
+    def test_materialize(self):
+        seq = Sequence("AGTGCGATGT", name="parent")
+        subseq = seq.view(4).materialize()
+        self.assertTrue(isinstance(subseq, Sequence))
+        self.assertEquals(subseq, "CGATGT")
+        self.assertEquals(subseq.name, "parent")
+
+    def test_str_behaviour(self):
+        seq = Sequence("AGTGCGATGT", name="parent")
+        views = list(seq.window(4))
+        self.assertEquals(views[0] + "A", "AGTGA")
+        self.assertEquals("A" + views[0], "AAGTG")
+        self.assertEquals(views[0] + views[1], "AGTGGTGC")
+        self.assertEquals([str(view) for view in sorted(views)], sorted(str(view) for view in views))
+        self.assertTrue(views[0] < "Z")
+        self.assertTrue(views[0] <= "AGTG" <= views[0])
+        self.assertTrue(views[1] > views[0])
+        self.assertRaises(AttributeError, getattr, views[0], "__nonexistent__")
+        self.assertRaises(AttributeError, getattr, views[0], "_nonexistent")
+
+    def test_copy_pickle(self):
+        seq = Sequence("AGTGCGATGT", name="parent")
+        view = seq.view(2, 6)
+        view.name = "child"
+        for other in (copy.copy(view), copy.deepcopy(view), pickle.loads(pickle.dumps(view, 2)), pickle.loads(pickle.dumps(view))):
+            self.assertTrue(isinstance(other, SequenceView))
+            self.assertEquals(other, "TGCG")
+            self.assertEquals(other.name, "child")
+        self.assertEquals(len(pickle.loads(pickle.dumps(view)).parent), 4)
+        other = copy.copy(view)
+        other.name = "other"
+        self.assertEquals(view.name, "child")
+
+class TestSequenceBatch(unittest.TestCase):
+    def setUp(self):
+        self.seqs = [
+            Sequence("aGTGCGATGTGCGATGAGATCg", name="one"),
+            Sequence("", name="empty"),
+            Sequence("GCNNAT", name="two", strand=-1),
+        ]
+        self.batch = SequenceBatch.from_sequences(self.seqs)
+
+    def test_roundtrip(self):
+        self.assertEquals(len(self.batch), 3)
+        self.assertEquals(list(self.batch.lengths), [22, 0, 6])
+        self.assertEquals(list(self.batch), self.seqs)
+        self.assertEquals(self.batch[-1].name, "two")
+        self.assertEquals(self.batch[-1].strand, -1)
+
+    def test_transforms(self):
+        rc = self.batch.rc
+        self.assertEquals(list(rc), [seq.rc for seq in self.seqs])
+        self.assertEquals([seq.strand for seq in rc], [-1, -1, 1])
+        self.assertEquals([seq.strand for seq in self.batch], [1, 1, -1])
+        self.assertEquals(list(self.batch.reverse), [seq.reverse for seq in self.seqs])
+        self.assertEquals(list(self.batch.compliment), [seq.compliment for seq in self.seqs])
+        self.assertEquals(list(self.batch.upper()), [seq.upper() for seq in self.seqs])
+
+    def test_counts(self):
+        self.assertEquals(list(self.batch.gc_counts), [seq.gc_count for seq in self.seqs])
+        self.assertEquals(list(self.batch.at_counts), [seq.at_count for seq in self.seqs])
+
+class TestPackedSequence(unittest.TestCase):
+    def test_roundtrip(self):
+        testseq = "aGTGNNCGATgtgcRYatgNagatcg"
+        seq = Sequence(testseq, name="packed", strand=-1)
+        packed = seq.pack()
+        self.assertTrue(isinstance(packed, PackedSequence))
+        self.assertEquals(len(packed), len(testseq))
+        self.assertEquals(str(packed), testseq)
+        unpacked = packed.to_sequence()
+        self.assertTrue(isinstance(unpacked, Sequence))
+        self.assertEquals(unpacked, seq)
+        self.assertEquals(unpacked.info, seq.info)
+
+    def test_revcomp(self):
+        testseq = "aGTGCGATGTGCNNATGAGATCg"
+        seq = Sequence(testseq)
+        packed = seq.pack()
+        self.assertEquals(packed.rc, seq.rc)
+        self.assertEquals(packed.rc.strand, -1)
+        self.assertEquals(packed.compliment, seq.compliment)
+        self.assertEquals(packed.reverse, seq.reverse)
+
+    def test_slice(self):
+        testseq = "GCATNNgcatAGGT"
+        packed = Sequence(testseq, name="slice").pack()
+        for (start, stop) in [(0, 4), (3, 9), (5, 14), (7, 7), (-6, -1)]:
+            subseq = packed[start:stop]
+            self.assertTrue(isinstance(subseq, PackedSequence))
+            self.assertEquals(subseq, testseq[start:stop])
+            self.assertEquals(subseq.name, "slice")
+        self.assertEquals(packed[::-2], testseq[::-2])
+        self.assertEquals(packed[4], "N")
+
+    def test_counts(self):
+        seq = Sequence("GcgCAtAtNN")
+        packed = seq.pack()
+        self.assertEquals(packed.gc_count, 4)
+        self.assertEquals(packed.at_count, 6)
+        self.assertEquals(packed.gc_content, seq.gc_content)
+
+    def test_kmers(self):
+        packed = Sequence("ACGTNACG").pack()
+        # ACG, CGT, then windows containing N are skipped, ACG
+        self.assertEquals(list(packed.kmers(3)), [0b000110, 0b011011, 0b000110])
+        # ACG and CGT are each other's reverse compliment
+        self.assertEquals(list(packed.kmers(3, canonical=True)), [0b000110, 0b000110, 0b000110])
+        self.assertRaises(ValueError, packed.kmers, 33)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+import unittest
+import tempfile
+import shutil
+import os
+import numpy
+from bones.sequence import *
+from bones.fast import FastA, FastQ
+from bones.simulate import *
+
+class TestReadSimulator(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.references = FastA(random_sequences(3, 2000, name="ref", rng=numpy.random.RandomState(1)))
+        self.fafn = os.path.join(self.tempdir, "references.fa")
+        self.references.save(self.fafn)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_random_sequences(self):
+        seqs = list(random_sequences(10, 100, gc_median=0.4, gc_spread=0.05))
+        self.assertEquals(len(seqs), 10)
+        self.assertEquals(seqs[3].name, "random_sequence_3")
+        for seq in seqs:
+            self.assertEquals(len(seq), 100)
+            self.assertTrue(35 <= seq.gc_count <= 45)
+
+    def test_error_free_pairs(self):
+        sim = ReadSimulator(read_length=50, insert_size=300, insert_stddev=20, error_rate=0, seed=7)
+        refs = dict((ref.name, ref) for ref in self.references)
+        pairs = list(sim.simulate(self.references, 200))
+        self.assertEquals(len(pairs), 200)
+        for (read1, read2) in pairs:
+            self.assertEquals(len(read1), 50)
+            self.assertEquals(len(read1.quality), 50)
+            self.assertEquals(read1.name[:-2], read2.name[:-2])
+            (name, start, end, serial) = read1.name[:-2].rsplit('_', 3)
+            (start, end) = (int(start) - 1, int(end))
+            fragment = refs[name][start:end]
+            self.assertTrue(set([read1.sequence, read2.sequence]) == set([fragment[:50], fragment.rc[:50]]))
+
+    def test_seeded(self):
+        pairs1 = list(ReadSimulator(read_length=30, seed=3).simulate(self.references, 20))
+        pairs2 = list(ReadSimulator(read_length=30, seed=3).simulate(self.references, 20))
+        self.assertEquals(pairs1, pairs2)
+
+    def test_errors(self):
+        sim = ReadSimulator(read_length=100, error_rate=0.05, seed=11)
+        mismatches = 0
+        refs = dict((ref.name, ref) for ref in self.references)
+        pairs = list(sim.simulate(self.references, 500))
+        for (read1, read2) in pairs:
+            (name, start, end, serial) = read1.name[:-2].rsplit('_', 3)
+            fragment = refs[name][int(start) - 1:int(end)]
+            expected = [fragment[:100], fragment.rc[:100]]
+            mismatches += min(sum(a != b for (a, b) in zip(read1.sequence, exp)) for exp in expected)
+        rate = mismatches / (500 * 100.0)
+        self.assertTrue(0.03 < rate < 0.07)
+
+    def test_write(self):
+        r1fn = os.path.join(self.tempdir, "reads_1.fq")
+        r2fn = os.path.join(self.tempdir, "reads_2.fq.gz")
+        ReadSimulator(read_length=75, seed=5).write(self.fafn, r1fn, r2fn, 250, batch_size=100)
+        reads1 = FastQ.load(r1fn)
+        reads2 = FastQ.load(r2fn)
+        self.assertEquals(len(reads1), 250)
+        self.assertEquals(len(reads2), 250)
+        self.assertEquals([read.name[:-2] for read in reads1], [read.name[:-2] for read in reads2])
+
+if __name__ == '__main__':
+    unittest.main()